@@ -1,72 +1,344 @@
-from flask import Flask, jsonify, request
+import os
+import json
+import time
+import uuid
+import base64
+import numpy as np
+from flask import Flask, jsonify, request, g, send_from_directory, abort
 from flask_cors import CORS
 from pandas import merge
 from recommender import Recommender
-from db.db_handler import DB
+from db.catalog import Catalog
 from utils.spotify_api import SpotifyAPIHandler
+from utils.media_cache import MediaCache
+from utils.response_cache import ResponseCache
+from utils.coalescer import Coalescer
+from utils.sessions import SessionStore, pack_tracks, unpack_tracks
+from utils.metrics import REGISTRY, REQUESTS, REQUEST_SECONDS, Sampler, stage
 
 app = Flask(__name__)
 CORS(app)
-db = DB()
+catalog = Catalog()
 recommender = Recommender(reuse_model=True)
-spotify_api = SpotifyAPIHandler()
+spotify_api = SpotifyAPIHandler(cache=MediaCache())
+response_cache = ResponseCache()
+# a response with the tracks whose Spotify links could not be fetched is only cached briefly, so the links are retried
+degraded_ttl = float(os.environ.get('RESPONSE_CACHE_DEGRADED_TTL', 30))
+# the concurrent /recommend calls may be answered by a single neighbour query, at the cost of waiting for each other
+coalescer = Coalescer(
+    recommender.recommend_many
+    , window=float(os.environ.get('RECOMMEND_COALESCE_WINDOW_MS', 2)) / 1000
+    , max_batch=int(os.environ.get('RECOMMEND_COALESCE_MAX_BATCH', 64))
+    , name='recommend'
+) if os.environ.get('RECOMMEND_COALESCE', '0') == '1' else None
 
+REGISTRY.start_dumping()
+# a request may ask for its stack samples with the X-Profile header or ?profile=1, only if the profiling is enabled
+profiling = os.environ.get('METRICS_PROFILING', '0') == '1'
+profiles_path = os.environ.get('METRICS_PROFILES_PATH', os.path.join(REGISTRY.directory or '/tmp', 'profiles'))
 
-@app.route('/api/v1/recommend', methods=['POST'])
-def recommend():
-    data = request.json
 
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+    if profiling and (request.headers.get('X-Profile') or request.args.get('profile')):
+        g.sampler = Sampler().start()
+
+
+@app.after_request
+def observe_request(response):
+    endpoint = request.endpoint or 'unmatched'  # the raw paths of the unknown routes would blow up the label set
+    REQUEST_SECONDS.observe(time.perf_counter() - g.start, endpoint=endpoint)
+    REQUESTS.inc(endpoint=endpoint, method=request.method, status=str(response.status_code))
+
+    sampler = g.pop('sampler', None)
+    if sampler is not None:
+        name = f"{endpoint}-{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}.folded"
+        os.makedirs(profiles_path, exist_ok=True)
+        with open(os.path.join(profiles_path, name), 'w') as f:
+            f.write(sampler.stop().collapsed())
+
+        response.headers['X-Profile-File'] = name
+
+    return response
+
+
+def cached_response(etag: str, body: bytes):
+    """Send the cached JSON body, or just 304 if the client already has this version of it"""
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(body, mimetype='application/json')
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'  # the clients may keep it, but have to revalidate
+
+    return response
+
+
+def parse_filters(filters) -> dict | str:
+    """Validate the request's filters, return the Catalog.filter() arguments or the error message"""
+    if not isinstance(filters, dict) or not set(filters) <= {'genres', 'explicit', 'popularity', 'tempo'}:
+        return "'filters' must be an object with any of 'genres', 'explicit', 'popularity' and 'tempo'"
+
+    genres = filters.get('genres')
+    if genres is not None and (not isinstance(genres, list) or not all(isinstance(g, str) for g in genres)):
+        return "'genres' must be a list of strings"
+
+    explicit = filters.get('explicit')
+    if explicit is not None and not isinstance(explicit, bool):
+        return "'explicit' must be a boolean"
+
+    parsed = {'genres': sorted(set(genres)) if genres is not None else None, 'explicit': explicit}
+    for name in ('popularity', 'tempo'):
+        bounds = filters.get(name)
+        if bounds is not None and (
+                not isinstance(bounds, list) or len(bounds) != 2
+                or not all(b is None or (isinstance(b, (int, float)) and not isinstance(b, bool)) for b in bounds)
+        ):
+            return f"'{name}' must be a [min, max] list, either of them may be null"
+        parsed[name] = bounds
+
+    return parsed
+
+
+def check_n_recs(n_recs) -> str | None:
+    """Validate the number of the recommendations, return the error message if it is not valid"""
+    limit = recommender.n_tracks - 1  # the index can't return more neighbours than it has other tracks
+    if not isinstance(n_recs, int) or isinstance(n_recs, bool) or not 1 <= n_recs <= limit:
+        return f"'n_recs' must be an integer between 1 and {limit}"
+
+
+def parse_recommend(data) -> dict | str:
+    """Validate the payload of a /recommend call, return the seeds and the options or the error message"""
     if not data or 'ids' not in data.keys():
-        return jsonify({"error": "Missing 'ids' in request payload"}), 400
+        return "Missing 'ids' in request payload"
 
     ids = data['ids']
     if not isinstance(ids, list) or not all(isinstance(i, str) for i in ids):
-        return jsonify({"error": "'ids' must be a list of strings"}), 400
-
-    n_recs = data['n_recs']
-    if not isinstance(n_recs, int):
-        return jsonify({"error": "'n_recs' must be an integer"}), 400
-
-    recs = sum(recommender.recommend(ids=ids, n_recs=n_recs).tolist(), [])  # flatten the results
-
-    results = db.query_table(
-        table_name='tracks as tr'
-        , columns=['tr.track_id', 'tr.track_name', "array_to_string(array_agg(a.artist), ', '::text) as artists"]
-        , join={
-            'tracks_artists as ta': ['tr.track_id = ta.track_id']
-            , 'artists as a': ['ta.artist_id = a.artist_id']
-        }
-        , filters={'idx': recs}
-        , group_by=['tr.track_id', 'tr.track_name']
+        return "'ids' must be a list of strings"
+
+    n_recs = data.get('n_recs')
+    error = check_n_recs(n_recs)
+    if error is not None:
+        return error
+
+    # per_seed: n_recs neighbours of every seed, taste: a single ranked list of n_recs tracks for the whole seed set
+    mode = data.get('mode', 'per_seed')
+    if mode not in ('per_seed', 'taste'):
+        return "'mode' must be either 'per_seed' or 'taste'"
+
+    method = data.get('method', 'rrf') if mode == 'taste' else None
+    if mode == 'taste' and method not in recommender.fusion_methods:
+        return f"'method' must be one of {', '.join(recommender.fusion_methods)}"
+
+    weights = data.get('weights') if mode == 'taste' else None
+    if weights is not None:
+        if (
+                not isinstance(weights, list) or len(weights) != len(ids)
+                or not all(isinstance(w, (int, float)) and not isinstance(w, bool) and w >= 0 for w in weights)
+        ):
+            return "'weights' must be a list of non-negative numbers, one per id"
+
+        weights = dict(zip(ids, weights))
+
+    filters = data.get('filters')
+    if filters is not None:
+        filters = parse_filters(filters)
+        if isinstance(filters, str):
+            return filters
+
+    ids = list(dict.fromkeys(ids))  # without the duplicates, the per_seed results line up with the input order
+    if weights is not None:
+        weights = [weights[track_id] for track_id in ids]
+
+    return {'ids': ids, 'n_recs': n_recs, 'mode': mode, 'method': method, 'weights': weights, 'filters': filters}
+
+
+def cache_params(params: dict) -> dict:
+    """Normalise the parameters for the cache key, the taste mode's ranking does not depend on the seeds' order, so
+    the equal seed sets share the cached response"""
+    if params['mode'] != 'taste':
+        return params
+
+    order = sorted(range(len(params['ids'])), key=params['ids'].__getitem__)
+    weights = [params['weights'][i] for i in order] if params['weights'] is not None else None
+
+    return {**params, 'ids': [params['ids'][i] for i in order], 'weights': weights}
+
+
+def enrich(recs) -> list[dict]:
+    """Look the recommended catalog idx up, add the Spotify links and drop the duplicates"""
+    with stage(stage='catalog_lookup'):
+        results = catalog.lookup(recs)
+    if results.empty:  # e.g. nothing has passed the filters, there are no links to merge
+        return []
+
+    with stage(stage='enrichment'):
+        track_ids = results['track_id'].tolist()
+        links = spotify_api.process_tracks(ids=track_ids)
+
+    with stage(stage='merge'):
+        results['track_artist'] = results['track_name'] + ' by ' + results['artists']
+        results = results.drop_duplicates(subset='track_id')
+        results = merge(results, links, on='track_id', how='inner')
+
+    return results.to_dict(orient='records')
+
+
+@app.route('/api/v1/recommend', methods=['POST'])
+def recommend():
+    params = parse_recommend(request.json)
+    if isinstance(params, str):
+        return jsonify({"error": params}), 400
+
+    ids, n_recs, filters = params['ids'], params['n_recs'], params['filters']
+
+    recommender.refresh()
+    catalog.refresh()
+
+    key = response_cache.key('recommend', (recommender.version, catalog.version), **cache_params(params))
+    with stage(stage='response_cache'):
+        cached = response_cache.get(key)
+    if cached is not None:
+        return cached_response(*cached)
+
+    track_filter = catalog.filter(**filters) if filters is not None else None
+
+    if params['mode'] == 'taste':
+        recs, unknown = recommender.recommend_taste(
+            ids=ids, n_recs=n_recs, method=params['method'], weights=params['weights'], return_unknown=True
+            , track_filter=track_filter
+        )
+    elif track_filter is not None:  # the filtered queries are not coalesced
+        recs, unknown = recommender.recommend(ids=ids, n_recs=n_recs, return_unknown=True, track_filter=track_filter)
+    elif coalescer is not None:
+        recs, unknown = coalescer.submit((ids, n_recs))
+    else:
+        recs, unknown = recommender.recommend(ids=ids, n_recs=n_recs, return_unknown=True)
+    if len(unknown) == len(ids):
+        return jsonify({"error": "None of the provided 'ids' are known", "unknown_ids": unknown}), 404
+
+    recs = recs.ravel()  # flatten the results, the taste mode's are flat and ranked already
+    results = enrich(recs)
+
+    with stage(stage='serialize'):
+        body = app.json.dumps(results).encode()
+
+    ttl = degraded_ttl if any(result['uri'] is None for result in results) else None
+
+    return cached_response(response_cache.set(key, body, ttl=ttl), body)
+
+
+def fetch_stream(params: dict, depth: int) -> tuple[np.ndarray, list[str], bool]:
+    """Find the session's stream at least depth tracks deep, see SessionStore"""
+    if params['mode'] == 'per_seed':  # the depth of every seed's list
+        depth = -(-depth // len(params['ids']))
+
+    track_filter = catalog.filter(**params['filters']) if params['filters'] is not None else None
+    return recommender.recommend_stream(
+        params['ids'], depth, mode=params['mode'], method=params['method'], weights=params['weights']
+        , track_filter=track_filter
     )
 
-    track_ids = results['track_id'].tolist()
-    links = spotify_api.process_tracks(ids=track_ids)
 
-    results['track_artist'] = results['track_name'] + ' by ' + results['artists']
-    results = results.drop_duplicates(subset='track_id')
-    results = merge(results, links, on='track_id', how='inner')
+sessions = SessionStore(fetch_stream)
+
+
+@app.route('/api/v1/recommend/session', methods=['POST'])
+def recommend_session():
+    """The first page takes the /recommend payload with n_recs as the page size, the next ones {"cursor": ...}"""
+    data = request.json or {}
+
+    recommender.refresh()
+    catalog.refresh()
+    versions = [recommender.version, catalog.version]
+
+    if 'cursor' in data:
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(data['cursor']))
+            params, served = cursor['params'], unpack_tracks(cursor['served'])
+            if (np.diff(served) <= 0).any() or parse_recommend(params) != params:
+                raise ValueError
+        except (TypeError, ValueError, KeyError):
+            return jsonify({"error": "Invalid 'cursor'"}), 400
+
+        if cursor.get('versions') != versions:
+            return jsonify({"error": "The cursor has expired, the model or the catalog has changed"}), 410
+    else:
+        params, served = parse_recommend(data), np.empty(0, dtype=np.int64)
+        if isinstance(params, str):
+            return jsonify({"error": params}), 400
+
+    # the cursor carries the served tracks, so that another worker, or the same one after the session has expired,
+    # never serves them again
+    key = response_cache.key('session', tuple(versions), **cache_params(params))
+    recs, unknown, has_more = sessions.page(key, params, len(served), params['n_recs'], served=served)
+    if len(unknown) == len(params['ids']):
+        return jsonify({"error": "None of the provided 'ids' are known", "unknown_ids": unknown}), 404
+
+    next_cursor = base64.urlsafe_b64encode(json.dumps({
+        'params': params, 'served': pack_tracks(np.concatenate([served, recs])), 'versions': versions
+    }).encode()).decode() if has_more else None
+
+    return jsonify({'recommendations': enrich(recs), 'unknown_ids': unknown, 'cursor': next_cursor}), 200
 
-    results = results.to_dict(orient='records')
-    # links = links.to_dict(orient='records')
 
-    return jsonify(results), 200
+@app.route('/api/v1/recommend/batch', methods=['POST'])
+def recommend_batch():
+    data = request.json
+
+    if not data or 'seeds' not in data.keys():
+        return jsonify({"error": "Missing 'seeds' in request payload"}), 400
+
+    seeds = data['seeds']
+    if (
+            not isinstance(seeds, list)
+            or not all(isinstance(ids, list) and all(isinstance(i, str) for i in ids) for ids in seeds)
+    ):
+        return jsonify({"error": "'seeds' must be a list of lists of strings"}), 400
+
+    n_recs = data.get('n_recs')
+    error = check_n_recs(n_recs)
+    if error is not None:
+        return jsonify({"error": error}), 400
+
+    enrich = data.get('enrich', False)
+    if not isinstance(enrich, bool):
+        return jsonify({"error": "'enrich' must be a boolean"}), 400
+
+    recommender.refresh()
+    blocks, unknown = recommender.recommend_batch(seeds=seeds, n_recs=n_recs, return_unknown=True)
+
+    catalog.refresh()
+    results = [catalog.lookup(recs) for recs in blocks]
+
+    if enrich:  # a single call for all the blocks, then spread the links back
+        track_ids = list(dict.fromkeys(track_id for block in results for track_id in block['track_id']))
+        links = spotify_api.process_tracks(ids=track_ids)
+
+        if not links.empty:
+            results = [merge(block, links, on='track_id', how='inner') for block in results]
+
+    response = []
+    for ids, unknown_ids, block in zip(seeds, unknown, results):
+        block['track_artist'] = block['track_name'] + ' by ' + block['artists']
+        response.append({
+            'ids': ids
+            , 'unknown_ids': unknown_ids
+            , 'recommendations': block.to_dict(orient='records')
+        })
+
+    return jsonify(response), 200
 
 
 @app.route('/api/v1/autocomplete', methods=['GET'])
 def autocomplete():
     query = request.args.get('q', '')
-    suggestions = db.query_table(
-        table_name='tracks as tr'
-        , columns=['tr.track_id', 'tr.track_name', "array_to_string(array_agg(a.artist), ', '::text) as artists"]
-        , join={
-            'tracks_artists as ta': ['tr.track_id = ta.track_id']
-            , 'artists as a': ['ta.artist_id = a.artist_id']
-        }
-        , filters={'tr.track_name_like': query}
-        , group_by=['tr.track_id', 'tr.track_name']
-        , limit=10
-    )
+
+    catalog.refresh()
+    suggestions = catalog.search(query, limit=10)
 
     suggestions['track_artist'] = suggestions['track_name'] + ' by ' + suggestions['artists']
     suggestions = suggestions.to_dict(orient='records')
@@ -74,9 +346,41 @@ def autocomplete():
     return suggestions, 200
 
 
-@app.route('/api/v1/test', methods=['GET'])
-def test_api():
-    return {'api_status': 'works fine'}, 200
+@app.route('/health/live', methods=['GET'])
+def liveness():
+    return {'status': 'alive'}, 200
+
+
+@app.route('/health/ready', methods=['GET'])
+def readiness():
+    # the requests are served from the memory, a DB outage only delays the next refresh, so it is reported, but the
+    # worker stays in the pool
+    checks = {
+        'model': recommender.model is not None
+        , 'catalog': len(catalog) > 0
+    }
+    status = {
+        'status': 'ready' if all(checks.values()) else 'not ready'
+        , 'checks': checks
+        , 'database': catalog.ping()
+        , 'model_version': recommender.version
+        , 'catalog_version': catalog.version
+    }
+
+    return status, 200 if all(checks.values()) else 503
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return app.response_class(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/metrics/profiles/<name>', methods=['GET'])
+def profile(name: str):
+    if not profiling:
+        abort(404)
+
+    return send_from_directory(profiles_path, name, mimetype='text/plain')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+
+# the audio features of the source dataset, the recommender is trained on them
+FEATURES = [
+    'popularity', 'duration_ms', 'danceability', 'energy', 'loudness', 'mode', 'speechiness', 'acousticness'
+    , 'instrumentalness', 'liveness', 'valence', 'tempo'
+]
+
+
+def synthetic_dataset(n_tracks: int = 20_000, seed: int = 0) -> pd.DataFrame:
+    """
+    Generate a dataset in the format of the source one (see db/etl.py), so that it can go through the very same ETL
+    :param n_tracks: number of the tracks
+    :param seed: seed of the generator, the same seed gives the same dataset
+    :return: pandas' DataFrame with the source's columns
+    """
+    rng = np.random.default_rng(seed)
+    syllables = np.array(['la', 'mo', 'ri', 'ta', 'ne', 'so', 'ku', 'vi', 'da', 'pe', 'lo', 'mi', 'ra', 'zu'])
+
+    def words(n: int, n_syllables: int) -> np.ndarray:
+        return np.array([''.join(parts).title() for parts in rng.choice(syllables, size=(n, n_syllables))])
+
+    artists = words(max(n_tracks // 10, 1), 3)
+    albums = words(max(n_tracks // 8, 1), 4)
+    names = words(n_tracks, 2).astype(object) + ' ' + words(n_tracks, 3).astype(object)
+
+    main_artists = rng.integers(0, len(artists), n_tracks)
+    featured = rng.integers(0, len(artists), n_tracks)
+    track_artists = np.where(
+        rng.random(n_tracks) < 0.2
+        , artists[main_artists].astype(object) + ';' + artists[featured].astype(object)
+        , artists[main_artists].astype(object)
+    )
+
+    return pd.DataFrame({
+        'track_id': [f'{i:022d}' for i in rng.permutation(n_tracks)]  # the length of the Spotify ids
+        , 'artists': track_artists
+        , 'album_name': albums[rng.integers(0, len(albums), n_tracks)]
+        , 'track_name': names
+        , 'popularity': rng.integers(0, 100, n_tracks)
+        , 'duration_ms': rng.integers(60_000, 400_000, n_tracks)
+        , 'explicit': rng.random(n_tracks) < 0.1
+        , 'danceability': rng.random(n_tracks)
+        , 'energy': rng.random(n_tracks)
+        , 'key': rng.integers(0, 12, n_tracks)
+        , 'loudness': rng.normal(-8, 4, n_tracks)
+        , 'mode': rng.integers(0, 2, n_tracks)
+        , 'speechiness': rng.beta(1, 8, n_tracks)
+        , 'acousticness': rng.random(n_tracks)
+        , 'instrumentalness': rng.beta(1, 4, n_tracks)
+        , 'liveness': rng.beta(2, 8, n_tracks)
+        , 'valence': rng.random(n_tracks)
+        , 'tempo': rng.normal(120, 25, n_tracks)
+        , 'time_signature': rng.choice([3, 4, 5], n_tracks, p=[0.1, 0.85, 0.05])
+        , 'track_genre': rng.choice(['pop', 'rock', 'jazz', 'techno', 'folk', 'hip-hop'], n_tracks)
+    })
+
+
+if __name__ == '__main__':  # python -m benchmarks.data <path> [n_tracks], e.g. to seed a local DB with ETL_SOURCE
+    import sys
+
+    synthetic_dataset(int(sys.argv[2]) if len(sys.argv) > 2 else 20_000).to_csv(sys.argv[1])
@@ -0,0 +1,102 @@
+import time
+import threading
+from collections import defaultdict
+import numpy as np
+import requests
+
+
+def collect_seeds(url: str, prefixes: list[str], timeout: float = 10) -> list[str]:
+    """Collect the track ids to use as the seeds through the autocomplete, so that any running API can be loaded"""
+    ids = []
+    with requests.Session() as session:
+        for prefix in prefixes:
+            response = session.get(f'{url}/api/v1/autocomplete', params={'q': prefix}, timeout=timeout)
+            if response.ok:
+                ids.extend(entry['track_id'] for entry in response.json())
+
+    return list(dict.fromkeys(ids))
+
+
+def _percentiles(latencies: list[float]) -> dict[str, float]:
+    if not latencies:
+        return {'p50_ms': None, 'p95_ms': None, 'p99_ms': None}
+
+    p50, p95, p99 = np.percentile(np.asarray(latencies) * 1e3, [50, 95, 99])
+
+    return {'p50_ms': round(float(p50), 2), 'p95_ms': round(float(p95), 2), 'p99_ms': round(float(p99), 2)}
+
+
+def run(
+        url: str
+        , seeds: list[str]
+        , prefixes: list[str]
+        , duration: float = 30
+        , concurrency: int = 8
+        , recommend_share: float = 0.3
+        , n_seeds: int = 3
+        , n_recs: int = 10
+        , zipf: float = 1.2
+        , seed: int = 0
+        , timeout: float = 30
+) -> dict[str, dict]:
+    """
+    Load the running API with a mix of /recommend and /autocomplete requests from concurrent clients
+    :param url: base URL of the API
+    :param seeds: the track ids to draw the seeds from, the popular ones first, they are drawn with a Zipf distribution
+    :param prefixes: the autocomplete queries
+    :param duration: number of seconds to run for
+    :param concurrency: number of the concurrent clients
+    :param recommend_share: share of the /recommend requests, the rest are autocompletes
+    :param n_seeds: number of the seeds per /recommend request
+    :param n_recs: number of the recommendations per seed
+    :param zipf: exponent of the seeds' popularity, the real traffic follows a power law
+    :param seed: seed of the clients' generators
+    :param timeout: timeout of a single request
+    :return: endpoint -> requests, errors, throughput and latency percentiles
+    """
+    samples = defaultdict(list)  # endpoint -> [(latency, ok)], list.append is atomic
+    deadline = time.monotonic() + duration
+
+    def client(client_seed: int) -> None:
+        rng = np.random.default_rng(client_seed)
+
+        with requests.Session() as session:
+            while time.monotonic() < deadline:
+                if rng.random() < recommend_share:
+                    endpoint = 'recommend'
+                    picks = np.minimum(rng.zipf(zipf, size=n_seeds), len(seeds)) - 1
+                    send = lambda: session.post(
+                        f'{url}/api/v1/recommend', json={'ids': [seeds[i] for i in picks], 'n_recs': n_recs}
+                        , timeout=timeout
+                    )
+                else:
+                    endpoint = 'autocomplete'
+                    query = prefixes[rng.integers(len(prefixes))]
+                    send = lambda: session.get(f'{url}/api/v1/autocomplete', params={'q': query}, timeout=timeout)
+
+                start = time.perf_counter()
+                try:
+                    ok = send().status_code < 400
+                except requests.RequestException:
+                    ok = False
+                samples[endpoint].append((time.perf_counter() - start, ok))
+
+    threads = [threading.Thread(target=client, args=(seed + i,)) for i in range(concurrency)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    results = {}
+    for endpoint, endpoint_samples in sorted(samples.items()):
+        latencies = [latency for latency, ok in endpoint_samples if ok]
+        results[endpoint] = {
+            'requests': len(endpoint_samples)
+            , 'errors': len(endpoint_samples) - len(latencies)
+            , 'throughput_rps': round(len(endpoint_samples) / elapsed, 1)
+            , **_percentiles(latencies)
+        }
+
+    return results
@@ -0,0 +1,204 @@
+import os
+import time
+import tempfile
+from typing import Callable
+import numpy as np
+from benchmarks.data import FEATURES, synthetic_dataset
+from benchmarks.mock_spotify import MockSpotify
+
+
+def timed(func: Callable, repeat: int = 1000, warmup: int = 20) -> dict[str, float]:
+    """
+    Time the calls of the function
+    :param func: the function to call, without arguments
+    :param repeat: number of the timed calls
+    :param warmup: number of the calls before the timing starts
+    :return: mean and percentiles of the latency in microseconds, and the calls per second
+    """
+    for _ in range(warmup):
+        func()
+
+    latencies = np.empty(repeat)
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        latencies[i] = time.perf_counter() - start
+
+    latencies *= 1e6
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+
+    return {
+        'calls': repeat
+        , 'mean_us': round(float(latencies.mean()), 2)
+        , 'p50_us': round(float(p50), 2)
+        , 'p95_us': round(float(p95), 2)
+        , 'p99_us': round(float(p99), 2)
+        , 'ops_per_s': round(float(1e6 / latencies.mean()), 1)
+    }
+
+
+def recommender_benchmarks(df, artifacts_path: str, repeat: int, seed: int = 0) -> dict[str, dict]:
+    """Benchmark the recommender loaded from an artifact built from the dataset, no DB is needed"""
+    from ml.engines import build_index
+    from ml.artifacts import ModelArtifact
+    from recommender import Recommender
+
+    features, projection = Recommender._preprocess_data(df.set_index('track_id')[FEATURES], n_components=6)
+    ModelArtifact.publish(
+        ids=features.index.to_numpy()
+        , features=features.to_numpy()
+        , columns=features.columns.tolist()
+        , model=build_index(features.to_numpy(), engine=os.environ.get('RECOMMENDER_ENGINE', 'kdtree'))
+        , root=artifacts_path
+        , extras={'row_idx': np.arange(len(features)), **projection.arrays}
+        , metadata={'projection_columns': projection.columns}
+    )
+    recommender = Recommender(artifacts_path=artifacts_path)
+
+    rng = np.random.default_rng(seed)
+    ids = df['track_id'].to_numpy()
+
+    def seeds(n: int) -> list[str]:
+        return rng.choice(ids, size=n, replace=False).tolist()
+
+    return {
+        'recommend_1_seed': timed(lambda: recommender.recommend(seeds(1), n_recs=10), repeat=repeat)
+        , 'recommend_10_seeds': timed(lambda: recommender.recommend(seeds(10), n_recs=10), repeat=repeat)
+        , 'recommend_batch_32x3': timed(
+            lambda: recommender.recommend_batch([seeds(3) for _ in range(32)], n_recs=10), repeat=max(repeat // 10, 10)
+        )
+    }
+
+
+def db_benchmarks(repeat: int) -> dict[str, dict]:
+    """Benchmark the query building, and the queries themselves if the DB is reachable"""
+    from db.db_handler import DB
+
+    filters = {'tr.track_name_like': 'love', 'tr.popularity': [50.0, 60.0, 70.0], 'tr.explicit': None}
+    results = {'build_filters': timed(lambda: DB._build_filters(filters=filters), repeat=repeat * 10)}
+
+    if not DB.ping():
+        results['query_table'] = {'skipped': 'the database is not reachable, see POSTGRES_HOST and POSTGRES_PORT'}
+        return results
+
+    results['query_table'] = timed(
+        lambda: DB.query_table(
+            table_name='tracks as tr'
+            , columns=['tr.track_id', 'tr.track_name', "array_to_string(array_agg(a.artist), ', '::text) as artists"]
+            , join={
+                'tracks_artists as ta': ['tr.track_id = ta.track_id']
+                , 'artists as a': ['ta.artist_id = a.artist_id']
+            }
+            , filters={'tr.track_name_like': 'lo'}
+            , group_by=['tr.track_id', 'tr.track_name']
+            , limit=10
+        )
+        , repeat=max(repeat // 10, 10)
+    )
+
+    return results
+
+
+def spotify_benchmarks(df, cache_path: str, latency_ms: float, repeat: int, seed: int = 0) -> dict[str, dict]:
+    """Benchmark the enrichment against the local Spotify stand-in, with and without the media cache"""
+    os.environ.setdefault('SPOTIFY_ID', 'benchmark')
+    os.environ.setdefault('SPOTIFY_SECRET', 'benchmark')
+
+    from utils.spotify_api import SpotifyAPIHandler
+    from utils.media_cache import MediaCache
+
+    rng = np.random.default_rng(seed)
+    ids = df['track_id'].to_numpy()
+    repeat = max(repeat // 50, 5)
+
+    with MockSpotify(latency_ms=latency_ms) as mock:
+        def client(cache: MediaCache = None) -> SpotifyAPIHandler:
+            api = SpotifyAPIHandler(cache=cache)
+            api._api_url = mock.environment['SPOTIFY_API_URL']
+            api._accounts_url = mock.environment['SPOTIFY_ACCOUNTS_URL']
+
+            return api
+
+        uncached = client()
+        cached = client(MediaCache(path=cache_path))
+        hot = rng.choice(ids, size=100, replace=False).tolist()
+        cached.process_tracks(hot)
+
+        results = {
+            'process_tracks_100_uncached': timed(
+                lambda: uncached.process_tracks(rng.choice(ids, size=100, replace=False).tolist()), repeat=repeat
+                , warmup=2
+            )
+            , 'process_tracks_100_cached': timed(lambda: cached.process_tracks(hot), repeat=repeat * 10)
+        }
+        results['spotify_requests'] = dict(mock.counters)
+
+    return results
+
+
+def search_benchmarks(df, repeat: int, seed: int = 0) -> dict[str, dict]:
+    """Benchmark the autocomplete's search index"""
+    from db.search import SearchIndex
+
+    index = SearchIndex(
+        idx=np.arange(len(df)), names=df['track_name'].to_numpy(), artists=df['artists'].to_numpy()
+        , popularity=df['popularity'].to_numpy()
+    )
+    rng = np.random.default_rng(seed)
+    names = df['track_name'].to_numpy()
+
+    return {
+        'search_prefix_2': timed(lambda: index.search(rng.choice(names)[:2]), repeat=repeat)
+        , 'search_prefix_5': timed(lambda: index.search(rng.choice(names)[:5]), repeat=repeat)
+        , 'search_no_match': timed(lambda: index.search('qqqxx'), repeat=repeat)
+    }
+
+
+def snapshot_benchmarks(df, snapshot_path: str, repeat: int) -> dict[str, dict]:
+    """Benchmark the startup reads of the columnar snapshot, the features as Parquet and as memory-mapped Arrow"""
+    from db.snapshot import Snapshot
+
+    if not Snapshot.available():
+        return {'skipped': 'pyarrow is not installed'}
+
+    features = df[['track_id', *FEATURES]]
+    snapshot = Snapshot.publish(
+        {'tracks': df, 'pr_comps': features}, catalog_version='benchmark', formats={'pr_comps': 'arrow'}
+        , root=snapshot_path
+    )
+    repeat = max(repeat // 50, 5)
+
+    return {
+        'read_tracks_all_columns': timed(lambda: snapshot.read_pandas('tracks'), repeat=repeat, warmup=2)
+        , 'read_tracks_features': timed(
+            lambda: snapshot.read_pandas('tracks', columns=['track_id', *FEATURES]), repeat=repeat, warmup=2
+        )
+        , 'read_features_arrow': timed(lambda: snapshot.read_pandas('pr_comps'), repeat=repeat, warmup=2)
+        , 'read_tracks_by_ids': timed(
+            lambda: snapshot.read_pandas('tracks', filters={'track_id': df['track_id'].iloc[:100].tolist()})
+            , repeat=repeat, warmup=2
+        )
+    }
+
+
+def run(n_tracks: int = 20_000, repeat: int = 1000, spotify_latency_ms: float = 20, seed: int = 0) -> dict:
+    """
+    Run all the micro-benchmarks on a synthetic dataset
+    :param n_tracks: size of the synthetic catalog
+    :param repeat: number of the timed calls of the fast benchmarks, the slow ones use a fraction of it
+    :param spotify_latency_ms: latency of the Spotify stand-in
+    :param seed: seed of the dataset and of the sampled inputs
+    :return: benchmark name -> its statistics
+    """
+    df = synthetic_dataset(n_tracks, seed=seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        return {
+            'recommender': recommender_benchmarks(df, os.path.join(tmp, 'artifacts'), repeat=repeat, seed=seed)
+            , 'search': search_benchmarks(df, repeat=repeat, seed=seed)
+            , 'snapshot': snapshot_benchmarks(df, os.path.join(tmp, 'snapshots'), repeat=repeat)
+            , 'db': db_benchmarks(repeat=repeat)
+            , 'spotify': spotify_benchmarks(
+                df, os.path.join(tmp, 'media.sqlite'), latency_ms=spotify_latency_ms, repeat=repeat, seed=seed
+            )
+        }
@@ -0,0 +1,170 @@
+import json
+import time
+import uuid
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class MockSpotify:
+    """
+    A local stand-in for the Spotify Web API with a configurable latency and failures
+    ...
+
+    Attributes
+    ----------
+    :param latency_ms: delay of every response
+    :param rate_limit_every: every n-th track request is answered with 429, never if 0
+    :param token_ttl_requests: the token expires after this many track requests, i.e. they are answered with 401, never
+        if 0
+    :param unknown_ids: the track ids the API does not know, answered with null
+    :param port: port to listen on, a free one if 0
+
+    Methods
+    -------
+    start() -> MockSpotify:
+        Start serving in a background thread
+    stop() -> None:
+        Stop serving
+    """
+    def __init__(
+            self
+            , latency_ms: float = 0
+            , rate_limit_every: int = 0
+            , token_ttl_requests: int = 0
+            , unknown_ids: set[str] = None
+            , port: int = 0
+    ):
+        self.latency_ms = latency_ms
+        self.rate_limit_every = rate_limit_every
+        self.token_ttl_requests = token_ttl_requests
+        self.unknown_ids = unknown_ids or set()
+        self.counters = {'token': 0, 'tracks': 0, 'rate_limited': 0, 'unauthorized': 0}
+
+        self._lock = threading.Lock()
+        self._token = ''
+        self._token_requests = 0
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self._server.server_address[1]}'
+
+    @property
+    def environment(self) -> dict[str, str]:
+        """The environment variables that point the client at the stand-in"""
+        return {'SPOTIFY_API_URL': f'{self.url}/v1', 'SPOTIFY_ACCOUNTS_URL': f'{self.url}/api'}
+
+    def _track(self, track_id: str) -> dict | None:
+        if track_id in self.unknown_ids:
+            return None
+
+        return {
+            'id': track_id
+            , 'uri': f'spotify:track:{track_id}'
+            , 'album': {'images': [{'url': f'{self.url}/images/{track_id}.jpg', 'height': 640, 'width': 640}]}
+        }
+
+    def _respond_tracks(self, authorization: str) -> int:
+        """Decide the status of a track request, counts it"""
+        with self._lock:
+            self.counters['tracks'] += 1
+            self._token_requests += 1
+
+            if not self._token or authorization.split()[-1:] != [self._token]:
+                self.counters['unauthorized'] += 1
+                return 401
+            if self.token_ttl_requests and self._token_requests > self.token_ttl_requests:
+                self._token = ''  # expired, the client has to ask for a new one
+                self.counters['unauthorized'] += 1
+                return 401
+            if self.rate_limit_every and self.counters['tracks'] % self.rate_limit_every == 0:
+                self.counters['rate_limited'] += 1
+                return 429
+
+        return 200
+
+    def _handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, as the real API
+
+            def _send(self, status: int, payload: dict) -> None:
+                time.sleep(mock.latency_ms / 1000)
+                body = json.dumps(payload).encode()
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                if status == 429:
+                    self.send_header('Retry-After', '1')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+                if urlparse(self.path).path != '/api/token':
+                    return self._send(404, {'error': 'not found'})
+
+                with mock._lock:
+                    mock.counters['token'] += 1
+                    mock._token = uuid.uuid4().hex
+                    mock._token_requests = 0
+                    token = mock._token
+
+                self._send(200, {'access_token': token, 'token_type': 'Bearer', 'expires_in': 3600})
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if not url.path.startswith('/v1/tracks'):
+                    return self._send(404, {'error': 'not found'})
+
+                status = mock._respond_tracks(self.headers.get('Authorization', ''))
+                if status != 200:
+                    return self._send(status, {'error': {'status': status}})
+
+                if url.path == '/v1/tracks':
+                    ids = parse_qs(url.query).get('ids', [''])[0].split(',')
+                    if len(ids) > 50:
+                        return self._send(400, {'error': {'status': 400, 'message': 'Too many ids requested'}})
+
+                    return self._send(200, {'tracks': [mock._track(track_id) for track_id in ids]})
+
+                track = mock._track(url.path.rsplit('/', 1)[-1])
+                self._send(200 if track else 404, track or {'error': {'status': 404}})
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> 'MockSpotify':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> 'MockSpotify':
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+
+if __name__ == '__main__':  # python -m benchmarks.mock_spotify [port] [latency_ms]
+    import sys
+
+    server = MockSpotify(
+        port=int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+        , latency_ms=float(sys.argv[2]) if len(sys.argv) > 2 else 50
+    )
+    print(f'Serving the Spotify stand-in on {server.url}, {server.environment}')
+    server._server.serve_forever()
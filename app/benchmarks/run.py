@@ -0,0 +1,160 @@
+"""
+Benchmark suite, the results are stored as JSON, so that they can be compared between the commits.
+
+Run from the app directory:
+    python -m benchmarks.run micro
+    python -m benchmarks.run load --url http://127.0.0.1:5000 --duration 30 --concurrency 8
+    python -m benchmarks.run compare benchmarks/results/<old>.json benchmarks/results/<new>.json
+"""
+import os
+import sys
+import json
+import time
+import string
+import argparse
+import platform
+import subprocess
+import numpy as np
+import sklearn
+
+results_path = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def _commit() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+            , cwd=os.path.dirname(__file__)
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save(kind: str, results: dict, arguments: dict, path: str = None) -> str:
+    """Save the results along with the commit and the environment, return the file's path"""
+    path = path or results_path
+    os.makedirs(path, exist_ok=True)
+
+    commit = _commit()
+    report = {
+        'kind': kind
+        , 'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z')
+        , 'commit': commit
+        , 'environment': {
+            'python': sys.version.split()[0], 'numpy': np.__version__, 'sklearn': sklearn.__version__
+            , 'platform': platform.platform(), 'cpus': os.cpu_count()
+        }
+        , 'arguments': arguments
+        , 'results': results
+    }
+
+    name = os.path.join(path, f"{time.strftime('%Y%m%dT%H%M%S')}-{kind}-{commit or 'unknown'}.json")
+    with open(name, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    return name
+
+
+def _flatten(results: dict, prefix: str = '') -> dict[str, float]:
+    """Flatten the nested results into metric path -> value"""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f'{prefix}{key}'] = value
+
+    return flat
+
+
+def compare(old_path: str, new_path: str, threshold: float = 0.1) -> list[str]:
+    """
+    Compare the latencies and the throughputs of two result files
+    :param old_path: the baseline results
+    :param new_path: the new results
+    :param threshold: relative change considered a regression
+    :return: the regressed metrics
+    """
+    with open(old_path) as f:
+        old = _flatten(json.load(f)['results'])
+    with open(new_path) as f:
+        new = _flatten(json.load(f)['results'])
+
+    regressions = []
+    for metric in sorted(old.keys() & new.keys()):
+        higher_is_better = metric.endswith(('ops_per_s', 'throughput_rps'))
+        if not (metric.endswith(('_us', '_ms')) or higher_is_better) or not old[metric]:
+            continue
+
+        change = (new[metric] - old[metric]) / old[metric]
+        regressed = -change > threshold if higher_is_better else change > threshold
+        print(f"{metric:<60} {old[metric]:>12} {new[metric]:>12} {change:>+8.1%}{'  REGRESSION' if regressed else ''}")
+
+        if regressed:
+            regressions.append(metric)
+
+    return regressions
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the recommender and the API')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    micro = commands.add_parser('micro', help='micro-benchmarks of the hot paths on a synthetic catalog')
+    micro.add_argument('--n-tracks', type=int, default=20_000)
+    micro.add_argument('--repeat', type=int, default=1000)
+    micro.add_argument('--spotify-latency-ms', type=float, default=20)
+    micro.add_argument('--seed', type=int, default=0)
+    micro.add_argument('--output', default=None)
+
+    load = commands.add_parser('load', help='load the running API with concurrent clients')
+    load.add_argument('--url', default='http://127.0.0.1:5000')
+    load.add_argument('--duration', type=float, default=30)
+    load.add_argument('--concurrency', type=int, default=8)
+    load.add_argument('--recommend-share', type=float, default=0.3)
+    load.add_argument('--n-seeds', type=int, default=3)
+    load.add_argument('--n-recs', type=int, default=10)
+    load.add_argument('--seed', type=int, default=0)
+    load.add_argument('--output', default=None)
+
+    diff = commands.add_parser('compare', help='compare two result files')
+    diff.add_argument('old')
+    diff.add_argument('new')
+    diff.add_argument('--threshold', type=float, default=0.1)
+
+    args = parser.parse_args(argv)
+    arguments = {key: value for key, value in vars(args).items() if key not in ('command', 'output')}
+
+    if args.command == 'micro':
+        from benchmarks import micro as benchmark
+
+        results = benchmark.run(
+            n_tracks=args.n_tracks, repeat=args.repeat, spotify_latency_ms=args.spotify_latency_ms, seed=args.seed
+        )
+        print(json.dumps(results, indent=2))
+        print(f"Results saved into {save('micro', results, arguments, path=args.output)}")
+
+    elif args.command == 'load':
+        from benchmarks import load as benchmark
+
+        prefixes = [a + b for a in string.ascii_lowercase for b in 'aeiou']
+        seeds = benchmark.collect_seeds(args.url, prefixes)
+        if not seeds:
+            print(f'Could not collect any seeds from {args.url}, is the API running?')
+            return 1
+
+        results = benchmark.run(
+            args.url, seeds=seeds, prefixes=prefixes, duration=args.duration, concurrency=args.concurrency
+            , recommend_share=args.recommend_share, n_seeds=args.n_seeds, n_recs=args.n_recs, seed=args.seed
+        )
+        print(json.dumps(results, indent=2))
+        print(f"Results saved into {save('load', results, arguments, path=args.output)}")
+
+    else:
+        return 1 if compare(args.old, args.new, threshold=args.threshold) else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
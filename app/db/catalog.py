@@ -0,0 +1,278 @@
+import time
+import threading
+from typing import NamedTuple
+import numpy as np
+import pandas as pd
+from db.db_handler import DB
+from db.search import SearchIndex
+from db.snapshot import Snapshot
+from utils.cache import LRUCache
+from utils.metrics import CATALOG_ROWS, CATALOG_LOAD_SECONDS
+
+
+class TrackFilter(NamedTuple):
+    """
+    A filter resolved against the catalog by Catalog.filter(), the masks are addressed by the tracks' idx
+    """
+    allowed: np.ndarray  # idx -> whether the track passes the filter
+    partition: str | None = None  # the sub-index' name, e.g. 'genre=rock@<catalog version>'
+    partition_mask: np.ndarray | None = None  # idx -> whether the track belongs to the sub-index
+
+
+class Catalog(DB):
+    """
+    A read-only in-memory copy of the track catalog, stored column-wise and addressed by the tracks' idx, extends the
+    parent DB class, inherits all public methods
+    ...
+
+    Attributes
+    ----------
+    :param refresh_interval: minimal number of seconds between two checks of the published catalog version
+
+    Methods
+    -------
+    load() -> None:
+        Load the catalog from the columnar snapshot (see db/snapshot.py) or from the DB
+    refresh() -> bool:
+        Reload the catalog if a new version has been published since the last load
+    lookup(idx: list[int] | np.ndarray) -> pd.DataFrame:
+        Resolve the given idx values into track ids, names and artists
+    search(query: str, limit: int = 10) -> pd.DataFrame:
+        Find the most popular tracks whose name or artists contain the query
+    filter(genres: list[str] = None, explicit: bool = None, ...) -> TrackFilter | None:
+        Resolve the filter into a mask over the idx, for the recommender
+    """
+    _columns = ['track_id', 'track_name', 'artists']
+    _ranges = ['popularity', 'tempo']  # the numeric columns the filters may restrict to a range
+
+    def __init__(self, refresh_interval: float = 5.0):
+        self._refresh_interval = refresh_interval
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+        self.version = ''
+        self._valid = np.zeros(0, dtype=bool)
+        self._data = {col: np.empty(0, dtype=object) for col in self._columns}
+        self._search = SearchIndex(idx=[], names=[], artists=[], popularity=[])
+        self._bitmaps: dict[str, np.ndarray] = {}
+        self._numeric = {col: np.empty(0, dtype=np.float32) for col in self._ranges}
+        self._masks = LRUCache(maxsize=64)  # the recently used filters' masks
+
+        self.load()
+
+    def __len__(self) -> int:
+        return int(self._valid.sum())
+
+    def load(self) -> None:
+        """
+        Load the catalog from the columnar snapshot, or from the DB if the snapshot is missing or stale, the arrays are
+            swapped at once, so concurrent readers see either the old or the new catalog, but never a mix of both
+        :return: void function
+        """
+        start = time.perf_counter()
+        version = self.catalog_version()
+
+        snapshot = Snapshot.current(catalog_version=version)
+        if snapshot is not None and snapshot.has('tracks', 'tracks_artists', 'artists'):
+            columns = self._from_snapshot(snapshot)
+        else:
+            if not self.table_exists(table_name='tracks'):
+                raise ValueError(f'The table tracks does not exist')
+
+            columns = self.fetch('catalog', output='numpy')  # the plain columns, no DataFrame in between
+            if not columns:
+                columns = {
+                    col: np.empty(0, dtype=object)
+                    for col in ['idx', 'popularity', 'track_genre', 'explicit', 'tempo', *self._columns]
+                }
+
+        positions = np.asarray(columns['idx'], dtype=np.int64)
+        size = int(positions.max()) + 1 if positions.size else 0
+
+        valid = np.zeros(size, dtype=bool)
+        valid[positions] = True
+
+        data = {}
+        for col in self._columns:
+            column = np.empty(size, dtype=object)
+            column[positions] = columns[col]
+            data[col] = column
+
+        search = SearchIndex(
+            idx=positions
+            , names=columns['track_name']
+            , artists=columns['artists']
+            , popularity=columns['popularity']
+        )
+
+        numeric = {}
+        for col in self._ranges:
+            column = np.full(size, np.nan, dtype=np.float32)  # NaN fails every range
+            column[positions] = pd.to_numeric(columns[col], errors='coerce')
+            numeric[col] = column
+
+        # one packed bitmap per genre and for the explicit tracks, 1 bit per idx
+        bitmaps = {}
+        codes, genres = pd.factorize(pd.Series(columns['track_genre'], dtype=object))
+        genre_codes = np.full(size, -1, dtype=np.int32)
+        genre_codes[positions] = codes
+        for code, genre in enumerate(genres):
+            bitmaps[f'genre={genre}'] = np.packbits(genre_codes == code)
+
+        explicit = np.zeros(size, dtype=bool)
+        explicit[positions] = pd.Series(columns['explicit']).eq(True).to_numpy()  # null is not explicit
+        bitmaps['explicit'] = np.packbits(explicit)
+
+        self._valid, self._data, self._search, self._bitmaps, self._numeric = valid, data, search, bitmaps, numeric
+        self.version = version
+        self._last_check = time.monotonic()
+
+        CATALOG_ROWS.set(len(positions))
+        CATALOG_LOAD_SECONDS.set(time.perf_counter() - start)
+
+    @staticmethod
+    def _from_snapshot(snapshot: Snapshot) -> dict[str, np.ndarray]:
+        """Read the catalog's columns from the columnar snapshot, the artists are joined the same way the DB does"""
+        import pyarrow.compute as pc  # there is a snapshot, so pyarrow is installed
+
+        tracks = snapshot.read(
+            'tracks', columns=['idx', 'track_id', 'track_name', 'popularity', 'track_genre', 'explicit', 'tempo']
+        )
+        artists = snapshot.read('tracks_artists', columns=['track_id', 'artist_id']).join(
+            snapshot.read('artists', columns=['artist_id', 'artist']), keys='artist_id', join_type='inner'
+        )
+        artists = artists.group_by('track_id').aggregate([('artist', 'list')])  # vectorised, no Python per track
+        artists = artists.append_column('artists', pc.binary_join(artists['artist_list'], ', ')).select(
+            ['track_id', 'artists']
+        )
+
+        tracks = tracks.join(artists, keys='track_id', join_type='left outer')
+        columns = {
+            col: tracks[col].to_numpy()
+            for col in ['idx', 'track_id', 'track_name', 'popularity', 'track_genre', 'explicit', 'tempo']
+        }
+        columns['artists'] = tracks['artists'].fill_null('').to_numpy()
+
+        return columns
+
+    def refresh(self) -> bool:
+        """
+        Check whether a new catalog version has been published and reload it if so, the check itself is throttled by
+            the refresh interval
+        :return: True if the catalog has been reloaded, False otherwise
+        """
+        if time.monotonic() - self._last_check < self._refresh_interval:
+            return False
+
+        if not self._lock.acquire(blocking=False):  # another thread is already on it
+            return False
+
+        try:
+            self._last_check = time.monotonic()
+
+            if self.catalog_version() == self.version:
+                return False
+
+            self.invalidate_schema_cache()  # the tables may have been created or replaced by another process
+            self.load()
+        finally:
+            self._lock.release()
+
+        return True
+
+    def lookup(self, idx: list[int] | np.ndarray) -> pd.DataFrame:
+        """
+        Resolve the idx values into the tracks' data, unknown values are skipped, duplicates are dropped
+        :param idx: the tracks' idx values, e.g. the recommender's output
+        :return: pandas' DataFrame with track_id, track_name and artists columns, in the order of the first occurrence
+        """
+        valid, data = self._valid, self._data  # take a consistent snapshot
+
+        idx = np.asarray(idx, dtype=np.int64).ravel()
+        idx = idx[(idx >= 0) & (idx < valid.size)]
+        idx = idx[valid[idx]]
+
+        _, first = np.unique(idx, return_index=True)
+        idx = idx[np.sort(first)]
+
+        return pd.DataFrame({col: data[col][idx] for col in self._columns})
+
+    def search(self, query: str, limit: int = 10) -> pd.DataFrame:
+        """
+        Find the tracks whose name or artists contain the query, case and accent insensitive
+        :param query: the searched text
+        :param limit: maximal number of the results
+        :return: pandas' DataFrame with track_id, track_name and artists columns, the most popular tracks first
+        """
+        return self.lookup(self._search.search(query, limit=limit))
+
+    def filter(
+            self
+            , genres: list[str] = None
+            , explicit: bool = None
+            , popularity: tuple[float | None, float | None] = None
+            , tempo: tuple[float | None, float | None] = None
+    ) -> TrackFilter | None:
+        """
+        Resolve the filter into a mask over the idx, the bitmaps are combined first, the ranges are applied to the
+            result. The masks of the recently used filters are cached until the catalog is reloaded
+        :param genres: the allowed genres, any if None, the unknown ones match no track
+        :param explicit: whether to keep the explicit tracks only (True) or the clean ones only (False), both if None
+        :param popularity: (min, max) popularity, inclusive, either of them may be None
+        :param tempo: (min, max) tempo in BPM, inclusive, either of them may be None
+        :return: the resolved filter, None if it does not restrict anything
+        """
+        ranges = {col: tuple(bounds) for col, bounds in zip(self._ranges, (popularity, tempo)) if bounds is not None}
+        ranges = {col: bounds for col, bounds in ranges.items() if bounds != (None, None)}
+        if genres is None and explicit is None and not ranges:
+            return None
+
+        valid, bitmaps, numeric, version = self._valid, self._bitmaps, self._numeric, self.version  # a consistent view
+        genres = sorted(set(genres)) if genres is not None else None
+        key = (version, tuple(genres) if genres is not None else None, explicit, tuple(sorted(ranges.items())))
+
+        track_filter = self._masks.get(key)
+        if track_filter is not None:
+            return track_filter
+
+        n_bytes = (valid.size + 7) // 8
+        allowed = np.packbits(valid)
+        if genres is not None:
+            in_genres = np.zeros(n_bytes, dtype=np.uint8)
+            for genre in genres:
+                in_genres |= bitmaps.get(f'genre={genre}', 0)
+            allowed &= in_genres
+        if explicit is not None:
+            allowed &= bitmaps['explicit'] if explicit else ~bitmaps['explicit']
+
+        allowed = np.unpackbits(allowed, count=valid.size).view(bool)
+        for col, (low, high) in ranges.items():
+            if low is not None:
+                allowed &= numeric[col] >= low
+            if high is not None:
+                allowed &= numeric[col] <= high
+
+        track_filter = TrackFilter(allowed=allowed)
+        if genres is not None and len(genres) == 1 and f'genre={genres[0]}' in bitmaps:
+            track_filter = TrackFilter(
+                allowed=allowed
+                , partition=f'genre={genres[0]}@{version}'
+                , partition_mask=np.unpackbits(bitmaps[f'genre={genres[0]}'], count=valid.size).view(bool)
+            )
+
+        self._masks.set(key, track_filter)
+
+        return track_filter
+
+
+Catalog.prepare(
+    'catalog'
+    , """
+    select tr.idx, tr.track_id, tr.track_name, tr.popularity, tr.track_genre, tr.explicit, tr.tempo
+        , array_to_string(array_agg(a.artist), ', '::text) as artists
+    from tracks as tr
+    left join tracks_artists as ta on tr.track_id = ta.track_id
+    left join artists as a on ta.artist_id = a.artist_id
+    group by tr.idx, tr.track_id, tr.track_name, tr.popularity, tr.track_genre, tr.explicit, tr.tempo
+    """
+)
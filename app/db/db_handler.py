@@ -1,9 +1,19 @@
 import os
+import re
+import time
+import uuid
+import threading
+import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, exc
+from sqlalchemy import URL, create_engine, event, exc
 from sqlalchemy.sql import text
 
+try:
+    from utils.metrics import DB_QUERIES, DB_QUERY_SECONDS, ERRORS
+except ImportError:  # run as a script from the db directory (e.g. the ETL), where the app's utils are not importable
+    DB_QUERIES = DB_QUERY_SECONDS = ERRORS = None
+
 load_dotenv()
 
 
@@ -22,7 +32,13 @@ class DB:
         Check whether the given schema exists
 
     table_exists() -> bool:
-        Check whether the vien table exists
+        Check whether the vien table exists, an existing table is cached for SCHEMA_CACHE_TTL seconds
+
+    invalidate_schema_cache() -> None:
+        Drop the cached schema metadata, should be called whenever tables are created or replaced
+
+    schema_cache_stats() -> dict[str, int]:
+        Get the hit/miss counters of the schema metadata cache
 
     query_table() -> pd.DataFrame:
         Query the table and get the results as pandas' DataFrame
@@ -32,56 +48,257 @@ class DB:
 
     update_table() -> None:
         Update the table with new values
+
+    publish_catalog() -> str:
+        Mark the catalog tables as changed, so that in-memory copies reload them
+
+    catalog_version() -> str:
+        Get the currently published catalog version
+
+    ping() -> bool:
+        Check whether the DB is reachable
+
+    prepare() -> None:
+        Register a named prepared statement
+
+    fetch() -> list[tuple] | dict[str, np.ndarray]:
+        Execute a prepared statement and get the rows as tuples or the columns as NumPy arrays
+
+    The connection pool is configured by POSTGRES_POOL_SIZE, POSTGRES_MAX_OVERFLOW, POSTGRES_POOL_TIMEOUT and
+    POSTGRES_POOL_RECYCLE, the connections are checked before use, and the statements are cancelled by the server after
+    POSTGRES_STATEMENT_TIMEOUT milliseconds (0 disables it)
     """
 
     _db_user = os.environ.get('POSTGRES_USER')
     _db_passwd = os.environ.get('POSTGRES_PASSWORD')
     _db = os.environ.get('POSTGRES_DB')
-    _sql_engine = create_engine(f'postgresql://{_db_user}:{_db_passwd}@pg:5432/{_db}')
+    _db_host = os.environ.get('POSTGRES_HOST', 'pg')
+    _db_port = os.environ.get('POSTGRES_PORT', '5432')
+    _sql_engine = create_engine(
+        URL.create(
+            'postgresql+psycopg2', username=_db_user, password=_db_passwd, host=_db_host
+            , port=int(_db_port), database=_db
+        )
+        , pool_size=int(os.environ.get('POSTGRES_POOL_SIZE', 10))  # one per gunicorn thread, see GUNICORN_THREADS
+        , max_overflow=int(os.environ.get('POSTGRES_MAX_OVERFLOW', 5))
+        , pool_timeout=float(os.environ.get('POSTGRES_POOL_TIMEOUT', 10))
+        , pool_recycle=int(os.environ.get('POSTGRES_POOL_RECYCLE', 1800))
+        , pool_pre_ping=True  # a connection dropped by the server is replaced instead of failing the request
+        , connect_args={'options': f"-c statement_timeout={int(os.environ.get('POSTGRES_STATEMENT_TIMEOUT', 30000))}"}
+    )
+    # name -> (statement with the $n placeholders, names of the parameters in their order)
+    _statements: dict[str, tuple[str, list[str]]] = {}
+    _catalog_version_path = os.path.join(os.path.dirname(__file__), 'catalog.version')
+
+    # the containers are mutated in place, so that the subclasses share the very same cache
+    _schema_cache: dict[tuple[str, str], tuple[bool, float]] = {}
+    _schema_cache_counters = {'hits': 0, 'misses': 0}
+    _schema_cache_lock = threading.Lock()
+    _schema_cache_ttl = float(os.environ.get('SCHEMA_CACHE_TTL', 300))
 
     @classmethod
-    def db_exists(cls, table_schema: str = 'public') -> bool:
-        """Check whether given table schema exists, return boolean"""
-        query = f"""
-            select exists(
-                select 1
-                from information_schema.tables
-                where table_schema = '{table_schema}'
-            )
+    def publish_catalog(cls) -> str:
+        """
+        Publish a new catalog version, should be called whenever the catalog tables are replaced
+        :return: the new version token
         """
+        version = uuid.uuid4().hex
+        tmp_path = f'{cls._catalog_version_path}.tmp'
+
+        with open(tmp_path, 'w') as f:
+            f.write(version)
+
+        os.replace(tmp_path, cls._catalog_version_path)  # atomic swap, readers never see a partial file
+
+        return version
 
+    @classmethod
+    def catalog_version(cls) -> str:
+        """Get the currently published catalog version, empty string if nothing was published yet"""
+        try:
+            with open(cls._catalog_version_path) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return ''
+
+    @classmethod
+    def ping(cls) -> bool:
+        """Check whether the DB is reachable and answers a trivial query, return boolean"""
         try:
             with cls._sql_engine.connect() as conn:
-                result = bool(conn.execute(text(query)).fetchone()[0])
+                conn.execute(text('select 1'))
 
-                return result
+            return True
         except exc.OperationalError as e:
             print(f'Trouble connecting to the database, {e}')
 
         return False
 
     @classmethod
-    def table_exists(cls, table_name: str) -> bool:
-        """Check whether given table exists in the public schema, return boolean"""
-        if len(table_name.split(' ')) > 1:  # if table name has aliases
-            table_name = table_name.split(' ')[0]  # extract the table name
+    def prepare(cls, name: str, query: str) -> None:
+        """
+        Register a named prepared statement, it is prepared on every pooled connection on its first use, so Postgres
+            parses and plans it once per connection instead of once per call
+        :param name: name of the statement, a valid SQL identifier
+        :param query: the statement's SQL with the :name placeholders for the parameters
+        :return: void function
+        """
+        placeholder = re.compile(r'(?<![:\w]):(\w+)')  # skips the ::type casts
+        names = list(dict.fromkeys(placeholder.findall(query)))
 
-        query = f"""
-            select exists(
-                select 1
-                from information_schema.tables
-                where table_schema = 'public'
-                    and table_name = '{table_name}'
-            )
+        cls._statements[name] = (placeholder.sub(lambda m: f'${names.index(m.group(1)) + 1}', query), names)
+
+    @staticmethod
+    def _column(values: tuple, type_code: int) -> np.ndarray:
+        """Convert the column's values into an array, the Postgres' bools, ints and floats get a native dtype"""
+        dtype = {16: bool, 20: np.int64, 21: np.int16, 23: np.int32, 700: np.float32, 701: np.float64}.get(type_code)
+
+        if dtype is not None:
+            try:
+                return np.array(values, dtype=dtype)
+            except TypeError:  # NULLs
+                if dtype is not bool:
+                    return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+
+        return np.array(values, dtype=object)
+
+    @classmethod
+    def fetch(
+            cls
+            , name: str
+            , params: dict[str, ] = None
+            , output: str = 'tuples'
+    ) -> list[tuple] | dict[str, np.ndarray]:
         """
+        Execute a prepared statement registered by prepare(), with the parameters bound by the server
+        :param name: name of the statement
+        :param params: the statement's parameters by their names
+        :param output: 'tuples' for a list of row tuples, 'numpy' for column name -> array of the column's values
+        :return: the rows or the columns, empty if the DB could not be reached
+        """
+        if output not in ('tuples', 'numpy'):
+            raise ValueError(f"output should be either 'tuples' or 'numpy', you provided {output}")
+
+        statement, names = cls._statements[name]
+        args = tuple((params or {})[param] for param in names)
 
         try:
             with cls._sql_engine.connect() as conn:
-                result = bool(conn.execute(text(query)).fetchone()[0])
-
-                return result
+                prepared = conn.connection.info.setdefault('prepared', set())  # lives as long as the DBAPI connection
+
+                for attempt in range(2):
+                    if name not in prepared:
+                        conn.execution_options(no_parameters=True).exec_driver_sql(f'prepare {name} as {statement}')
+                        prepared.add(name)
+
+                    try:
+                        result = conn.exec_driver_sql(
+                            f"execute {name}({', '.join(['%s'] * len(args))})" if args else f'execute {name}', args
+                        )
+                        break
+                    except exc.OperationalError:
+                        raise
+                    except exc.DBAPIError:  # e.g. the tables were replaced and the plan's result type has changed
+                        if attempt:
+                            raise
+
+                        conn.rollback()
+                        conn.exec_driver_sql(f'deallocate {name}')
+                        prepared.discard(name)
+
+                description = result.cursor.description
+                rows = result.fetchall()
         except exc.OperationalError as e:
             print(f'Trouble connecting to the database, {e}')
+            return [] if output == 'tuples' else {}
+
+        if output == 'tuples':
+            return [tuple(row) for row in rows]
+
+        columns = list(zip(*rows)) if rows else [()] * len(description)
+
+        return {column.name: cls._column(values, column.type_code) for column, values in zip(description, columns)}
+
+    @classmethod
+    def _cached_schema_lookup(cls, key: tuple[str, str]) -> bool | None:
+        """Get the cached result of a schema lookup, None if it is missing or expired"""
+        with cls._schema_cache_lock:
+            cached = cls._schema_cache.get(key)
+
+            if cached is not None and time.monotonic() - cached[1] < cls._schema_cache_ttl:
+                cls._schema_cache_counters['hits'] += 1
+                return cached[0]
+
+            cls._schema_cache_counters['misses'] += 1
+
+        return None
+
+    @classmethod
+    def _cache_schema_lookup(cls, key: tuple[str, str], result: bool) -> None:
+        """
+        Store the result of a schema lookup, the missing ones are not stored, they may be created by another process any
+            time, which only invalidates its own cache
+        """
+        if not result:
+            return
+
+        with cls._schema_cache_lock:
+            cls._schema_cache[key] = (result, time.monotonic())
+
+    @classmethod
+    def invalidate_schema_cache(cls, table_name: str = None) -> None:
+        """
+        Drop the cached schema metadata
+        :param table_name: a table to drop from the cache, the whole cache is dropped if None
+        :return: void function
+        """
+        with cls._schema_cache_lock:
+            if table_name is None:
+                cls._schema_cache.clear()
+            else:
+                cls._schema_cache.pop(('table', table_name.split(' ')[0]), None)
+
+                for key in [key for key in cls._schema_cache if key[0] == 'schema']:  # may depend on the table
+                    del cls._schema_cache[key]
+
+    @classmethod
+    def schema_cache_stats(cls) -> dict[str, int]:
+        """Get the hit/miss counters and the current size of the schema metadata cache"""
+        with cls._schema_cache_lock:
+            return {**cls._schema_cache_counters, 'size': len(cls._schema_cache)}
+
+    @classmethod
+    def db_exists(cls, table_schema: str = 'public') -> bool:
+        """Check whether given table schema exists, return boolean"""
+        key = ('schema', table_schema)
+        cached = cls._cached_schema_lookup(key)
+        if cached is not None:
+            return cached
+
+        rows = cls.fetch('schema_exists', params={'table_schema': table_schema})
+        if rows:
+            cls._cache_schema_lookup(key, bool(rows[0][0]))
+
+            return bool(rows[0][0])
+
+        return False
+
+    @classmethod
+    def table_exists(cls, table_name: str) -> bool:
+        """Check whether given table exists in the public schema, return boolean"""
+        if len(table_name.split(' ')) > 1:  # if table name has aliases
+            table_name = table_name.split(' ')[0]  # extract the table name
+
+        key = ('table', table_name)
+        cached = cls._cached_schema_lookup(key)
+        if cached is not None:
+            return cached
+
+        rows = cls.fetch('table_exists', params={'table_name': table_name})
+        if rows:
+            cls._cache_schema_lookup(key, bool(rows[0][0]))
+
+            return bool(rows[0][0])
 
         return False
 
@@ -111,13 +328,13 @@ class DB:
                     if len(val) == 1:
                         conditions.append(f"{col} = %({col})s")
                         params[col] = val[0]
-                    elif len(val) > 1:
-                        conditions.append(f"{col} in %({col}_tuple)s")
-                        params[f"{col}_tuple"] = tuple(val)
+                    elif len(val) > 1:  # bound as one array, so the query text does not depend on the number of values
+                        conditions.append(f"{col} = any(%({col}_list)s)")
+                        params[f"{col}_list"] = list(val)
                 elif val is None:
                     conditions.append(f"{col} is null")
 
-        where = 'where ' + 'and '.join(conditions) if conditions else ''
+        where = 'where ' + ' and '.join(conditions) if conditions else ''
 
         return where, params
 
@@ -180,8 +397,10 @@ class DB:
             {where}
             {group}
             {sort}
-            {'limit ' + str(limit) if limit else ''}
+            {'limit %(_limit)s' if limit else ''}
         """
+        if limit:
+            params['_limit'] = int(limit)
 
         try:
             with cls._sql_engine.connect() as conn:
@@ -285,7 +504,37 @@ class DB:
             print(f'Trouble connecting to the database, {e}')
 
 
+if DB_QUERIES is not None:  # count and time every DB round trip and error, whichever class issued them
+    @event.listens_for(DB._sql_engine, 'before_cursor_execute')
+    def _start_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(DB._sql_engine, 'after_cursor_execute')
+    def _stop_timer(conn, cursor, statement, parameters, context, executemany):
+        DB_QUERY_SECONDS.observe(time.perf_counter() - conn.info['query_start'].pop())
+        DB_QUERIES.inc(statement=statement.lstrip().split(None, 1)[0].lower() if statement.strip() else 'unknown')
+
+    @event.listens_for(DB._sql_engine, 'handle_error')
+    def _count_error(context):
+        starts = context.connection.info.get('query_start') if context.connection is not None else None
+        if starts:
+            starts.pop()  # the failed statement never reaches after_cursor_execute
+        ERRORS.inc(component='db', error=type(context.original_exception).__name__)
+
+
+DB.prepare(
+    'schema_exists'
+    , 'select exists(select 1 from information_schema.tables where table_schema = :table_schema)'
+)
+DB.prepare(
+    'table_exists'
+    , "select exists(select 1 from information_schema.tables where table_schema = 'public' and table_name = :table_name)"
+)
+
+# the pooled connections must not be shared with a forked child (e.g. a gunicorn worker), it opens its own ones
+os.register_at_fork(after_in_child=lambda: DB._sql_engine.dispose(close=False))
+
+
 if __name__ == '__main__':
     db_handler = DB()
 
-
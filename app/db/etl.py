@@ -1,12 +1,51 @@
+import io
 import os
+import json
 import pandas as pd
+from dataclasses import dataclass, field, asdict
 from dotenv import load_dotenv
 from sqlalchemy import exc
 from db_handler import DB
+from snapshot import Snapshot
 
 load_dotenv()
 
 
+@dataclass
+class Changeset:
+    """
+    The result of an incremental ingest, saved as JSON for the downstream steps
+    ...
+
+    Attributes
+    ----------
+    :param version: the catalog version published by the ingest
+    :param inserted: track ids of the new tracks
+    :param updated: track ids of the tracks whose attributes or artists have changed
+    :param unchanged: number of the incoming tracks that were already up-to-date
+    :param albums: names of the new albums
+    :param artists: names of the new artists
+    :param duplicates: number of the duplicated rows dropped per table before its unique index was created
+    """
+    version: str = ''
+    inserted: list[str] = field(default_factory=list)
+    updated: list[str] = field(default_factory=list)
+    unchanged: int = 0
+    albums: list[str] = field(default_factory=list)
+    artists: list[str] = field(default_factory=list)
+    duplicates: dict[str, int] = field(default_factory=dict)
+
+    def save(self, directory: str) -> str:
+        """Save the changeset as <directory>/<version>.json, return the path"""
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{self.version}.json')
+
+        with open(path, 'w') as f:
+            json.dump(asdict(self), f)
+
+        return path
+
+
 class ExtractTransformLoad(DB):
     """
     A class that handles the ETL process for the given dataset, extends the parent DB class, inherits all public methods
@@ -21,8 +60,24 @@ class ExtractTransformLoad(DB):
     populate_database() -> None:
         Extracts the dataset from the given source, cleans and normalises it across 4 tables,
         then uploads it into the DB.
+    populate_database_streaming(chunksize: int = 50_000) -> None:
+        The same as populate_database(), but reads the source in chunks and bulk loads them with COPY, so that the
+        memory usage does not depend on the size of the dataset.
+    upsert_database(source: str = None) -> Changeset:
+        Ingests a delta of the dataset into the existing tables without replacing them, returns what has changed.
+    export_snapshot(chunksize: int = 100_000) -> Snapshot | None:
+        Exports the tables into a columnar snapshot of the current catalog version, see db/snapshot.py.
     """
-    _source_url = 'hf://datasets/maharshipandya/spotify-tracks-dataset/dataset.csv'
+    _source_url = os.environ.get('ETL_SOURCE', 'hf://datasets/maharshipandya/spotify-tracks-dataset/dataset.csv')
+    _changesets_path = os.path.join(os.path.dirname(__file__), 'changesets')
+
+    # unique indexes the incremental ingest relies on for ON CONFLICT, index name: (table, columns)
+    _unique_keys = {
+        'tracks_track_id_key': ('tracks', ['track_id'])
+        , 'albums_album_key': ('albums', ['album'])
+        , 'artists_artist_key': ('artists', ['artist'])
+        , 'tracks_artists_key': ('tracks_artists', ['track_id', 'artist_id'])
+    }
 
     def __init__(self):
         self._df = pd.DataFrame()
@@ -31,6 +86,12 @@ class ExtractTransformLoad(DB):
         self._artists = pd.DataFrame()
         self._tracks_artists = pd.DataFrame()
 
+        # surrogate keys assigned so far and the next free ones, used by the streaming and the incremental modes
+        self._seen_tracks = set()
+        self._album_ids = {}
+        self._artist_ids = {}
+        self._next_keys = {'idx': 0, 'album_id': 1, 'artist_id': 1}
+
     def _fetch_data(self):
         """Fetch the data from the specified source"""
         self._df = pd.read_csv(self.__class__._source_url)
@@ -47,7 +108,7 @@ class ExtractTransformLoad(DB):
 
         df = (
             df
-            .drop(columns=['Unnamed: 0'])
+            .drop(columns=['Unnamed: 0'], errors='ignore')
             .dropna()
             .drop_duplicates(subset='track_id', keep='first', inplace=False)
             .reset_index(drop=True)  # reset the old index
@@ -106,10 +167,293 @@ class ExtractTransformLoad(DB):
         self._artists = artists
         self._tracks_artists = tracks_artists
 
+    def _take_keys(self, key: str, n: int) -> range:
+        """Reserve the next n values of the given surrogate key"""
+        start = self._next_keys[key]
+        self._next_keys[key] += n
+
+        return range(start, start + n)
+
+    def _normalise_chunk(self, chunk: pd.DataFrame) -> dict[str, pd.DataFrame]:
+        """
+        Normalises a chunk of the source the same way as _normalise_tables() does, the idx values and the album/artist
+            surrogate keys continue where the previous chunk stopped, the tracks seen in the previous chunks are skipped
+        :param chunk: a chunk of the raw source
+        :return: the new rows for each of the tables
+        """
+        df = self._preprocess_data(chunk)
+        df = df[~df['track_id'].isin(self._seen_tracks)].copy()
+        df['idx'] = self._take_keys('idx', len(df))
+        self._seen_tracks.update(df['track_id'])
+
+        album_names = df['album_name'].drop_duplicates()
+        album_names = album_names[album_names.map(self._album_ids).isna()]
+        albums = pd.DataFrame({
+            'album_id': pd.Series(self._take_keys('album_id', len(album_names)), dtype='Int64')
+            , 'album': album_names.to_numpy()
+        })
+        self._album_ids.update(zip(albums['album'], albums['album_id']))
+
+        tracks_artists = (
+            df[['track_id', 'artists']]
+            .assign(artist=df['artists'].str.split(';'))
+            .explode('artist')
+        )
+
+        artist_names = tracks_artists['artist'].drop_duplicates()
+        artist_names = artist_names[artist_names.map(self._artist_ids).isna()]
+        artists = pd.DataFrame({
+            'artist_id': pd.Series(self._take_keys('artist_id', len(artist_names)), dtype='Int64')
+            , 'artist': artist_names.to_numpy()
+        })
+        self._artist_ids.update(zip(artists['artist'], artists['artist_id']))
+
+        tracks_artists = tracks_artists.assign(
+            artist_id=tracks_artists['artist'].map(self._artist_ids).astype('Int64')
+        )[['track_id', 'artist_id']]
+
+        tracks = (
+            df
+            .assign(album_id=df['album_name'].map(self._album_ids).astype('Int64'))
+            .drop(['artists', 'album_name'], axis=1)
+        )
+
+        return {'tracks': tracks, 'albums': albums, 'artists': artists, 'tracks_artists': tracks_artists}
+
+    @staticmethod
+    def _copy_dataframe(cursor, table_name: str, dataframe: pd.DataFrame) -> None:
+        """
+        Bulk load the DataFrame into the table with COPY FROM STDIN, way faster than the row by row inserts
+        :param cursor: a raw psycopg2 cursor
+        :param table_name: the target table, must already exist
+        :param dataframe: the rows to load, the columns must match the table's ones
+        :return: void function
+        """
+        buffer = io.StringIO()
+        dataframe.to_csv(buffer, index=False, header=False)  # missing values are written as empty, i.e. nulls
+        buffer.seek(0)
+
+        columns = ', '.join(f'"{column}"' for column in dataframe.columns)
+        cursor.copy_expert(f'copy {table_name} ({columns}) from stdin with (format csv)', buffer)
+
+    def populate_database_streaming(self, chunksize: int = 50_000) -> None:
+        """
+        Insert the normalised tables into the database chunk by chunk:
+            public.tracks, public.albums, public.artists, public.tracks_artists
+        the tables are replaced within a single transaction, then a new catalog version is published
+        :param chunksize: number of source rows to process at once
+        :return: void function
+        """
+        self._seen_tracks, self._album_ids, self._artist_ids = set(), {}, {}
+        self._next_keys = {'idx': 0, 'album_id': 1, 'artist_id': 1}
+        engine = self.__class__._sql_engine
+
+        try:
+            with engine.begin() as conn:
+                cursor = conn.connection.cursor()  # the raw cursor shares the transaction with conn
+                cursor.execute('set local statement_timeout = 0')  # the bulk load may run longer than the API's queries
+
+                for i, chunk in enumerate(pd.read_csv(self.__class__._source_url, chunksize=chunksize)):
+                    tables = self._normalise_chunk(chunk)
+
+                    for table_name, dataframe in tables.items():
+                        if i == 0:  # create the tables with the types inferred from the first chunk
+                            dataframe.head(0).to_sql(
+                                name=table_name
+                                , if_exists='replace'
+                                , con=conn
+                                , index=False
+                            )
+
+                        self._copy_dataframe(cursor, table_name=table_name, dataframe=dataframe)
+        except exc.OperationalError as e:
+            print(f'Trouble connecting to the database, {e}')
+        else:
+            self.publish_catalog()
+        finally:
+            self.invalidate_schema_cache()
+
+    @classmethod
+    def _ensure_unique_keys(cls, cursor) -> dict[str, int]:
+        """
+        Create the unique indexes the ON CONFLICT clauses need, the duplicated links of tracks_artists are dropped,
+            the other tables' duplicated keys raise ValueError
+        :param cursor: a raw psycopg2 cursor
+        :return: number of the dropped duplicates per table
+        """
+        cursor.execute('select indexname from pg_indexes where schemaname = %(schema)s', {'schema': 'public'})
+        existing = {row[0] for row in cursor.fetchall()}
+
+        dropped = {}
+        for index_name, (table_name, columns) in cls._unique_keys.items():
+            if index_name in existing:
+                continue
+
+            cursor.execute(f"select count(*) - count(distinct ({', '.join(columns)})) from {table_name}")
+            n_duplicates = cursor.fetchone()[0]
+
+            if n_duplicates and table_name != 'tracks_artists':
+                raise ValueError(
+                    f"{table_name} has {n_duplicates} rows with a duplicated {', '.join(columns)}, "
+                    f"please resolve them before the incremental ingest"
+                )
+
+            if n_duplicates:
+                print(f'Dropping {n_duplicates} duplicated rows of {table_name}')
+                keys = ' and '.join(f'a.{column} = b.{column}' for column in columns)
+                cursor.execute(f'delete from {table_name} a using {table_name} b where a.ctid < b.ctid and {keys}')
+                dropped[table_name] = n_duplicates
+
+            cursor.execute(f"create unique index {index_name} on {table_name} ({', '.join(columns)})")
+
+        return dropped
+
+    def _upsert_dataframe(
+            self
+            , cursor
+            , table_name: str
+            , dataframe: pd.DataFrame
+            , keys: list[str]
+            , update: bool = False
+    ) -> list[tuple]:
+        """
+        Upsert the DataFrame into the table through a COPY-loaded staging table
+        :param cursor: a raw psycopg2 cursor
+        :param table_name: the target table
+        :param dataframe: the rows to upsert, the columns must match the table's ones
+        :param keys: the conflict target, must be covered by a unique index
+        :param update: whether to update the conflicting rows whose values differ, or to leave them as they are
+        :return: (*keys, inserted) tuples of the inserted or updated rows, inserted is False for the updated ones
+        """
+        staging = f'{table_name}_staging'
+        cursor.execute(f'create temp table {staging} (like {table_name}) on commit drop')
+        self._copy_dataframe(cursor, table_name=staging, dataframe=dataframe)
+
+        columns = [f'"{column}"' for column in dataframe.columns]
+        values = [column for column in columns if column.strip('"') not in keys + ['idx']]
+
+        if update and values:
+            conflict = f"""
+                do update set {', '.join(f'{column} = excluded.{column}' for column in values)}
+                where ({', '.join(f'{table_name}.{column}' for column in values)})
+                    is distinct from ({', '.join(f'excluded.{column}' for column in values)})
+            """
+        else:
+            conflict = 'do nothing'
+
+        cursor.execute(f"""
+            insert into {table_name} ({', '.join(columns)})
+            select {', '.join(columns)}
+            from {staging}
+            on conflict ({', '.join(keys)}) {conflict}
+            returning {', '.join(keys)}, (xmax = 0) as inserted
+        """)
+
+        return cursor.fetchall()
+
+    def _seed_keys(self, cursor, df: pd.DataFrame) -> dict[str, int]:
+        """
+        Load the existing surrogate keys relevant for the incoming rows, and the next free ones
+        :param cursor: a raw psycopg2 cursor
+        :param df: the preprocessed incoming rows
+        :return: idx values of the incoming tracks that already exist
+        """
+        artists = df['artists'].str.split(';').explode().drop_duplicates().tolist()
+        lookups = {
+            'track_id': ('select track_id, idx from tracks where track_id = any(%(keys)s)', df['track_id'].tolist())
+            , 'album': ('select album, album_id from albums where album = any(%(keys)s)', df['album_name'].tolist())
+            , 'artist': ('select artist, artist_id from artists where artist = any(%(keys)s)', artists)
+        }
+
+        existing = {}
+        for name, (query, keys) in lookups.items():
+            cursor.execute(query, {'keys': keys})
+            existing[name] = dict(cursor.fetchall())
+
+        cursor.execute("""
+            select
+                (select coalesce(max(idx), -1) + 1 from tracks)
+                , (select coalesce(max(album_id), 0) + 1 from albums)
+                , (select coalesce(max(artist_id), 0) + 1 from artists)
+        """)
+        next_idx, next_album_id, next_artist_id = cursor.fetchone()
+
+        self._seen_tracks = set()
+        self._album_ids, self._artist_ids = existing['album'], existing['artist']
+        self._next_keys = {'idx': next_idx, 'album_id': next_album_id, 'artist_id': next_artist_id}
+
+        return existing['track_id']
+
+    def upsert_database(self, source: str = None) -> Changeset:
+        """
+        Ingest new and changed tracks into the existing tables with INSERT ... ON CONFLICT, publish a new catalog
+            version and save the changeset into db/changesets, unless nothing has changed
+        :param source: the path or URL of the delta in the same format as the full dataset, the full dataset if None
+        :return: the changeset, empty if the DB could not be reached
+        """
+        raw = pd.read_csv(source or self.__class__._source_url)
+        changeset = Changeset()
+        engine = self.__class__._sql_engine
+
+        try:
+            with engine.begin() as conn:
+                cursor = conn.connection.cursor()  # the raw cursor shares the transaction with conn
+                cursor.execute('set local statement_timeout = 0')  # the bulk load may run longer than the API's queries
+                changeset.duplicates = self._ensure_unique_keys(cursor)
+
+                existing_idx = self._seed_keys(cursor, self._preprocess_data(raw))
+                tables = self._normalise_chunk(raw)
+
+                # the existing tracks keep their idx, only the new ones take the next free values
+                tracks = tables['tracks']
+                known = tracks['track_id'].map(existing_idx)
+                self._next_keys['idx'] -= len(tracks)
+                tracks['idx'] = known.fillna(-1).astype('int64')
+                tracks.loc[known.isna(), 'idx'] = self._take_keys('idx', int(known.isna().sum()))
+
+                self._upsert_dataframe(cursor, 'albums', tables['albums'], keys=['album'])
+                self._upsert_dataframe(cursor, 'artists', tables['artists'], keys=['artist'])
+                changed = self._upsert_dataframe(cursor, 'tracks', tracks, keys=['track_id'], update=True)
+
+                links = tables['tracks_artists'].drop_duplicates()
+                linked = self._upsert_dataframe(cursor, 'tracks_artists', links, keys=['track_id', 'artist_id'])
+                cursor.execute("""
+                    delete from tracks_artists ta
+                    where ta.track_id = any(%(track_ids)s)
+                        and not exists (
+                            select 1
+                            from tracks_artists_staging s
+                            where s.track_id = ta.track_id
+                                and s.artist_id = ta.artist_id
+                        )
+                    returning ta.track_id
+                """, {'track_ids': tracks['track_id'].tolist()})
+                unlinked = cursor.fetchall()
+
+                changeset.inserted = [track_id for track_id, inserted in changed if inserted]
+                changeset.updated = [track_id for track_id, inserted in changed if not inserted]
+                # the tracks whose only change is in their artists are updated as well
+                relinked = {row[0] for row in linked + unlinked} - set(changeset.inserted) - set(changeset.updated)
+                changeset.updated += sorted(relinked)
+                changeset.unchanged = len(tracks) - len(changeset.inserted) - len(changeset.updated)
+                changeset.albums = tables['albums']['album'].tolist()
+                changeset.artists = tables['artists']['artist'].tolist()
+        except exc.OperationalError as e:
+            print(f'Trouble connecting to the database, {e}')
+        else:
+            if changeset.inserted or changeset.updated:
+                changeset.version = self.publish_catalog()
+                changeset.save(self.__class__._changesets_path)
+        finally:
+            self.invalidate_schema_cache()
+
+        return changeset
+
     def populate_database(self) -> None:
         """
         Insert the normalised tables into the database:
             public.tracks, public.albums, public.artists, public.tracks_artists
+        and publish a new catalog version
         :return: void function
         """
         self._normalise_tables()
@@ -123,7 +467,8 @@ class ExtractTransformLoad(DB):
         }
 
         try:
-            with engine.connect() as conn:
+            with engine.begin() as conn:  # committed as the block exits, the catalog is only published after that
+                conn.exec_driver_sql('set local statement_timeout = 0')  # the bulk load may outlast the API's queries
                 for table_name, dataframe in table_mappings.items():
                     dataframe.to_sql(
                         name=table_name
@@ -133,11 +478,50 @@ class ExtractTransformLoad(DB):
                     )
         except exc.OperationalError as e:
             print(f'Trouble connecting to the database, {e}')
+        else:
+            self.publish_catalog()
+        finally:
+            self.invalidate_schema_cache()
+
+    def export_snapshot(self, chunksize: int = 100_000) -> Snapshot | None:
+        """
+        Export the catalog tables, and the recommender's training data if there is any, into a columnar snapshot of the
+            current catalog version
+        :param chunksize: number of rows per part
+        :return: the published snapshot, None if pyarrow is not installed or the DB could not be reached
+        """
+        if not Snapshot.available():
+            return None
+
+        version = self.catalog_version()
+        tables = [
+            table for table in ('tracks', 'albums', 'artists', 'tracks_artists', 'pr_comps') if self.table_exists(table)
+        ]
+
+        try:
+            with self.__class__._sql_engine.connect().execution_options(stream_results=True) as conn:
+                return Snapshot.publish(
+                    {table: pd.read_sql(f'select * from {table}', con=conn, chunksize=chunksize) for table in tables}
+                    , catalog_version=version
+                    , formats={'pr_comps': 'arrow'}  # read as a whole into the feature matrix
+                )
+        except exc.OperationalError as e:
+            print(f'Trouble connecting to the database, {e}')
+
+        return None
 
 
 if __name__ == '__main__':
     etl = ExtractTransformLoad()
 
-    # run this script as a part of container initialisation
-    if not etl.db_exists():
-        etl.populate_database()
+    # run this script as a part of container initialisation, or to ingest a delta into an existing database
+    if os.environ.get('ETL_MODE') == 'incremental' and etl.db_exists():
+        etl.upsert_database(source=os.environ.get('ETL_SOURCE'))
+    elif not etl.db_exists():
+        if os.environ.get('ETL_MODE', 'full') == 'streaming':
+            etl.populate_database_streaming(chunksize=int(os.environ.get('ETL_CHUNKSIZE', 50_000)))
+        else:
+            etl.populate_database()
+
+    if Snapshot.current(catalog_version=etl.catalog_version()) is None:  # missing or older than the catalog
+        etl.export_snapshot()
@@ -0,0 +1,91 @@
+import unicodedata
+from collections import defaultdict
+import numpy as np
+
+
+def normalise(text: str) -> str:
+    """Lower-case the text, strip the accents and collapse the whitespace, so that 'Beyoncé' is found by 'beyonce'"""
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+
+    return ' '.join(text.casefold().split())
+
+
+class SearchIndex:
+    """
+    An in-memory trigram index over the track names and the artists, the documents are ranked by the popularity
+    ...
+
+    Attributes
+    ----------
+    :param idx: the tracks' idx values
+    :param names: the track names
+    :param artists: the artists, as a single string per track
+    :param popularity: the tracks' popularity, the matches are ranked by it
+
+    Methods
+    -------
+    search(query: str, limit: int = 10) -> np.ndarray:
+        Find the most popular tracks whose name or artists contain the query
+    """
+    _gram_size = 3
+
+    def __init__(self, idx: np.ndarray, names: np.ndarray, artists: np.ndarray, popularity: np.ndarray):
+        order = np.argsort(-np.asarray(popularity, dtype=np.float64), kind='stable')
+
+        self._idx = np.asarray(idx, dtype=np.int64)[order]
+        # the separator never appears in a normalised query, so no match spans both fields
+        self._texts = [f'{normalise(str(names[i]))}\n{normalise(str(artists[i]))}' for i in order]
+
+        postings = defaultdict(list)
+        for doc, text in enumerate(self._texts):
+            for gram in self._grams(text):
+                postings[gram].append(doc)
+
+        self._postings = {gram: np.array(docs, dtype=np.int32) for gram, docs in postings.items()}
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+    @classmethod
+    def _grams(cls, text: str) -> set[str]:
+        return {text[i:i + cls._gram_size] for i in range(len(text) - cls._gram_size + 1)}
+
+    def _candidates(self, query: str) -> np.ndarray | range:
+        """Get the documents that contain all the query's trigrams, in the rank order"""
+        if len(query) < self._gram_size:  # too short to use the index, scan in the rank order instead
+            return range(len(self._texts))
+
+        postings = []
+        for gram in self._grams(query):
+            if gram not in self._postings:
+                return np.empty(0, dtype=np.int32)
+            postings.append(self._postings[gram])
+
+        postings.sort(key=len)
+        candidates = postings[0]
+        for docs in postings[1:]:
+            if len(candidates) <= 64:  # cheaper to verify the rest than to intersect the long postings
+                break
+            candidates = np.intersect1d(candidates, docs, assume_unique=True)
+
+        return candidates
+
+    def search(self, query: str, limit: int = 10) -> np.ndarray:
+        """
+        Find the tracks whose name or artists contain the query, case and accent insensitive
+        :param query: the searched text
+        :param limit: maximal number of the matches
+        :return: the matching tracks' idx values, the most popular first
+        """
+        query = normalise(query)
+        texts = self._texts
+
+        matches = []
+        for doc in self._candidates(query):
+            if query in texts[doc]:
+                matches.append(doc)
+                if len(matches) == limit:
+                    break
+
+        return self._idx[np.asarray(matches, dtype=np.int64)]
@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import uuid
+import shutil
+from typing import Iterable
+import pandas as pd
+
+try:  # optional, without it everything is read from Postgres
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+class Snapshot:
+    """
+    A versioned columnar copy of the DB tables, only valid for the catalog version it was exported at
+    ...
+
+    Layout
+    ------
+    <root>/CURRENT                                  the name of the published version
+    <root>/<version>/manifest.json                  format version, catalog version, the tables' formats, parts, rows
+                                                    and columns
+    <root>/<version>/<table>/part-00000.parquet     the normalised tables, compressed, one part per exported chunk
+    <root>/<version>/<table>/part-00000.arrow       the features, uncompressed Arrow IPC, memory-mapped when read
+
+    Attributes
+    ----------
+    :param version: the snapshot's version
+    :param manifest: the snapshot's manifest
+    :param path: the snapshot's directory
+
+    Methods
+    -------
+    available() -> bool:
+        Check whether pyarrow is installed
+    current(root: str = None, catalog_version: str = None) -> Snapshot | None:
+        Get the published snapshot, if it matches the catalog version
+    publish(tables: dict[str, pd.DataFrame | Iterable[pd.DataFrame]], catalog_version: str, ...) -> Snapshot:
+        Write the tables as a new snapshot and publish it
+    has(*tables: str) -> bool:
+        Check whether the snapshot contains all the tables
+    schema(table: str) -> pa.Schema:
+        Get the table's columns and their types
+    numeric_columns(table: str) -> list[str]:
+        Get the table's integer and floating point columns
+    read(table: str, columns: list[str] = None, filters: dict[str, list] = None) -> pa.Table:
+        Read the table as an Arrow table
+    read_pandas(table: str, columns: list[str] = None, filters: dict[str, list] = None) -> pd.DataFrame:
+        Read the table as pandas' DataFrame
+    """
+    format_version = 1
+    default_root = os.environ.get('SNAPSHOT_PATH', os.path.join(os.path.dirname(__file__), 'snapshots'))
+    _extensions = {'parquet': 'parquet', 'arrow': 'arrow'}
+
+    def __init__(self, version: str, manifest: dict, path: str):
+        self.version = version
+        self.manifest = manifest
+        self.path = path
+
+    @staticmethod
+    def available() -> bool:
+        return pa is not None
+
+    @classmethod
+    def current(cls, root: str = None, catalog_version: str = None) -> 'Snapshot | None':
+        """
+        Get the currently published snapshot
+        :param root: the snapshots' directory, SNAPSHOT_PATH or db/snapshots by default
+        :param catalog_version: the catalog version the snapshot has to match, any if None
+        :return: the snapshot, None if there is none, it is stale or pyarrow is not installed
+        """
+        root = root or cls.default_root
+        if pa is None:
+            return None
+
+        try:
+            with open(os.path.join(root, 'CURRENT')) as f:
+                version = f.read().strip()
+            with open(os.path.join(root, version, 'manifest.json')) as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+        if manifest['format_version'] != cls.format_version:
+            return None
+        if catalog_version is not None and manifest['catalog_version'] != catalog_version:
+            return None
+
+        return cls(version=version, manifest=manifest, path=os.path.join(root, version))
+
+    @classmethod
+    def _write_table(cls, path: str, chunks: Iterable[pd.DataFrame], file_format: str) -> dict:
+        """Write the chunks as the table's parts, all of them with the first chunk's schema, describe the table"""
+        os.makedirs(path)
+        schema, parts, rows = None, [], 0
+
+        for i, chunk in enumerate(chunks):
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if schema is None:
+                schema = table.schema.remove_metadata()
+            table = table.cast(schema)
+
+            name = f'part-{i:05d}.{cls._extensions[file_format]}'
+            if file_format == 'arrow':
+                with pa.OSFile(os.path.join(path, name), 'wb') as sink, pa.ipc.new_file(sink, schema) as writer:
+                    writer.write_table(table)
+            else:
+                pq.write_table(table, os.path.join(path, name), compression='zstd')
+
+            parts.append(name)
+            rows += table.num_rows
+
+        return {
+            'format': file_format
+            , 'parts': parts
+            , 'rows': rows
+            , 'columns': {field.name: str(field.type) for field in schema} if schema is not None else {}
+        }
+
+    @classmethod
+    def publish(
+            cls
+            , tables: dict[str, pd.DataFrame | Iterable[pd.DataFrame]]
+            , catalog_version: str
+            , formats: dict[str, str] = None
+            , carry_over: str = None
+            , root: str = None
+            , keep: int = 2
+    ) -> 'Snapshot':
+        """
+        Write the tables as a new snapshot and publish it as the current one
+        :param tables: table name -> its data, either a DataFrame or an iterable of DataFrames, one part per chunk
+        :param catalog_version: the catalog version the data belongs to
+        :param formats: table name -> 'parquet' or 'arrow', parquet by default, arrow is meant for the float matrices
+            that are read as a whole
+        :param carry_over: a catalog version, the tables of the current snapshot are shared with the new one through
+            hard links, if it was exported at this version, nothing is carried over if None
+        :param root: the snapshots' directory, SNAPSHOT_PATH or db/snapshots by default
+        :param keep: number of the most recent versions to keep on disk
+        :return: the published snapshot
+        """
+        if pa is None:
+            raise ImportError('pyarrow is required to publish a snapshot')
+
+        root = root or cls.default_root
+        formats = formats or {}
+        version = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        tmp_path = os.path.join(root, f'.{version}.tmp')
+        os.makedirs(tmp_path)
+
+        described = {}
+        base = cls.current(root=root, catalog_version=carry_over) if carry_over else None
+        if base is not None:
+            for name, description in base.manifest['tables'].items():
+                if name in tables:
+                    continue
+
+                os.makedirs(os.path.join(tmp_path, name))
+                for part in description['parts']:
+                    source, target = os.path.join(base.path, name, part), os.path.join(tmp_path, name, part)
+                    try:
+                        os.link(source, target)
+                    except OSError:  # e.g. a file system without hard links
+                        shutil.copyfile(source, target)
+                described[name] = description
+
+        for name, data in tables.items():
+            chunks = [data] if isinstance(data, pd.DataFrame) else data
+            described[name] = cls._write_table(os.path.join(tmp_path, name), chunks, formats.get(name, 'parquet'))
+
+        manifest = {
+            'format_version': cls.format_version
+            , 'version': version
+            , 'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z')
+            , 'catalog_version': catalog_version
+            , 'pyarrow': pa.__version__
+            , 'tables': described
+        }
+        with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+        os.replace(tmp_path, os.path.join(root, version))
+        with open(os.path.join(root, 'CURRENT.tmp'), 'w') as f:
+            f.write(version)
+        os.replace(os.path.join(root, 'CURRENT.tmp'), os.path.join(root, 'CURRENT'))
+
+        versions = sorted(
+            (entry for entry in os.listdir(root)
+             if entry != version and os.path.isfile(os.path.join(root, entry, 'manifest.json')))
+            , key=lambda entry: os.path.getmtime(os.path.join(root, entry, 'manifest.json'))
+        )
+        for old_version in versions[:max(len(versions) - keep + 1, 0)]:
+            shutil.rmtree(os.path.join(root, old_version), ignore_errors=True)
+
+        return cls(version=version, manifest=manifest, path=os.path.join(root, version))
+
+    def has(self, *tables: str) -> bool:
+        return all(table in self.manifest['tables'] for table in tables)
+
+    def _parts(self, table: str) -> list[str]:
+        return [os.path.join(self.path, table, part) for part in self.manifest['tables'][table]['parts']]
+
+    def schema(self, table: str) -> 'pa.Schema':
+        """Get the table's columns and their types, read from its first part only"""
+        first = self._parts(table)[0]
+        if self.manifest['tables'][table]['format'] == 'arrow':
+            return pa.ipc.open_file(pa.memory_map(first)).schema
+
+        return pq.read_schema(first)
+
+    def numeric_columns(self, table: str) -> list[str]:
+        return [
+            field.name for field in self.schema(table)
+            if pa.types.is_integer(field.type) or pa.types.is_floating(field.type)
+        ]
+
+    def read(self, table: str, columns: list[str] = None, filters: dict[str, list] = None) -> 'pa.Table':
+        """
+        Read the table, only the requested columns are decoded. The Arrow parts are memory-mapped, so their columns are
+            not copied, but backed by the OS page cache shared by all the processes
+        :param table: name of the table
+        :param columns: the columns to read, all of them if None
+        :param filters: column -> the values to keep, the rows have to match all the columns, e.g. {'track_id': ids}
+        :return: the Arrow table
+        """
+        expression = None
+        for column, values in (filters or {}).items():
+            condition = pc.field(column).isin(values)
+            expression = condition if expression is None else expression & condition
+
+        if self.manifest['tables'][table]['format'] == 'arrow':
+            data = pa.concat_tables(pa.ipc.open_file(pa.memory_map(part)).read_all() for part in self._parts(table))
+            if expression is not None:
+                data = data.filter(expression)
+
+            return data.select(columns) if columns else data
+
+        # row groups whose statistics rule out the filter are skipped
+        return pq.read_table(self._parts(table), columns=columns, filters=expression, memory_map=True)
+
+    def read_pandas(self, table: str, columns: list[str] = None, filters: dict[str, list] = None) -> pd.DataFrame:
+        """The same as read(), but returns pandas' DataFrame"""
+        return self.read(table, columns=columns, filters=filters).to_pandas(split_blocks=True)
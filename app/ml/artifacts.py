@@ -0,0 +1,270 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import numpy as np
+import sklearn
+from ml.engines import ENGINES, NeighbourIndex
+
+
+class ModelArtifact:
+    """
+    A versioned on-disk model artifact, the arrays are stored as raw .npy files and opened memory-mapped
+    ...
+
+    Layout
+    ------
+    <root>/CURRENT                  the name of the published version
+    <root>/<version>/manifest.json  format version, engine, its parameters, shapes and dtypes of the arrays
+    <root>/<version>/features.npy   float32 feature matrix, one row per track
+    <root>/<version>/ids.npy        track ids, fixed width unicode, aligned with the features
+    <root>/<version>/index/*.npy    the engine's internal arrays, e.g. the tree nodes
+    <root>/<version>/extra/*.npy    any additional arrays, e.g. the frozen projection or the delta index
+
+    Attributes
+    ----------
+    :param version: the artifact's version
+    :param manifest: the artifact's manifest
+    :param ids: track ids
+    :param features: feature matrix
+    :param model: the restored nearest neighbours index
+    :param extras: the additional arrays
+    :param path: the artifact's directory
+
+    Methods
+    -------
+    current_version(root: str = None) -> str | None:
+        Get the currently published version
+    publish(ids: np.ndarray, features: np.ndarray, columns: list[str], model: NeighbourIndex, ...) -> ModelArtifact:
+        Write a new artifact and publish it as the current version
+    publish_extras(base: ModelArtifact, extras: dict[str, np.ndarray], metadata: dict = None) -> ModelArtifact:
+        Publish a new version that shares the base' arrays and replaces its additional arrays
+    load(root: str = None, version: str = None, mmap: bool = True) -> ModelArtifact:
+        Load the given or the current version of the artifact
+    """
+    format_version = 1
+    default_root = os.path.join(os.path.dirname(__file__), 'artifacts')
+    _sklearn_engines = ('kdtree', 'balltree')  # their arrays are only valid for the very same sklearn version
+
+    def __init__(
+            self
+            , version: str
+            , manifest: dict
+            , ids: np.ndarray
+            , features: np.ndarray
+            , model: NeighbourIndex
+            , extras: dict[str, np.ndarray] = None
+            , path: str = None
+    ):
+        self.version = version
+        self.manifest = manifest
+        self.ids = ids
+        self.features = features
+        self.model = model
+        self.extras = extras or {}
+        self.path = path
+
+    @classmethod
+    def current_version(cls, root: str = None) -> str | None:
+        """Get the currently published version, None if nothing has been published yet"""
+        try:
+            with open(os.path.join(root or cls.default_root, 'CURRENT')) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _save_array(path: str, array: np.ndarray) -> dict:
+        """Save the array as .npy and describe it for the manifest"""
+        array = np.ascontiguousarray(array)
+        np.save(path, array, allow_pickle=False)
+
+        return {'dtype': array.dtype.str if array.dtype.names is None else 'structured', 'shape': list(array.shape)}
+
+    @staticmethod
+    def _new_version(root: str) -> tuple[str, str]:
+        """Create a temporary directory for a new version, return the version and the directory"""
+        version = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        tmp_path = os.path.join(root, f'.{version}.tmp')
+        os.makedirs(os.path.join(tmp_path, 'index'))
+        os.makedirs(os.path.join(tmp_path, 'extra'))
+
+        return version, tmp_path
+
+    @staticmethod
+    def _finalise(root: str, version: str, tmp_path: str, manifest: dict, keep: int) -> str:
+        """Write the manifest, move the version in place, point CURRENT at it and prune the old versions"""
+        with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+        path = os.path.join(root, version)
+        os.replace(tmp_path, path)
+
+        with open(os.path.join(root, 'CURRENT.tmp'), 'w') as f:
+            f.write(version)
+        os.replace(os.path.join(root, 'CURRENT.tmp'), os.path.join(root, 'CURRENT'))
+
+        versions = sorted(
+            (entry for entry in os.listdir(root)
+             if entry != version and os.path.isfile(os.path.join(root, entry, 'manifest.json')))
+            , key=lambda entry: os.path.getmtime(os.path.join(root, entry, 'manifest.json'))
+        )
+        # the just published version is always kept, the workers that still map the old files keep them alive until
+        # they unmap them
+        for old_version in versions[:max(len(versions) - keep + 1, 0)]:
+            shutil.rmtree(os.path.join(root, old_version), ignore_errors=True)
+
+        return path
+
+    @classmethod
+    def publish(
+            cls
+            , ids: np.ndarray
+            , features: np.ndarray
+            , columns: list[str]
+            , model: NeighbourIndex
+            , root: str = None
+            , keep: int = 2
+            , extras: dict[str, np.ndarray] = None
+            , metadata: dict = None
+    ) -> 'ModelArtifact':
+        """
+        Write a new artifact and atomically publish it as the current version, the older versions are pruned
+        :param ids: track ids, aligned with the features
+        :param features: feature matrix, one row per track
+        :param columns: names of the features
+        :param model: the fitted nearest neighbours index
+        :param root: the artifacts' directory, ml/artifacts by default
+        :param keep: number of the most recent versions to keep on disk, the workers that have not reloaded yet may
+            still read the previous one
+        :param extras: additional arrays to store along with the model
+        :param metadata: additional JSON serialisable data to store in the manifest
+        :return: the published artifact
+        """
+        root = root or cls.default_root
+        version, tmp_path = cls._new_version(root)
+
+        ids = np.asarray(ids).astype(str)  # fixed width unicode, so it can be memory-mapped
+        features = np.asarray(features, dtype=np.float32)
+        extras = extras or {}
+
+        files = {
+            'features': cls._save_array(os.path.join(tmp_path, 'features.npy'), features)
+            , 'ids': cls._save_array(os.path.join(tmp_path, 'ids.npy'), ids)
+        }
+        for name, array in model.get_arrays().items():
+            files[f'index/{name}'] = cls._save_array(os.path.join(tmp_path, 'index', f'{name}.npy'), array)
+        for name, array in extras.items():
+            files[f'extra/{name}'] = cls._save_array(os.path.join(tmp_path, 'extra', f'{name}.npy'), array)
+
+        manifest = {
+            'format_version': cls.format_version
+            , 'version': version
+            , 'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z')
+            , 'engine': model.name
+            , 'engine_params': model.get_params()
+            , 'columns': list(columns)
+            , 'n_rows': int(features.shape[0])
+            , 'sklearn_version': sklearn.__version__
+            , 'files': files
+            , 'metadata': metadata or {}
+        }
+        path = cls._finalise(root, version=version, tmp_path=tmp_path, manifest=manifest, keep=keep)
+
+        return cls(
+            version=version, manifest=manifest, ids=ids, features=features, model=model, extras=extras, path=path
+        )
+
+    @classmethod
+    def publish_extras(
+            cls
+            , base: 'ModelArtifact'
+            , extras: dict[str, np.ndarray]
+            , metadata: dict = None
+            , root: str = None
+            , keep: int = 2
+    ) -> 'ModelArtifact':
+        """
+        Publish a new version that shares the features and the index with the base version through hard links, only
+            the additional arrays are written, so the cost depends on their size only
+        :param base: the artifact to build upon
+        :param extras: the additional arrays, replace the base' ones with the same name, the others are dropped
+        :param metadata: the manifest's metadata, updates the base' one
+        :param root: the artifacts' directory, ml/artifacts by default
+        :param keep: number of the most recent versions to keep on disk
+        :return: the published artifact
+        """
+        root = root or cls.default_root
+        version, tmp_path = cls._new_version(root)
+
+        files = {}
+        for name, description in base.manifest['files'].items():
+            if name.startswith('extra/'):
+                continue
+
+            source, target = os.path.join(base.path, f'{name}.npy'), os.path.join(tmp_path, f'{name}.npy')
+            try:
+                os.link(source, target)
+            except OSError:  # e.g. a file system without hard links
+                shutil.copyfile(source, target)
+            files[name] = description
+
+        for name, array in extras.items():
+            files[f'extra/{name}'] = cls._save_array(os.path.join(tmp_path, 'extra', f'{name}.npy'), array)
+
+        manifest = {
+            **base.manifest
+            , 'version': version
+            , 'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z')
+            , 'files': files
+            , 'metadata': {**base.manifest.get('metadata', {}), **(metadata or {})}
+        }
+        cls._finalise(root, version=version, tmp_path=tmp_path, manifest=manifest, keep=keep)
+
+        return cls.load(root=root, version=version)
+
+    @classmethod
+    def load(cls, root: str = None, version: str = None, mmap: bool = True) -> 'ModelArtifact':
+        """
+        Load the artifact, the arrays are memory-mapped read-only unless said otherwise
+        :param root: the artifacts' directory, ml/artifacts by default
+        :param version: the version to load, the current one if None
+        :param mmap: whether to memory-map the arrays or to read them into memory
+        :return: the loaded artifact
+        """
+        root = root or cls.default_root
+        version = version or cls.current_version(root)
+
+        if version is None:
+            raise FileNotFoundError(f'There is no published model artifact in {root}')
+
+        path = os.path.join(root, version)
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+
+        if manifest['format_version'] != cls.format_version:
+            raise ValueError(f"Unsupported artifact format {manifest['format_version']}, expected {cls.format_version}")
+
+        mmap_mode = 'r' if mmap else None
+        features = np.load(os.path.join(path, 'features.npy'), mmap_mode=mmap_mode)
+        ids = np.load(os.path.join(path, 'ids.npy'), mmap_mode=mmap_mode)
+
+        arrays = {
+            name.split('/', 1)[1]: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+            for name in manifest['files'] if name.startswith('index/')
+        }
+        if manifest['engine'] in cls._sklearn_engines and manifest['sklearn_version'] != sklearn.__version__:
+            arrays = {}  # the tree layout may differ between the versions, rebuild it from the features instead
+
+        extras = {
+            name.split('/', 1)[1]: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+            for name in manifest['files'] if name.startswith('extra/')
+        }
+
+        engine = ENGINES[manifest['engine']](**manifest['engine_params'])
+        model = engine.set_arrays(data=features, arrays=arrays)
+
+        return cls(
+            version=version, manifest=manifest, ids=ids, features=features, model=model, extras=extras, path=path
+        )
@@ -0,0 +1,184 @@
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import StandardScaler
+from sklearn.decomposition import PCA
+from ml.engines import NeighbourIndex, BruteForceIndex
+
+
+class Projection:
+    """
+    A frozen copy of the fitted StandardScaler and PCA stored as plain arrays, projects the new tracks into the
+    model's feature space without refitting
+    ...
+
+    Attributes
+    ----------
+    :param columns: the input columns, in the order the transformers were fitted on
+    :param arrays: scaler_mean, scaler_scale, pca_mean and pca_components arrays
+
+    Methods
+    -------
+    from_fitted(columns: list[str], scaler: StandardScaler, pca: PCA, n_components: int) -> Projection:
+        Freeze the fitted transformers
+    transform(df: pd.DataFrame) -> np.ndarray:
+        Project the rows of the DataFrame
+    """
+    def __init__(self, columns: list[str], arrays: dict[str, np.ndarray]):
+        self.columns = list(columns)
+        self.arrays = arrays
+
+    @classmethod
+    def from_fitted(cls, columns: list[str], scaler: StandardScaler, pca: PCA, n_components: int) -> 'Projection':
+        return cls(
+            columns=columns
+            , arrays={
+                'scaler_mean': scaler.mean_
+                , 'scaler_scale': scaler.scale_
+                , 'pca_mean': pca.mean_
+                , 'pca_components': pca.components_[:n_components]
+            }
+        )
+
+    def transform(self, df: pd.DataFrame) -> np.ndarray:
+        """
+        Project the rows the same way the training data was projected
+        :param df: pandas' DataFrame with (at least) the input columns
+        :return: float32 matrix with one row per input row
+        """
+        X = df[self.columns].to_numpy(dtype=np.float64)
+        X = (X - self.arrays['scaler_mean']) / self.arrays['scaler_scale']
+
+        return ((X - self.arrays['pca_mean']) @ self.arrays['pca_components'].T).astype(np.float32)
+
+
+class DeltaIndex:
+    """
+    A small exact index over the tracks added since the main index was built, the replaced main rows are tombstoned,
+    .add() returns a new index
+    ...
+
+    Attributes
+    ----------
+    :param n_main: number of rows in the main index, the delta rows follow after them
+    :param ids: track ids of the delta rows
+    :param vectors: projected vectors of the delta rows
+    :param row_idx: catalog idx values of the delta rows
+    :param tombstones: sorted positions of the main index' rows that have been replaced
+
+    Methods
+    -------
+    add(ids: list[str], vectors: np.ndarray, row_idx: np.ndarray, main_positions: dict[str, int]) -> DeltaIndex:
+        Get a new delta with the given tracks added or replaced
+    search(X: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        Search the delta index only
+    query(model: NeighbourIndex, X: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        Search both the main and the delta index, merge the results by the distance
+    """
+    def __init__(
+            self
+            , n_main: int
+            , ids: list[str] = None
+            , vectors: np.ndarray = None
+            , row_idx: np.ndarray = None
+            , tombstones: np.ndarray = None
+    ):
+        self.n_main = n_main
+        self.ids = list(ids) if ids is not None else []
+        self.vectors = vectors if vectors is not None else np.empty((0, 0), dtype=np.float32)
+        self.row_idx = row_idx if row_idx is not None else np.empty(0, dtype=np.int64)
+        self.tombstones = tombstones if tombstones is not None else np.empty(0, dtype=np.int64)
+
+        self._index = BruteForceIndex().fit(self.vectors) if len(self.ids) else None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(
+            self
+            , ids: list[str]
+            , vectors: np.ndarray
+            , row_idx: np.ndarray
+            , main_positions: dict[str, int]
+    ) -> 'DeltaIndex':
+        """
+        Add the tracks to the delta, the tracks already present in the delta are replaced, the ones present in the main
+            index are tombstoned there
+        :param ids: track ids
+        :param vectors: the projected vectors
+        :param row_idx: the tracks' catalog idx values
+        :param main_positions: the track id -> position mapping, the positions past n_main are ignored
+        :return: a new delta index
+        """
+        incoming = set(ids)
+        keep = [i for i, track_id in enumerate(self.ids) if track_id not in incoming]
+
+        replaced = [pos for pos in (main_positions.get(track_id, -1) for track_id in ids) if 0 <= pos < self.n_main]
+        tombstones = np.union1d(self.tombstones, np.asarray(replaced, dtype=np.int64))
+
+        old_vectors = self.vectors[keep] if len(keep) else np.empty((0, vectors.shape[1]), dtype=np.float32)
+
+        return DeltaIndex(
+            n_main=self.n_main
+            , ids=[self.ids[i] for i in keep] + list(ids)
+            , vectors=np.vstack([old_vectors, np.asarray(vectors, dtype=np.float32)])
+            , row_idx=np.concatenate([self.row_idx[keep], np.asarray(row_idx, dtype=np.int64)])
+            , tombstones=tombstones
+        )
+
+    def search(self, X: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Search the delta rows only, e.g. to merge them with the precomputed neighbours of the main index
+        :param X: the query vectors
+        :param k: number of neighbours, at most the delta's size is returned
+        :return: distances and rows, numbered from n_main onwards, empty if the delta is
+        """
+        if self._index is None:
+            return np.empty((len(X), 0), dtype=np.float64), np.empty((len(X), 0), dtype=np.int64)
+
+        distances, rows = self._index.query(X, k=min(k, len(self)), return_distance=True)
+
+        return distances, rows + self.n_main
+
+    def query(self, model: NeighbourIndex, X: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Search both indexes and merge their results. The main index is searched as deep as the share of the tombstones
+            suggests, the queries too many tombstones have fallen into are searched twice as deep until k live
+            neighbours remain, or the whole main index has been searched
+        :param model: the main index
+        :param X: the query vectors
+        :param k: number of neighbours
+        :return: distances and rows, the delta rows are numbered from n_main onwards
+        """
+        n_live = self.n_main - len(self.tombstones)
+        k_live = min(k, n_live)
+
+        if len(self.tombstones):
+            depth = min(self.n_main, max(k, int(np.ceil(1.5 * k * self.n_main / max(n_live, 1)))))
+            distances, rows = self._live(*model.query(X, k=depth, return_distance=True), k=k_live)
+
+            short = np.flatnonzero(np.isinf(distances).any(axis=1))
+            while len(short) and depth < self.n_main:
+                depth = min(self.n_main, 2 * depth)
+                distances[short], rows[short] = self._live(
+                    *model.query(X[short], k=depth, return_distance=True), k=k_live
+                )
+                short = short[np.isinf(distances[short]).any(axis=1)]
+        else:
+            distances, rows = model.query(X, k=k_live, return_distance=True)
+
+        if self._index is not None:
+            delta_distances, delta_rows = self.search(X, k=k)
+            distances = np.hstack([distances, delta_distances])
+            rows = np.hstack([rows, delta_rows])
+
+        k = min(k, n_live + len(self))
+        order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(rows, order, axis=1)
+
+    def _live(self, distances: np.ndarray, rows: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Keep the k nearest rows that are not tombstoned, the distance is inf where fewer than k of them are found"""
+        distances = np.where(np.isin(rows, self.tombstones), np.inf, distances)
+        order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(rows, order, axis=1)
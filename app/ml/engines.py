@@ -0,0 +1,422 @@
+import numpy as np
+from abc import ABC, abstractmethod
+from sklearn.metrics import DistanceMetric
+from sklearn.neighbors import KDTree, BallTree
+from ml.quantization import squared_distances, kmeans, ScalarQuantizer, ProductQuantizer
+
+
+class NeighbourIndex(ABC):
+    """
+    An abstract base class for the nearest neighbours engines, mirrors the sklearn's KDTree interface
+    ...
+
+    Attributes
+    ----------
+    :param params: engine specific parameters, see the respective subclass
+
+    Methods
+    -------
+    fit(data: np.ndarray) -> NeighbourIndex:
+        Build the index over the given data
+    query(X: np.ndarray, k: int = 1, return_distance: bool = True) -> np.ndarray | tuple[np.ndarray, np.ndarray]:
+        Find the k nearest neighbours of every row in X, sorted by the distance
+    get_params() -> dict:
+        Get the engine's parameters
+    get_arrays() -> dict[str, np.ndarray]:
+        Get the index' internal arrays, so that they can be stored on disk
+    set_arrays(data: np.ndarray, arrays: dict[str, np.ndarray]) -> NeighbourIndex:
+        Restore the index from the stored (possibly memory-mapped) arrays without copying them
+    """
+    name = ''
+
+    def __init__(self, **params):
+        self._params = params
+
+    def get_params(self) -> dict:
+        """Get the engine's parameters, sufficient to rebuild the very same index"""
+        return dict(self._params)
+
+    def get_arrays(self) -> dict[str, np.ndarray]:
+        """Get the index' internal arrays apart from the indexed data itself, empty if there is nothing to store"""
+        return {}
+
+    def set_arrays(self, data: np.ndarray, arrays: dict[str, np.ndarray]) -> 'NeighbourIndex':
+        """
+        Restore the index from the arrays returned by .get_arrays(), the index is rebuilt from the data if they are
+            missing. The arrays are used as they are, so memory-mapped arrays stay memory-mapped
+        :param data: the indexed data
+        :param arrays: the arrays returned by .get_arrays()
+        :return: the restored index
+        """
+        return self.fit(data)
+
+    @abstractmethod
+    def fit(self, data: np.ndarray) -> 'NeighbourIndex':
+        """Build the index over the data, one row per point"""
+
+    @abstractmethod
+    def query(
+            self
+            , X: np.ndarray
+            , k: int = 1
+            , return_distance: bool = True
+    ) -> np.ndarray | tuple[np.ndarray, np.ndarray]:
+        """Find the k nearest neighbours of every row of X, the closest first, (distances, rows) if return_distance"""
+
+    def __repr__(self) -> str:
+        params = ', '.join(f'{key}={value}' for key, value in self._params.items())
+
+        return f'{self.__class__.__name__}({params})'
+
+
+class KDTreeIndex(NeighbourIndex):
+    """Exact search with sklearn's KDTree, a good fit for low dimensional data"""
+    name = 'kdtree'
+    _tree_class = KDTree
+
+    def __init__(self, leaf_size: int = 7):
+        super().__init__(leaf_size=leaf_size)
+        self._tree = None
+
+    @classmethod
+    def from_tree(cls, tree: KDTree | BallTree) -> 'KDTreeIndex':
+        """Wrap an already built sklearn tree, e.g. a model pickled before the engines were introduced"""
+        index = cls(leaf_size=tree.leaf_size)
+        index._tree = tree
+
+        return index
+
+    def fit(self, data: np.ndarray) -> 'KDTreeIndex':
+        self._tree = self._tree_class(data, leaf_size=self._params['leaf_size'])
+
+        return self
+
+    def get_arrays(self) -> dict[str, np.ndarray]:
+        state = self._tree.__getstate__()
+
+        if state[12] is not None:  # sample weights are not supported, rebuild the tree on load
+            return {}
+
+        return {
+            'tree_data': state[0]
+            , 'idx_array': state[1]
+            , 'node_data': state[2]
+            , 'node_bounds': state[3]
+            , 'tree_stats': np.array(state[4:11], dtype=np.int64)
+        }
+
+    def set_arrays(self, data: np.ndarray, arrays: dict[str, np.ndarray]) -> 'KDTreeIndex':
+        if not arrays:
+            return self.fit(data)
+
+        tree = self._tree_class.__new__(self._tree_class)
+        tree.__setstate__((
+            arrays['tree_data']
+            , arrays['idx_array']
+            , arrays['node_data']
+            , arrays['node_bounds']
+            , *(int(stat) for stat in arrays['tree_stats'])
+            , DistanceMetric.get_metric('euclidean')
+            , None
+        ))
+        self._tree = tree
+
+        return self
+
+    def query(self, X, k=1, return_distance=True):
+        return self._tree.query(X, k=k, return_distance=return_distance)
+
+
+class BallTreeIndex(KDTreeIndex):
+    """Exact search with sklearn's BallTree, degrades more gracefully than KDTree with more dimensions"""
+    name = 'balltree'
+    _tree_class = BallTree
+
+    def __init__(self, leaf_size: int = 40):
+        super().__init__(leaf_size=leaf_size)
+
+
+class BruteForceIndex(NeighbourIndex):
+    """
+    Exact search by a batched matrix multiplication, a good fit for large query batches
+    """
+    name = 'brute'
+
+    def __init__(self, batch_size: int = 1024):
+        super().__init__(batch_size=batch_size)
+        self._data = np.empty((0, 0), dtype=np.float32)
+        self._sq_norms = np.empty(0, dtype=np.float32)
+
+    def fit(self, data: np.ndarray) -> 'BruteForceIndex':
+        self._data = np.ascontiguousarray(data, dtype=np.float32)
+        self._sq_norms = np.einsum('ij,ij->i', self._data, self._data)
+
+        return self
+
+    def get_arrays(self) -> dict[str, np.ndarray]:
+        return {'sq_norms': self._sq_norms}
+
+    def set_arrays(self, data: np.ndarray, arrays: dict[str, np.ndarray]) -> 'BruteForceIndex':
+        if not arrays:
+            return self.fit(data)
+
+        self._data = np.ascontiguousarray(data, dtype=np.float32)
+        self._sq_norms = arrays['sq_norms']
+
+        return self
+
+    def query(self, X, k=1, return_distance=True):
+        X = np.atleast_2d(np.asarray(X, dtype=np.float32))
+        k = min(k, len(self._data))
+        batch_size = self._params['batch_size']
+
+        distances = np.empty((len(X), k), dtype=np.float64)
+        indices = np.empty((len(X), k), dtype=np.intp)
+
+        for start in range(0, len(X), batch_size):
+            batch = X[start:start + batch_size]
+
+            sq_dist = self._sq_norms[None, :] - 2 * batch @ self._data.T
+            sq_dist += np.einsum('ij,ij->i', batch, batch)[:, None]
+
+            # partial selection first, then sort only the k best candidates
+            if k < sq_dist.shape[1]:
+                candidates = np.argpartition(sq_dist, k - 1, axis=1)[:, :k]
+            else:
+                candidates = np.broadcast_to(np.arange(sq_dist.shape[1]), sq_dist.shape)
+            candidate_dist = np.take_along_axis(sq_dist, candidates, axis=1)
+            order = np.argsort(candidate_dist, axis=1, kind='stable')
+
+            indices[start:start + batch_size] = np.take_along_axis(candidates, order, axis=1)
+            distances[start:start + batch_size] = np.take_along_axis(candidate_dist, order, axis=1)
+
+        if return_distance:
+            return np.sqrt(np.maximum(distances, 0)), indices
+
+        return indices
+
+
+class IVFIndex(NeighbourIndex):
+    """
+    Approximate search with an inverted file index, every query only scans the n_probe closest k-means clusters
+    """
+    name = 'ivf'
+
+    def __init__(self, n_lists: int = None, n_probe: int = 8, n_iter: int = 15, seed: int = 0):
+        super().__init__(n_lists=n_lists, n_probe=n_probe, n_iter=n_iter, seed=seed)
+        self._data = np.empty((0, 0), dtype=np.float32)
+        self._centroids = np.empty((0, 0), dtype=np.float32)
+        self._order = np.empty(0, dtype=np.intp)  # rows sorted by their list
+        self._offsets = np.zeros(1, dtype=np.intp)  # the list i spans over _order[_offsets[i]:_offsets[i + 1]]
+
+    def fit(self, data: np.ndarray) -> 'IVFIndex':
+        self._data = np.ascontiguousarray(data, dtype=np.float32)
+        n_lists = self._params['n_lists'] or max(1, int(np.sqrt(len(self._data))))
+        n_lists = min(n_lists, len(self._data))
+
+        centroids, labels = kmeans(self._data, n_lists, n_iter=self._params['n_iter'], seed=self._params['seed'])
+
+        self._centroids = centroids
+        self._order = np.argsort(labels, kind='stable')
+        self._offsets = np.concatenate(([0], np.cumsum(np.bincount(labels, minlength=n_lists))))
+
+        return self
+
+    def get_arrays(self) -> dict[str, np.ndarray]:
+        return {'centroids': self._centroids, 'order': self._order, 'offsets': self._offsets}
+
+    def set_arrays(self, data: np.ndarray, arrays: dict[str, np.ndarray]) -> 'IVFIndex':
+        if not arrays:
+            return self.fit(data)
+
+        self._data = np.ascontiguousarray(data, dtype=np.float32)
+        self._centroids = arrays['centroids']
+        self._order = arrays['order']
+        self._offsets = arrays['offsets']
+
+        return self
+
+    def query(self, X, k=1, return_distance=True):
+        X = np.atleast_2d(np.asarray(X, dtype=np.float32))
+        k = min(k, len(self._data))
+        sizes = np.diff(self._offsets)
+
+        distances = np.empty((len(X), k), dtype=np.float64)
+        indices = np.empty((len(X), k), dtype=np.intp)
+
+        list_order = np.argsort(squared_distances(X, self._centroids), axis=1)
+
+        for i, (x, lists) in enumerate(zip(X, list_order)):
+            # probe at least n_probe lists, and as many as needed to have k candidates
+            n_probe = max(self._params['n_probe'], int(np.searchsorted(np.cumsum(sizes[lists]), k)) + 1)
+            candidates = np.concatenate([
+                self._order[self._offsets[j]:self._offsets[j + 1]] for j in lists[:n_probe]
+            ])
+
+            diff = self._data[candidates] - x
+            sq_dist = np.einsum('ij,ij->i', diff, diff)
+            best = np.argpartition(sq_dist, k - 1)[:k] if k < len(candidates) else np.arange(len(candidates))
+            best = best[np.argsort(sq_dist[best], kind='stable')]
+
+            indices[i] = candidates[best]
+            distances[i] = sq_dist[best]
+
+        if return_distance:
+            return np.sqrt(distances), indices
+
+        return indices
+
+
+class QuantizedIndex(NeighbourIndex):
+    """
+    Exhaustive search over float32, int8 or product quantized vectors, the rerank * k best candidates are re-ranked by
+    their exact distances
+    """
+    name = 'quantized'
+    precisions = ('float32', 'int8', 'pq')
+
+    def __init__(
+            self
+            , precision: str = 'int8'
+            , rerank: int = 4
+            , n_subspaces: int = None
+            , n_centroids: int = 256
+            , n_iter: int = 15
+            , seed: int = 0
+            , block_size: int = 65536
+    ):
+        if precision not in self.precisions:
+            raise ValueError(f'Unknown precision {precision}, please choose one of: {", ".join(self.precisions)}')
+
+        super().__init__(
+            precision=precision, rerank=rerank, n_subspaces=n_subspaces, n_centroids=n_centroids, n_iter=n_iter
+            , seed=seed, block_size=block_size
+        )
+        self._data = np.empty((0, 0), dtype=np.float32)
+        self._codes = np.empty((0, 0), dtype=np.float32)
+        self._code_norms = np.empty(0, dtype=np.float32)
+        self._quantizer: ScalarQuantizer | ProductQuantizer | None = None
+
+    def fit(self, data: np.ndarray) -> 'QuantizedIndex':
+        self._data = np.ascontiguousarray(data, dtype=np.float32)
+        precision = self._params['precision']
+
+        if precision == 'float32':
+            self._codes = self._data
+            self._code_norms = np.einsum('ij,ij->i', self._data, self._data)
+        elif precision == 'int8':
+            self._quantizer = ScalarQuantizer().fit(self._data)
+            self._codes = self._quantizer.encode(self._data)
+            self._code_norms = self._quantizer.code_norms(self._codes)
+        else:
+            n_subspaces = self._params['n_subspaces'] or max(1, self._data.shape[1] // 2)
+            self._quantizer = ProductQuantizer(n_subspaces, n_centroids=self._params['n_centroids']).fit(
+                self._data, n_iter=self._params['n_iter'], seed=self._params['seed']
+            )
+            self._codes = self._quantizer.encode(self._data)
+
+        return self
+
+    def get_arrays(self) -> dict[str, np.ndarray]:
+        precision = self._params['precision']
+
+        if precision == 'float32':
+            return {'sq_norms': self._code_norms}
+        if precision == 'int8':
+            return {
+                'codes': self._codes, 'code_norms': self._code_norms
+                , 'offset': self._quantizer.offset, 'scale': self._quantizer.scale
+            }
+
+        return {'codes': self._codes, 'codebooks': self._quantizer.codebooks, 'bounds': self._quantizer.bounds}
+
+    def set_arrays(self, data: np.ndarray, arrays: dict[str, np.ndarray]) -> 'QuantizedIndex':
+        if not arrays:
+            return self.fit(data)
+
+        self._data = np.ascontiguousarray(data, dtype=np.float32)
+        precision = self._params['precision']
+
+        if precision == 'float32':
+            self._codes, self._code_norms = self._data, arrays['sq_norms']
+        elif precision == 'int8':
+            self._quantizer = ScalarQuantizer(offset=arrays['offset'], scale=arrays['scale'])
+            self._codes, self._code_norms = arrays['codes'], arrays['code_norms']
+        else:
+            self._quantizer = ProductQuantizer(
+                n_subspaces=len(arrays['codebooks']), n_centroids=arrays['codebooks'].shape[1]
+                , codebooks=arrays['codebooks'], bounds=arrays['bounds']
+            )
+            self._codes = arrays['codes']
+
+        return self
+
+    def _approximate(self, X: np.ndarray, start: int, stop: int) -> np.ndarray:
+        """Get the squared distances between the queries and the rows start:stop computed from their codes"""
+        codes = self._codes[start:stop]
+        precision = self._params['precision']
+
+        if precision == 'float32':
+            sq_dist = self._code_norms[None, start:stop] - 2 * X @ codes.T
+            return sq_dist + np.einsum('ij,ij->i', X, X)[:, None]
+        if precision == 'int8':
+            return self._quantizer.distances(X, codes, self._code_norms[start:stop])
+
+        return self._quantizer.distances(X, codes)
+
+    def query(self, X, k=1, return_distance=True):
+        X = np.atleast_2d(np.asarray(X, dtype=np.float32))
+        n_rows, block_size = len(self._codes), self._params['block_size']
+        k = min(k, n_rows)
+
+        rerank = self._params['rerank'] if self._params['precision'] != 'float32' else 0  # exact already
+        n_candidates = min(n_rows, k * rerank) if rerank else k
+
+        distances = np.empty((len(X), k), dtype=np.float64)
+        indices = np.empty((len(X), k), dtype=np.intp)
+
+        # the queries are taken in batches, so that their distance matrix stays within block_size * 256 floats
+        batch_size = max(1, block_size * 256 // max(n_rows, 1))
+        for start in range(0, len(X), batch_size):
+            batch = X[start:start + batch_size]
+
+            sq_dist = np.empty((len(batch), n_rows), dtype=np.float32)
+            for row in range(0, n_rows, block_size):
+                sq_dist[:, row:row + block_size] = self._approximate(batch, row, row + block_size)
+
+            if n_candidates < n_rows:
+                candidates = np.argpartition(sq_dist, n_candidates - 1, axis=1)[:, :n_candidates]
+            else:
+                candidates = np.broadcast_to(np.arange(n_rows), sq_dist.shape)
+
+            if rerank:  # the exact distances of the candidates only
+                diff = self._data[candidates] - batch[:, None, :]
+                candidate_dist = np.einsum('ijk,ijk->ij', diff, diff)
+            else:
+                candidate_dist = np.take_along_axis(sq_dist, candidates, axis=1)
+
+            order = np.argsort(candidate_dist, axis=1, kind='stable')[:, :k]
+            indices[start:start + batch_size] = np.take_along_axis(candidates, order, axis=1)
+            distances[start:start + batch_size] = np.take_along_axis(candidate_dist, order, axis=1)
+
+        if return_distance:
+            return np.sqrt(np.maximum(distances, 0)), indices
+
+        return indices
+
+
+ENGINES = {engine.name: engine for engine in [KDTreeIndex, BallTreeIndex, BruteForceIndex, IVFIndex, QuantizedIndex]}
+
+
+def build_index(data: np.ndarray, engine: str = 'kdtree', **params) -> NeighbourIndex:
+    """
+    Build a nearest neighbours index with the chosen engine
+    :param data: the data to index, rows are the points
+    :param engine: one of the ENGINES keys: kdtree, balltree, brute, ivf or quantized
+    :param params: the engine specific parameters, see the respective engine class
+    :return: the fitted index
+    """
+    if engine not in ENGINES:
+        raise ValueError(f'Unknown engine {engine}, please choose one of: {", ".join(ENGINES)}')
+
+    return ENGINES[engine](**params).fit(np.asarray(data))
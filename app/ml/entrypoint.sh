@@ -1,10 +1,10 @@
-MODEL_FILE="kdt.pkl"
+MODEL_FILE="artifacts/CURRENT"
 
 if [ ! -f "$MODEL_FILE" ]; then
-	echo "Model file does not exist, training a new one"
+	echo "Model artifact does not exist, training a new one"
 	cd .. && python recommender.py
 else
-	echo "Model file exists. Skipping the training"
+	echo "Model artifact exists. Skipping the training"
 fi
 
 # start the Dockerfile main process
@@ -0,0 +1,128 @@
+"""
+Precomputes the top-K neighbours of every track of the published model artifact and publishes them with the model.
+
+Run from the app directory:
+    python -m ml.neighbours -k 50 --jobs 4
+"""
+import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from threadpoolctl import threadpool_limits
+from ml.artifacts import ModelArtifact
+from ml.engines import NeighbourIndex
+
+# the artifact is opened by every worker once, its arrays are memory-mapped, so the workers share the parent's pages
+_model: NeighbourIndex | None = None
+_vectors: np.ndarray | None = None
+
+
+def _init_worker(root: str, version: str) -> None:
+    global _model, _vectors
+    artifact = ModelArtifact.load(root=root, version=version)
+    _model, _vectors = artifact.model, artifact.features
+
+    threadpool_limits(1)  # the parallelism comes from the processes
+
+
+def top_k(model: NeighbourIndex, vectors: np.ndarray, start: int, stop: int, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Find the k nearest neighbours of the rows start:stop, the rows themselves excluded
+    :param model: the index
+    :param vectors: the index' vectors
+    :param start: the first row
+    :param stop: the row after the last one
+    :param k: number of the neighbours
+    :return: the neighbours' rows as int32 and their distances as float16, the closest first
+    """
+    distances, rows = model.query(vectors[start:stop], k=k + 1, return_distance=True)
+
+    # the row itself goes last and is cut off, the last neighbour is, if the row has more than k exact duplicates
+    own = rows == np.arange(start, stop)[:, None]
+    order = np.argsort(own, axis=1, kind='stable')[:, :k]
+
+    return (
+        np.take_along_axis(rows, order, axis=1).astype(np.int32)
+        , np.take_along_axis(distances, order, axis=1).astype(np.float16)
+    )
+
+
+def _compute_block(start: int, stop: int, k: int) -> tuple[int, np.ndarray, np.ndarray]:
+    return start, *top_k(_model, _vectors, start, stop, k)
+
+
+def compute(
+        artifact: ModelArtifact
+        , k: int = 50
+        , jobs: int = None
+        , block_size: int = 4096
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the neighbour table of the artifact's main index
+    :param artifact: a published model artifact
+    :param k: number of the neighbours per track
+    :param jobs: number of the worker processes, all the cores if None, in-process if 1
+    :param block_size: number of the tracks per task
+    :return: rows and distances, one row per track of the main index
+    """
+    n_rows = len(artifact.features)
+    k = min(k, n_rows - 1)
+    rows = np.empty((n_rows, k), dtype=np.int32)
+    distances = np.empty((n_rows, k), dtype=np.float16)
+    blocks = [(start, min(start + block_size, n_rows)) for start in range(0, n_rows, block_size)]
+
+    if jobs == 1:
+        for start, stop in blocks:
+            rows[start:stop], distances[start:stop] = top_k(artifact.model, artifact.features, start, stop, k)
+
+        return rows, distances
+
+    root = os.path.dirname(artifact.path)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(root, artifact.version)) as pool:
+        for start, block_rows, block_distances in pool.map(_compute_block, *zip(*blocks), [k] * len(blocks)):
+            rows[start:start + len(block_rows)], distances[start:start + len(block_rows)] = block_rows, block_distances
+
+    return rows, distances
+
+
+def publish(root: str = None, k: int = 50, jobs: int = None) -> ModelArtifact:
+    """
+    Compute the neighbour table of the current model artifact and publish it as a new version of the artifact, the
+        features and the index are shared with the base version
+    :param root: the artifacts' directory, ml/artifacts by default
+    :param k: number of the neighbours per track
+    :param jobs: number of the worker processes, all the cores if None
+    :return: the published artifact
+    """
+    base = ModelArtifact.load(root=root)
+    rows, distances = compute(base, k=k, jobs=jobs)
+
+    return ModelArtifact.publish_extras(
+        base=base
+        , extras={**base.extras, 'neighbour_rows': rows, 'neighbour_distances': distances}
+        , metadata={'neighbours_k': int(rows.shape[1])}
+        , root=root
+    )
+
+
+def main(argv: list[str] = None) -> ModelArtifact:
+    parser = argparse.ArgumentParser(description="Precompute the top-K neighbours of the published model's tracks")
+    parser.add_argument('-k', type=int, default=int(os.environ.get('RECOMMENDER_NEIGHBOURS_K', 50)))
+    parser.add_argument('--jobs', type=int, default=None, help='number of the worker processes, all the cores if unset')
+    parser.add_argument('--root', default=None, help='the artifacts directory, ml/artifacts if unset')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    artifact = publish(root=args.root, k=args.k, jobs=args.jobs)
+
+    print(
+        f"{artifact.manifest['n_rows']} tracks x {artifact.manifest['metadata']['neighbours_k']} neighbours published "
+        f"as {artifact.version} in {time.perf_counter() - start:.1f}s"
+    )
+
+    return artifact
+
+
+if __name__ == '__main__':
+    main()
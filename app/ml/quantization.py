@@ -0,0 +1,173 @@
+import numpy as np
+
+
+def squared_distances(X: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Get the squared distances between the rows and the centroids"""
+    sq_dist = np.einsum('ij,ij->i', centroids, centroids)[None, :] - 2 * X @ centroids.T
+
+    return sq_dist + np.einsum('ij,ij->i', X, X)[:, None]
+
+
+def kmeans(data: np.ndarray, n_clusters: int, n_iter: int = 15, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Cluster the rows by Lloyd's k-means, the initial centroids are sampled from the rows
+    :param data: float32 matrix, one row per point
+    :param n_clusters: number of the clusters, at most the number of the rows
+    :param n_iter: number of the iterations
+    :param seed: seed of the initial centroids' sample
+    :return: the centroids and the rows' labels
+    """
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), size=n_clusters, replace=False)]
+
+    for _ in range(n_iter):
+        labels = squared_distances(data, centroids).argmin(axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, data)
+        counts = np.bincount(labels, minlength=n_clusters)
+
+        non_empty = counts > 0  # empty clusters keep their previous centroid
+        centroids[non_empty] = sums[non_empty] / counts[non_empty, None]
+
+    return centroids, squared_distances(data, centroids).argmin(axis=1)
+
+
+class ScalarQuantizer:
+    """
+    Stores every dimension as int8 scaled to the dimension's range
+    ...
+
+    Attributes
+    ----------
+    :param offset: the value code -128 stands for, per dimension
+    :param scale: the difference between two adjacent codes, per dimension
+
+    Methods
+    -------
+    fit(data: np.ndarray) -> ScalarQuantizer:
+        Get the dimensions' ranges
+    encode(data: np.ndarray) -> np.ndarray:
+        Quantize the rows
+    decode(codes: np.ndarray) -> np.ndarray:
+        Reconstruct the rows
+    code_norms(codes: np.ndarray) -> np.ndarray:
+        Precompute the rows' norms for .distances()
+    distances(X: np.ndarray, codes: np.ndarray, code_norms: np.ndarray) -> np.ndarray:
+        Get the squared distances between the queries and the quantized rows
+    """
+    def __init__(self, offset: np.ndarray = None, scale: np.ndarray = None):
+        self.offset = offset
+        self.scale = scale
+
+    def fit(self, data: np.ndarray) -> 'ScalarQuantizer':
+        low, high = data.min(axis=0), data.max(axis=0)
+        self.offset = low.astype(np.float32)
+        self.scale = (np.maximum(high - low, 1e-12) / 255).astype(np.float32)
+
+        return self
+
+    def encode(self, data: np.ndarray) -> np.ndarray:
+        codes = np.rint((data - self.offset) / self.scale) - 128
+
+        return np.clip(codes, -128, 127).astype(np.int8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return (codes.astype(np.float32) + 128) * self.scale + self.offset
+
+    def code_norms(self, codes: np.ndarray) -> np.ndarray:
+        """Get the squared norms of the decoded rows relative to the offset, precomputed for .distances()"""
+        scaled = (codes.astype(np.float32) + 128) * self.scale
+
+        return np.einsum('ij,ij->i', scaled, scaled)
+
+    def distances(self, X: np.ndarray, codes: np.ndarray, code_norms: np.ndarray) -> np.ndarray:
+        """
+        Get the squared distances between the queries and the decoded rows without decoding them
+        :param X: the float32 queries
+        :param codes: the rows' codes
+        :param code_norms: the rows' .code_norms()
+        :return: the squared distances, one row per query
+        """
+        X = X - self.offset
+        sq_dist = code_norms[None, :] - 2 * ((X * self.scale) @ (codes.T.astype(np.float32) + 128))
+
+        return sq_dist + np.einsum('ij,ij->i', X, X)[:, None]
+
+
+class ProductQuantizer:
+    """
+    Stores every row as the ids of the closest k-means centroids of its subspaces, one byte per subspace
+    ...
+
+    Attributes
+    ----------
+    :param n_subspaces: number of the subspaces, i.e. bytes per row
+    :param n_centroids: number of the centroids per subspace, at most 256
+    :param codebooks: the subspaces' centroids, n_subspaces x n_centroids x the widest subspace, zero padded
+    :param bounds: the subspaces' first dimensions and the end
+
+    Methods
+    -------
+    fit(data: np.ndarray, n_iter: int = 15, seed: int = 0) -> ProductQuantizer:
+        Train the codebooks
+    encode(data: np.ndarray) -> np.ndarray:
+        Quantize the rows
+    decode(codes: np.ndarray) -> np.ndarray:
+        Reconstruct the rows
+    distances(X: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        Get the squared distances between the queries and the quantized rows
+    """
+    def __init__(
+            self
+            , n_subspaces: int
+            , n_centroids: int = 256
+            , codebooks: np.ndarray = None
+            , bounds: np.ndarray = None
+    ):
+        self.n_subspaces = n_subspaces
+        self.n_centroids = min(n_centroids, 256)
+        self.codebooks = codebooks
+        self.bounds = bounds
+
+    def _parts(self, data: np.ndarray) -> list[np.ndarray]:
+        return [data[:, start:end] for start, end in zip(self.bounds[:-1], self.bounds[1:])]
+
+    def fit(self, data: np.ndarray, n_iter: int = 15, seed: int = 0) -> 'ProductQuantizer':
+        n_subspaces = min(self.n_subspaces, data.shape[1])
+        n_centroids = min(self.n_centroids, len(data))
+        self.bounds = np.linspace(0, data.shape[1], n_subspaces + 1).astype(np.int64)  # as even as possible
+
+        width = int(np.diff(self.bounds).max())
+        self.codebooks = np.zeros((n_subspaces, n_centroids, width), dtype=np.float32)
+        for i, part in enumerate(self._parts(data)):
+            centroids, _ = kmeans(np.ascontiguousarray(part), n_centroids, n_iter=n_iter, seed=seed + i)
+            self.codebooks[i, :, :part.shape[1]] = centroids
+
+        return self
+
+    def encode(self, data: np.ndarray) -> np.ndarray:
+        codes = np.empty((len(data), len(self.codebooks)), dtype=np.uint8)
+        for i, part in enumerate(self._parts(data)):
+            codes[:, i] = squared_distances(part, self.codebooks[i, :, :part.shape[1]]).argmin(axis=1)
+
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return np.hstack([
+            self.codebooks[i, codes[:, i], :end - start]
+            for i, (start, end) in enumerate(zip(self.bounds[:-1], self.bounds[1:]))
+        ])
+
+    def distances(self, X: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        """
+        Get the squared distances between the queries and the decoded rows by the asymmetric distance computation
+        :param X: the float32 queries
+        :param codes: the rows' codes
+        :return: the squared distances, one row per query
+        """
+        sq_dist = np.zeros((len(X), len(codes)), dtype=np.float32)
+        for i, part in enumerate(self._parts(X)):
+            table = squared_distances(part, self.codebooks[i, :, :part.shape[1]])  # query x centroid
+            sq_dist += table[:, codes[:, i]]
+
+        return sq_dist
@@ -0,0 +1,274 @@
+"""
+Benchmarks every combination of the number of principal components, the engine and its parameters in parallel and
+publishes the best one as the new model artifact, along with its neighbour table.
+
+Run from the app directory:
+    python -m ml.train --n-components 4 6 8 --leaf-size 7 20 40 --engines kdtree balltree brute ivf
+    python -m ml.train --engines brute quantized --precisions float32 int8 pq --rerank 0 4 --no-promote
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import sklearn
+from threadpoolctl import threadpool_limits
+from ml.engines import ENGINES, BruteForceIndex, QuantizedIndex, build_index
+from ml.neighbours import publish as publish_neighbours
+from recommender import Recommender
+
+# the features and the queries are sent to every worker once, not with every configuration
+_features: np.ndarray | None = None
+_queries: np.ndarray | None = None
+_truth: np.ndarray | None = None
+
+reports_path = os.path.join(os.path.dirname(__file__), 'reports')
+
+
+def _init_worker(features: np.ndarray, queries: np.ndarray, truth: np.ndarray) -> None:
+    global _features, _queries, _truth
+    _features, _queries, _truth = features, queries, truth
+
+    threadpool_limits(1)  # one core per configuration, so the parallel runs do not skew each other's timings
+
+
+def _recall(found: np.ndarray, truth: np.ndarray) -> float:
+    """Get the mean share of the true neighbours among the found ones"""
+    hits = sum(len(np.intersect1d(row, true_row, assume_unique=True)) for row, true_row in zip(found, truth))
+
+    return hits / truth.size
+
+
+def configurations(
+        n_components: list[int]
+        , engines: list[str]
+        , leaf_sizes: list[int]
+        , n_probes: list[int]
+        , seed: int
+        , precisions: tuple[str, ...] = ('float32', 'int8', 'pq')
+        , reranks: tuple[int, ...] = (0, 4)
+) -> list[dict]:
+    """Expand the grid, the engine specific parameters only multiply their own engine's configurations"""
+    configs = []
+    for n, engine in itertools.product(n_components, engines):
+        if engine in ('kdtree', 'balltree'):
+            grid = [{'leaf_size': leaf_size} for leaf_size in leaf_sizes]
+        elif engine == 'ivf':
+            grid = [{'n_probe': n_probe, 'seed': seed} for n_probe in n_probes]
+        elif engine == 'quantized':  # the re-rank does not change the exact float32 scan
+            grid = [
+                {'precision': precision, 'rerank': rerank, 'seed': seed}
+                for precision, rerank in itertools.product(precisions, reranks)
+                if precision != 'float32' or rerank == reranks[0]
+            ]
+        else:
+            grid = [{}]
+
+        configs.extend({'n_components': n, 'engine': engine, 'params': params} for params in grid)
+
+    return configs
+
+
+def evaluate(config: dict, k: int = 10, n_latency: int = 200) -> dict:
+    """
+    Build the index of the configuration and benchmark it, runs in a worker process
+    :param config: n_components, engine and params
+    :param k: number of the neighbours, the query point itself is not counted
+    :param n_latency: number of the single queries timed for the latency percentiles
+    :return: the configuration along with its metrics
+    """
+    data = np.ascontiguousarray(_features[:, :config['n_components']])
+    queries = data[_queries]
+
+    start = time.perf_counter()
+    index = build_index(data, engine=config['engine'], **config['params'])
+    build_time = time.perf_counter() - start
+
+    found = index.query(queries, k=k + 1, return_distance=False)[:, 1:]
+    exact = BruteForceIndex().fit(data).query(queries, k=k + 1, return_distance=False)[:, 1:]
+
+    for query in queries[:10]:  # warm up the caches first
+        index.query(query[None, :], k=k + 1, return_distance=False)
+
+    latencies = []
+    for query in queries[:n_latency]:  # one seed at a time, as the API queries them
+        start = time.perf_counter()
+        index.query(query[None, :], k=k + 1, return_distance=False)
+        latencies.append(time.perf_counter() - start)
+
+    p50, p95, p99 = np.percentile(np.asarray(latencies) * 1e6, [50, 95, 99])
+
+    # the quantized engines only read the full precision rows of the re-ranked candidates
+    index_bytes = int(sum(array.nbytes for array in index.get_arrays().values()))
+    scans_codes = config['engine'] == 'quantized' and config['params'].get('precision', 'int8') != 'float32'
+
+    return {
+        **config
+        , 'build_time_s': round(build_time, 4)
+        , 'index_bytes': index_bytes
+        , 'memory_bytes': index_bytes + (0 if scans_codes else data.nbytes)  # what a query scan keeps resident
+        , 'latency_us': {'p50': round(float(p50), 1), 'p95': round(float(p95), 1), 'p99': round(float(p99), 1)}
+        , f'recall@{k}': round(_recall(found, _truth[:, :k]), 4)  # against all the features
+        , f'index_recall@{k}': round(_recall(found, exact), 4)  # against the exact search in the same projection
+    }
+
+
+def select_best(results: list[dict], k: int, max_p95_us: float = None) -> dict:
+    """
+    Pick the configuration with the best recall within the latency budget, the ties are broken by the p95 latency
+    :param results: the evaluated configurations
+    :param k: number of the neighbours the recall was measured at
+    :param max_p95_us: the latency budget, no budget if None
+    :return: the best configuration
+    """
+    eligible = [
+        result for result in results if max_p95_us is None or result['latency_us']['p95'] <= max_p95_us
+    ] or results  # nothing fits the budget, fall back to all of them
+
+    return max(eligible, key=lambda result: (result[f'recall@{k}'], -result['latency_us']['p95']))
+
+
+def write_report(report: dict, path: str = None) -> str:
+    """Write the report as JSON and as a Markdown table, return the JSON's path"""
+    path = path or reports_path
+    os.makedirs(path, exist_ok=True)
+
+    name = os.path.join(path, time.strftime('%Y%m%dT%H%M%S'))
+    with open(f'{name}.json', 'w') as f:
+        json.dump(report, f, indent=2)
+
+    k = report['k']
+    lines = [
+        f"| n_components | engine | params | build (s) | index (MiB) | memory (MiB) | p50 (us) | p95 (us) | p99 (us) "
+        f"| recall@{k} | index recall@{k} |"
+        , '|' + '---|' * 11
+    ]
+    for result in sorted(report['results'], key=lambda result: -result[f'recall@{k}']):
+        lines.append(
+            f"| {result['n_components']} | {result['engine']} | {json.dumps(result['params'])} "
+            f"| {result['build_time_s']} | {result['index_bytes'] / 2 ** 20:.2f} "
+            f"| {result['memory_bytes'] / 2 ** 20:.2f} "
+            f"| {result['latency_us']['p50']} | {result['latency_us']['p95']} | {result['latency_us']['p99']} "
+            f"| {result[f'recall@{k}']} | {result[f'index_recall@{k}']} |"
+        )
+    lines.append(f"\nBest: {json.dumps({key: report['best'][key] for key in ('n_components', 'engine', 'params')})}")
+
+    with open(f'{name}.md', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    return f'{name}.json'
+
+
+def sweep(
+        df
+        , configs: list[dict]
+        , k: int = 10
+        , n_queries: int = 1000
+        , n_latency: int = 200
+        , jobs: int = None
+        , seed: int = 0
+) -> list[dict]:
+    """
+    Evaluate all the configurations in parallel
+    :param df: pandas' DataFrame with the training features
+    :param configs: the configurations, see configurations()
+    :param k: number of the neighbours
+    :param n_queries: number of the tracks sampled as the queries for the recall
+    :param n_latency: number of the single queries timed for the latency percentiles
+    :param jobs: number of the worker processes, all the cores if None
+    :param seed: seed of the query sample
+    :return: the configurations along with their metrics, in the input order
+    """
+    # all the components are an orthogonal rotation of the scaled features, so they double as the ground truth space
+    features, _ = Recommender._preprocess_data(df, n_components=df.shape[1])
+    features = np.ascontiguousarray(features.to_numpy(), dtype=np.float32)
+
+    rng = np.random.default_rng(seed)
+    queries = np.sort(rng.choice(len(features), size=min(n_queries, len(features)), replace=False))
+    truth = BruteForceIndex().fit(features).query(features[queries], k=k + 1, return_distance=False)[:, 1:]
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(features, queries, truth)) as pool:
+        futures = [pool.submit(evaluate, config, k=k, n_latency=n_latency) for config in configs]
+
+        results = []
+        for config, future in zip(configs, futures):
+            results.append(future.result())
+            print(f"{config['n_components']:>2} {config['engine']:<8} {json.dumps(config['params']):<28} done")
+
+    return results
+
+
+def main(argv: list[str] = None) -> dict:
+    parser = argparse.ArgumentParser(description='Sweep the model configurations and promote the best one')
+    parser.add_argument('--n-components', type=int, nargs='+', default=[4, 6, 8])
+    parser.add_argument('--engines', nargs='+', default=list(ENGINES), choices=list(ENGINES))
+    parser.add_argument('--leaf-size', type=int, nargs='+', default=[7, 20, 40])
+    parser.add_argument('--n-probe', type=int, nargs='+', default=[4, 8, 16])
+    parser.add_argument(
+        '--precisions', nargs='+', default=list(QuantizedIndex.precisions), choices=QuantizedIndex.precisions
+    )
+    parser.add_argument('--rerank', type=int, nargs='+', default=[0, 4], help='candidates re-ranked exactly, per k')
+    parser.add_argument('-k', type=int, default=10, help='number of the neighbours the recall is measured at')
+    parser.add_argument('--n-queries', type=int, default=1000)
+    parser.add_argument('--n-latency', type=int, default=200)
+    parser.add_argument('--max-p95-us', type=float, default=None, help='latency budget of the best configuration')
+    parser.add_argument('--jobs', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-promote', action='store_true', help='only write the report')
+    parser.add_argument(
+        '--neighbours-k', type=int, default=int(os.environ.get('RECOMMENDER_NEIGHBOURS_K', 50))
+        , help='depth of the neighbour table published with the promoted model, 0 to publish none'
+    )
+    args = parser.parse_args(argv)
+
+    recommender = Recommender(reuse_model=False)
+    configs = configurations(
+        args.n_components, args.engines, args.leaf_size, args.n_probe, seed=args.seed, precisions=args.precisions
+        , reranks=args.rerank
+    )
+
+    results = sweep(
+        recommender._df, configs, k=args.k, n_queries=args.n_queries, n_latency=args.n_latency, jobs=args.jobs
+        , seed=args.seed
+    )
+    best = select_best(results, k=args.k, max_p95_us=args.max_p95_us)
+
+    report = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z')
+        , 'arguments': vars(args)
+        , 'environment': {
+            'python': sys.version.split()[0], 'numpy': np.__version__, 'sklearn': sklearn.__version__
+            , 'cpus': os.cpu_count()
+        }
+        , 'n_rows': len(recommender._df)
+        , 'k': args.k
+        , 'results': results
+        , 'best': best
+    }
+
+    if not args.no_promote:
+        params = dict(best['params'])
+        recommender.train(
+            n_dimensions=best['n_components']
+            , leaf_size=params.pop('leaf_size', 7)
+            , engine=best['engine']
+            , **params
+        )
+        recommender.save()
+        report['promoted_version'] = recommender.version
+
+        # the new model has no neighbour table yet, it is published as the next version, see ml/neighbours.py
+        if args.neighbours_k:
+            artifact = publish_neighbours(root=recommender._artifacts_path, k=args.neighbours_k, jobs=args.jobs)
+            report['promoted_version'] = artifact.version
+
+    print(f'Report written into {write_report(report)}')
+
+    return report
+
+
+if __name__ == '__main__':
+    main()
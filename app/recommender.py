@@ -1,6 +1,10 @@
 import os
 import sys
+import json
 import pickle
+import time
+import threading
+from typing import NamedTuple
 
 import numpy as np
 import pandas as pd
@@ -10,11 +14,32 @@ from sklearn.preprocessing import StandardScaler
 from sklearn.decomposition import PCA
 from sklearn.neighbors import KDTree
 from db.db_handler import DB
+from db.snapshot import Snapshot
+from db.catalog import TrackFilter
+from ml.engines import ENGINES, NeighbourIndex, KDTreeIndex, BruteForceIndex, build_index
+from ml.artifacts import ModelArtifact
+from ml.delta import Projection, DeltaIndex
+from ml.neighbours import publish as publish_neighbours
+from utils.cache import LRUCache
+from utils.metrics import stage, MODEL_ROWS, MODEL_BYTES, MODEL_LOAD_SECONDS, DELTA_ROWS, NEIGHBOUR_LOOKUPS
 
 
 load_dotenv()
 
 
+class IndexState(NamedTuple):
+    """
+    Everything the requests read, swapped at once, the rows past the main index belong to the delta index
+    """
+    model: NeighbourIndex
+    vectors: np.ndarray  # main index' vectors
+    positions: dict[str, int]  # track id -> row
+    row_idx: np.ndarray  # row -> catalog idx
+    delta: DeltaIndex
+    neighbours: tuple[np.ndarray, np.ndarray] | None = None  # main row -> its precomputed neighbours' rows, distances
+    partitions: LRUCache | None = None  # filter's partition name -> (its rows, their sub-index), built on the first use
+
+
 class Recommender(DB):
     """
     A class that handles the recommendation engine, extends the parent DB class, inherits all public methods
@@ -23,39 +48,97 @@ class Recommender(DB):
     Attributes
     ----------
     :param reuse_model: whether to reuse an existing model and data, or to train a new one
-    :param filename: the path to the model if you wish to reuse existing one, unnecessary otherwise
+    :param filename: the path to a legacy pickled model, only used if there is no published model artifact
+    :param artifacts_path: the directory with the model artifacts, ml/artifacts by default
 
     Methods
     -------
-    train(n_dimensions: int = 6, leaf_size: int = 7) -> None:
-        Train the KDTree model, use the preprocessed data from the SQL DB
+    train(n_dimensions: int = 6, leaf_size: int = 7, engine: str = None, **engine_params) -> None:
+        Train the nearest neighbours model, use the preprocessed data from the SQL DB
     save() -> None:
-        Serialise the model and create a table with the training data for future recommendations
-    recommend(ids: list[str], n_recs: int) -> np.ndarray:
+        Publish the model as a new artifact and create a table with the training data for future recommendations,
+        publishes a new catalog version
+    load_artifact(version: str = None) -> None:
+        Load the given or the currently published model artifact
+    refresh() -> bool:
+        Load the published model artifact if it differs from the loaded one
+    locate(ids: list[str]) -> tuple[np.ndarray, list[str]]:
+        Find the row positions of the provided track IDs, report the unknown ones
+    recommend(ids: list[str], n_recs: int, return_unknown: bool = False, ...) -> np.ndarray:
         Recommend tracks based on provided track IDs
+    recommend_batch(seeds: list[list[str]], n_recs: int, return_unknown: bool = False) -> list[np.ndarray]:
+        Recommend tracks for many independent lists of track IDs at once
+    recommend_many(requests: list[tuple[list[str], int]]) -> list[tuple[np.ndarray, list[str]]]:
+        Answer many independent .recommend() calls with a single neighbour query
+    recommend_taste(ids: list[str], n_recs: int, method: str = 'rrf', weights: list[float] = None, ...) -> np.ndarray:
+        Recommend a single ranked list of tracks for the whole seed set
+    recommend_stream(ids: list[str], depth: int, mode: str = 'per_seed', ...) -> tuple[np.ndarray, list[str], bool]:
+        Rank the tracks for the seed set as a single stream, e.g. to serve it page by page
+    add_tracks(df: pd.DataFrame, publish: bool = False) -> None:
+        Add new or changed tracks to the delta index
+    update_from_changeset(path: str, publish: bool = False) -> int:
+        Add the tracks of an ETL changeset to the delta index
+    compact(publish: bool = False, background: bool = False) -> None:
+        Merge the delta into the main index
+    publish_delta() -> None:
+        Publish the delta index on top of the current model artifact
     """
-    def __init__(self, reuse_model: bool = True, filename: str = 'ml/kdt.pkl'):
+    fusion_methods = ('centroid', 'rrf', 'distance')
+    filter_exact_limit = 8192  # the filters passed by at most this many tracks are searched exhaustively
+    rrf_k = 60  # the reciprocal rank fusion's constant, damps the weight of the top ranks
+
+    def __init__(self, reuse_model: bool = True, filename: str = 'ml/kdt.pkl', artifacts_path: str = None):
         base_path = os.path.dirname(__file__)
         model_path = os.path.join(base_path, filename)
 
+        self._artifacts_path = artifacts_path or ModelArtifact.default_root
+        self._artifact = None
+        self._projection = None
+        self._neighbours = None
+        self._write_lock = threading.Lock()
+        self._compaction = None
+        self._compacted = False  # whether the main index has changed since the artifact was published
+        self._refresh_interval = float(os.environ.get('RECOMMENDER_REFRESH_INTERVAL', 5))
+        self._last_check = time.monotonic()
+        self.compact_threshold = int(os.environ.get('RECOMMENDER_COMPACT_THRESHOLD', 10_000))
+        self.version = None
+
+        if reuse_model and ModelArtifact.current_version(self._artifacts_path):
+            self.load_artifact()
+            return
+
         if reuse_model and os.path.isfile(model_path):
             with open(model_path, 'rb') as f:
                 self.model = pickle.load(f)
+
+            if isinstance(self.model, KDTree):  # a model pickled before the engines were introduced
+                self.model = KDTreeIndex.from_tree(self.model)
         elif reuse_model and not os.path.isfile(model_path):
             raise FileNotFoundError(f'There is no pickle file in the provided path: {model_path}')
         else:
             self.model = None
 
-        if reuse_model and self.table_exists('pr_comps'):  # reuse the existing data
+        # the columnar snapshot is read instead of the DB, if it has been exported for the current catalog version
+        snapshot = Snapshot.current(catalog_version=self.catalog_version())
+
+        if reuse_model and snapshot is not None and snapshot.has('pr_comps'):
+            self.data = snapshot.read_pandas('pr_comps').set_index('track_id')
+            self._row_idx = np.arange(len(self.data))  # the legacy tables are aligned with the idx
+        elif reuse_model and self.table_exists('pr_comps'):  # reuse the existing data
             self.data = self.__class__.query_table(
                 table_name='pr_comps'
             ).set_index('track_id')
+            self._row_idx = np.arange(len(self.data))  # the legacy tables are aligned with the idx
         else:
             self.data = pd.DataFrame()
 
-            df = self.__class__.query_table(
-                table_name='tracks'
-            )
+            if snapshot is not None and snapshot.has('tracks'):  # only the numeric columns are decoded
+                df = snapshot.read_pandas('tracks', columns=['track_id', *snapshot.numeric_columns('tracks')])
+            else:
+                df = self.__class__.query_table(
+                    table_name='tracks'
+                )
+            self._row_idx = df['idx'].to_numpy(dtype=np.int64)
 
             self._df = (
                 df
@@ -64,14 +147,260 @@ class Recommender(DB):
                 .drop(columns=['key', 'time_signature', 'album_id', 'idx'])
             )
 
+        self._build_lookup()
+
+    def load_artifact(self, version: str = None) -> None:
+        """
+        Load the model and its data from the artifact, the arrays are memory-mapped, not copied
+        :param version: the version to load, the currently published one if None
+        :return: void function
+        """
+        start = time.perf_counter()
+        artifact = ModelArtifact.load(root=self._artifacts_path, version=version)
+        extras, metadata = artifact.extras, artifact.manifest.get('metadata', {})
+
+        self.model = artifact.model
+        self.data = pd.DataFrame(
+            artifact.features
+            , columns=artifact.manifest['columns']
+            , index=pd.Index(artifact.ids, name='track_id')
+            , copy=False
+        )
+        self._row_idx = extras.get('row_idx', np.arange(len(self.data)))
+
+        self._neighbours = None
+        if 'neighbour_rows' in extras and len(extras['neighbour_rows']) == len(self.data):
+            self._neighbours = (extras['neighbour_rows'], extras['neighbour_distances'])
+
+        if 'projection_columns' in metadata:
+            self._projection = Projection(
+                columns=metadata['projection_columns']
+                , arrays={name: extras[name] for name in ('scaler_mean', 'scaler_scale', 'pca_mean', 'pca_components')}
+            )
+
+        delta = None
+        if 'delta_ids' in extras:
+            delta = DeltaIndex(
+                n_main=len(self.data)
+                , ids=extras['delta_ids'].tolist()
+                , vectors=np.asarray(extras['delta_vectors'])
+                , row_idx=np.asarray(extras['delta_row_idx'])
+                , tombstones=np.asarray(extras['tombstones'])
+            )
+
+        self._artifact = artifact
+        self.version = artifact.version
+
+        self._build_lookup(delta=delta)
+        MODEL_LOAD_SECONDS.set(time.perf_counter() - start)
+
+    def refresh(self) -> bool:
+        """
+        Load the newly published model artifact, if any, at most once per RECOMMENDER_REFRESH_INTERVAL seconds
+        :return: True if a new artifact has been loaded, False otherwise
+        """
+        if time.monotonic() - self._last_check < self._refresh_interval or self._artifact is None:
+            return False
+
+        # another thread is already on it, or the index is being updated
+        if not self._write_lock.acquire(blocking=False):
+            return False
+
+        try:
+            self._last_check = time.monotonic()
+
+            version = ModelArtifact.current_version(self._artifacts_path)
+            if version is None or version == self.version:
+                return False
+
+            self.load_artifact(version=version)
+        finally:
+            self._write_lock.release()
+
+        return True
+
+    def _build_lookup(self, delta: DeltaIndex = None) -> None:
+        """
+        Precompute the track id -> row mapping and a contiguous float32 copy of the data, so that the requests gather
+            the seed vectors by position instead of scanning the DataFrame. The new state replaces the old one at once
+        :param delta: the delta index to search alongside the main one, none if None
+        :return: void function
+        """
+        vectors = np.ascontiguousarray(self.data.to_numpy(), dtype=np.float32)
+        positions = {track_id: pos for pos, track_id in enumerate(self.data.index)}
+        row_idx = np.asarray(self._row_idx, dtype=np.int64)
+
+        if delta is None:
+            delta = DeltaIndex(n_main=len(vectors))
+        else:
+            for pos in delta.tombstones:
+                positions.pop(self.data.index[pos], None)
+            positions.update({track_id: len(vectors) + i for i, track_id in enumerate(delta.ids)})
+            row_idx = np.concatenate([row_idx, delta.row_idx])
+
+        self._state = IndexState(
+            model=self.model, vectors=vectors, positions=positions, row_idx=row_idx, delta=delta
+            , neighbours=self._neighbours, partitions=LRUCache(maxsize=256)
+        )
+
+        MODEL_ROWS.set(len(vectors))
+        MODEL_BYTES.set(
+            vectors.nbytes + (sum(a.nbytes for a in self.model.get_arrays().values()) if self.model else 0)
+        )
+        DELTA_ROWS.set(len(delta))
+
+    @staticmethod
+    def _gather(state: IndexState, rows: np.ndarray) -> np.ndarray:
+        """Gather the vectors of the given rows from the main and the delta index"""
+        n_main = state.delta.n_main
+        if not len(state.delta) or rows.max(initial=-1) < n_main:
+            return state.vectors[rows]
+
+        vectors = np.empty((len(rows), state.vectors.shape[1]), dtype=np.float32)
+        in_main = rows < n_main
+        vectors[in_main] = state.vectors[rows[in_main]]
+        vectors[~in_main] = state.delta.vectors[rows[~in_main] - n_main]
+
+        return vectors
+
+    @staticmethod
+    def _query(state: IndexState, X: np.ndarray, k: int) -> np.ndarray:
+        """Find the k nearest rows, searches the delta index as well if there is any"""
+        if len(state.delta) or len(state.delta.tombstones):
+            return state.delta.query(state.model, X, k=k)[1]
+
+        return state.model.query(X, k=k, return_distance=False)
+
+    @classmethod
+    def _lookup_neighbours(cls, state: IndexState, positions: np.ndarray, k: int) -> np.ndarray:
+        """
+        Find the k nearest rows of the given rows, the rows themselves excluded, from the precomputed table if it is
+            deep enough, from the index otherwise
+        :param state: the index state
+        :param positions: the seeds' rows
+        :param k: number of neighbours
+        :return: the neighbours' rows, one row per seed
+        """
+        table, delta = state.neighbours, state.delta
+        if table is None or k > table[0].shape[1] or positions.max(initial=-1) >= delta.n_main:
+            NEIGHBOUR_LOOKUPS.inc(len(positions), source='index')
+            return cls._query(state, cls._gather(state, positions), k=k + 1)[:, 1:]  # don't return the point itself
+
+        rows, distances = table[0][positions, :k], table[1][positions, :k]
+        if not len(delta) and not len(delta.tombstones):
+            NEIGHBOUR_LOOKUPS.inc(len(positions), source='table')
+            return rows.astype(np.int64)
+
+        distances = distances.astype(np.float32)
+        if len(delta.tombstones):
+            distances[np.isin(rows, delta.tombstones)] = np.inf
+            if (np.isfinite(distances).sum(axis=1) < min(k, delta.n_main - len(delta.tombstones) - 1)).any():
+                NEIGHBOUR_LOOKUPS.inc(len(positions), source='index')  # too many of them have been replaced
+                return cls._query(state, cls._gather(state, positions), k=k + 1)[:, 1:]
+
+        delta_distances, delta_rows = delta.search(state.vectors[positions], k=k)
+        distances = np.hstack([distances, delta_distances])
+        rows = np.hstack([rows.astype(np.int64), delta_rows])
+
+        k = min(k, delta.n_main - len(delta.tombstones) - 1 + len(delta))
+        order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+        NEIGHBOUR_LOOKUPS.inc(len(positions), source='table')
+
+        return np.take_along_axis(rows, order, axis=1)
+
     @staticmethod
-    def _preprocess_data(df: pd.DataFrame, n_components: int = 6) -> pd.DataFrame:
+    def _allowed_rows(state: IndexState, mask: np.ndarray) -> np.ndarray:
+        """Translate a mask over the catalog idx into a mask over the rows, the tombstoned rows never pass"""
+        allowed = np.zeros(len(state.row_idx), dtype=bool)
+        in_catalog = state.row_idx < len(mask)
+        allowed[in_catalog] = mask[state.row_idx[in_catalog]]
+        allowed[state.delta.tombstones] = False
+
+        return allowed
+
+    @classmethod
+    def _partition(cls, state: IndexState, track_filter: TrackFilter) -> tuple[np.ndarray, NeighbourIndex]:
+        """Get the rows and the sub-index of the filter's partition, it is built on the first use"""
+        partition = state.partitions.get(track_filter.partition)
+
+        if partition is None:
+            rows = np.flatnonzero(cls._allowed_rows(state, track_filter.partition_mask))
+            vectors = cls._gather(state, rows)
+            if len(rows) <= cls.filter_exact_limit:
+                index = BruteForceIndex().fit(vectors)
+            else:
+                index = ENGINES[state.model.name](**state.model.get_params()).fit(vectors)
+
+            partition = (rows, index)
+            state.partitions.set(track_filter.partition, partition)
+
+        return partition
+
+    @classmethod
+    def _filtered_query(
+            cls
+            , state: IndexState
+            , X: np.ndarray
+            , k: int
+            , track_filter: TrackFilter
+            , exclude: np.ndarray = None
+    ) -> np.ndarray:
+        """
+        Find the k nearest rows that pass the filter. The search starts as deep as the filter's selectivity suggests
+            and is doubled until every query has k passing rows, or the whole index has been searched
+        :param state: the index state
+        :param X: the query vectors
+        :param k: number of neighbours
+        :param track_filter: the filter resolved by the catalog
+        :param exclude: a row to leave out per query, e.g. the seed itself
+        :return: the rows, one row per query, -1 where fewer than k rows pass the filter
+        """
+        allowed = cls._allowed_rows(state, track_filter.allowed)
+        n_allowed = int(allowed.sum())
+
+        if track_filter.partition is not None:
+            rows, index = cls._partition(state, track_filter)
+            n_searched = len(rows)
+            search = lambda depth: rows[index.query(X, k=depth, return_distance=False)]
+        elif n_allowed <= cls.filter_exact_limit:
+            rows = np.flatnonzero(allowed)
+            index = BruteForceIndex().fit(cls._gather(state, rows))
+            n_searched = len(rows)
+            search = lambda depth: rows[index.query(X, k=depth, return_distance=False)]
+        else:
+            n_searched = len(state.row_idx) - len(state.delta.tombstones)
+            search = lambda depth: cls._query(state, X, k=depth)
+
+        neighbours = np.full((len(X), k), -1, dtype=np.int64)
+        if not n_allowed or not n_searched or not k:
+            return neighbours
+
+        needed = k + (exclude is not None)
+        depth = min(n_searched, max(needed, int(np.ceil(1.5 * needed * n_searched / n_allowed))))
+        while True:
+            found = search(depth)
+            passed = allowed[found]
+            if exclude is not None:
+                passed &= found != exclude[:, None]
+
+            if depth >= n_searched or (passed.sum(axis=1) >= k).all():
+                break
+            depth = min(n_searched, 2 * depth)
+
+        order = np.argsort(~passed, axis=1, kind='stable')[:, :k]  # the passing rows first, in the order of distance
+        found, passed = np.take_along_axis(found, order, axis=1), np.take_along_axis(passed, order, axis=1)
+        neighbours[:, :found.shape[1]] = np.where(passed, found, -1)
+
+        return neighbours
+
+    @staticmethod
+    def _preprocess_data(df: pd.DataFrame, n_components: int = 6) -> tuple[pd.DataFrame, Projection]:
         """
         Preprocesses the given data by scaling it and computing the principal components
         :param df: pandas' DataFrame to preprocess
         :param n_components: number of principal components to retain, minimum 1, maximum 14. The model performance
             may decrease with increasing number of parameters
-        :return: a processed DataFrame
+        :return: a processed DataFrame and the frozen projection that produced it
         """
         scaler = StandardScaler()
         pca = PCA()
@@ -84,31 +413,44 @@ class Recommender(DB):
 
         p_comps = pd.DataFrame(
             pca.fit_transform(df_scaled)[:, :n_components]
-            , columns=[f'PC{i+1}' for i in range(6)]
+            , columns=[f'PC{i+1}' for i in range(n_components)]
             , index=df_scaled.index
         )
 
-        return p_comps
+        return p_comps, Projection.from_fitted(df.columns.tolist(), scaler=scaler, pca=pca, n_components=n_components)
 
-    def train(self, n_dimensions: int = 6, leaf_size: int = 7) -> None:
+    def train(self, n_dimensions: int = 6, leaf_size: int = 7, engine: str = None, **engine_params) -> None:
         """
-        Train the KDTree model, uses the preprocessed data from the SQL DB
-        :param n_dimensions:
-        :param leaf_size:
-        :return:
+        Train the nearest neighbours model, uses the preprocessed data from the SQL DB
+        :param n_dimensions: number of principal components to use
+        :param leaf_size: leaf size of the tree engines, ignored by the others
+        :param engine: the nearest neighbours engine, RECOMMENDER_ENGINE or kdtree if None
+        :param engine_params: engine specific parameters, RECOMMENDER_ENGINE_PARAMS are used if neither the engine nor
+            its parameters are given
+        :return: void function, the engine and its parameters are persisted along with the model by .save()
         """
-        self.data = self._preprocess_data(self._df, n_components=n_dimensions)
+        self.data, self._projection = self._preprocess_data(self._df, n_components=n_dimensions)
+
+        if engine is None:
+            engine = os.environ.get('RECOMMENDER_ENGINE', 'kdtree')
+            if not engine_params:  # the parameters only make sense along with the configured engine
+                engine_params = json.loads(os.environ.get('RECOMMENDER_ENGINE_PARAMS', '{}'))
+        if engine in ('kdtree', 'balltree'):
+            engine_params.setdefault('leaf_size', leaf_size)
 
-        self.model = KDTree(self.data, leaf_size=leaf_size)
+        self.model = build_index(self.data.to_numpy(), engine=engine, **engine_params)
+        self._neighbours = None
+        self._build_lookup()
 
     def save(self) -> None:
         """
-        Save the model as serialised object and the training data as an SQL table
-        :return: void function, creates a .pkl object in the /ml directory, and pr_comps table in the DB
+        Publish the model (including the engine and its parameters) as a new memory-mappable artifact and save the
+        training data as an SQL table
+        :return: void function, creates a new version in the ml/artifacts directory, and pr_comps table in the DB and
+            in the columnar snapshot
         """
         if self.model:
-            with open('ml/kdt.pkl', 'wb') as f:
-                pickle.dump(self.model, f)
+            self._publish_artifact()
 
         if not self.data.empty:
             try:
@@ -122,14 +464,90 @@ class Recommender(DB):
                     )
             except exc.OperationalError as e:
                 print(f'Trouble connecting to the database, {e}')
+            else:
+                previous = self.catalog_version()
+                version = self.publish_catalog()
+
+                if Snapshot.available():  # the rest of the snapshot is still valid, only the features are new
+                    Snapshot.publish(
+                        {'pr_comps': self.data.reset_index()}, catalog_version=version, formats={'pr_comps': 'arrow'}
+                        , carry_over=previous
+                    )
+            finally:
+                self.invalidate_schema_cache(table_name='pr_comps')
+
+    def _artifact_extras(self) -> tuple[dict[str, np.ndarray], dict]:
+        """Get the additional arrays and the metadata to publish along with the model"""
+        state = self._state
+        extras = {'row_idx': state.row_idx[:state.delta.n_main]}
+        metadata = {}
+
+        if state.neighbours is not None:  # still valid, the main index has not changed
+            extras.update({'neighbour_rows': state.neighbours[0], 'neighbour_distances': state.neighbours[1]})
+
+        if self._projection is not None:
+            extras.update(self._projection.arrays)
+            metadata['projection_columns'] = self._projection.columns
+
+        if len(state.delta) or len(state.delta.tombstones):
+            extras.update({
+                'delta_ids': np.asarray(state.delta.ids, dtype=str)
+                , 'delta_vectors': state.delta.vectors
+                , 'delta_row_idx': state.delta.row_idx
+                , 'tombstones': state.delta.tombstones
+            })
+
+        return extras, metadata
+
+    def _publish_artifact(self) -> None:
+        """Publish the current model, its data and the delta index as a new artifact"""
+        extras, metadata = self._artifact_extras()
+
+        self._artifact = ModelArtifact.publish(
+            ids=self.data.index.to_numpy()
+            , features=self.data.to_numpy()
+            , columns=self.data.columns.tolist()
+            , model=self.model
+            , root=self._artifacts_path
+            , extras=extras
+            , metadata=metadata
+        )
+        self.version = self._artifact.version
+        self._compacted = False
 
-    def recommend(self, ids: list[str], n_recs: int) -> np.ndarray:
+    def locate(self, ids: list[str]) -> tuple[np.ndarray, list[str]]:
         """
-        Recommend tracks using KDTree model, bases the recommendations on provided track ids. Please consider
-        training the model first before you run this method, unless you have a pickled model in the directory.
+        Find the row positions of the provided track ids
+        :param ids: list of track ids
+        :return: the positions of the known ids in the order of the input, and the list of the unknown ids
+        """
+        positions = self._locate(self._state, ids)
+        unknown = [track_id for track_id, pos in zip(ids, positions) if pos < 0]
+
+        return positions[positions >= 0], unknown
+
+    @staticmethod
+    def _locate(state: IndexState, ids: list[str]) -> np.ndarray:
+        """Find the rows of the provided track ids, -1 for the unknown ones"""
+        return np.fromiter((state.positions.get(track_id, -1) for track_id in ids), dtype=np.int64, count=len(ids))
+
+    def recommend(
+            self
+            , ids: list[str]
+            , n_recs: int
+            , return_unknown: bool = False
+            , track_filter: TrackFilter = None
+    ) -> np.ndarray | tuple[np.ndarray, list[str]]:
+        """
+        Recommend tracks using the nearest neighbours model, bases the recommendations on provided track ids. Please
+        consider training the model first before you run this method, unless you have a published model artifact.
         :param ids: list of track ids, please note that you should parse list even if it is one value
         :param n_recs: number of recommendations to return
-        :return: ids of the closest neighbours, where each row represents recommendations for the respective ID
+        :param return_unknown: whether to return the list of ids that are not known to the model as well
+        :param track_filter: only recommend the tracks that pass the filter, see Catalog.filter()
+        :return: catalog idx of the closest neighbours, where each row represents recommendations for the respective
+            known ID in the order of the input, -1 where fewer than n_recs tracks pass the filter, (recommendations,
+            unknown ids) if return_unknown is True
         """
         if not self.model:
             raise ValueError(f'Recommender model does not exist, please consider training it first using .train()')
@@ -137,18 +555,435 @@ class Recommender(DB):
         if not isinstance(ids, list):
             raise ValueError(f'ids should be a list of string, you provided {type(ids)}')
 
-        data = self.data[self.data.index.isin(ids)]
+        state = self._state
+        with stage(stage='locate'):
+            positions = self._locate(state, ids)
+        unknown = [track_id for track_id, pos in zip(ids, positions) if pos < 0]
+        positions = positions[positions >= 0]
 
-        kdt = self.model
-        recs_idx = kdt.query(data, k=n_recs + 1, return_distance=False)
+        if positions.size:
+            with stage(stage='query'):
+                if track_filter is None:
+                    rows = self._lookup_neighbours(state, positions, k=n_recs)
+                else:
+                    rows = self._filtered_query(
+                        state, self._gather(state, positions), k=n_recs, track_filter=track_filter, exclude=positions
+                    )
+            recs_idx = np.where(rows >= 0, state.row_idx[rows], -1)
+        else:
+            recs_idx = np.empty((0, n_recs), dtype=np.int64)
 
-        return recs_idx[:, 1:]  # don't return the point itself
+        if return_unknown:
+            return recs_idx, unknown
+
+        return recs_idx
+
+    def recommend_batch(
+            self
+            , seeds: list[list[str]]
+            , n_recs: int
+            , return_unknown: bool = False
+    ) -> list[np.ndarray] | tuple[list[np.ndarray], list[list[str]]]:
+        """
+        Recommend tracks for many independent seed lists with a single tree query. The neighbours of every seed list
+        are deduplicated and the seeds themselves are excluded from their own list
+        :param seeds: a list of seed lists, where each seed list is a list of track ids
+        :param n_recs: number of recommendations to return per seed track
+        :param return_unknown: whether to return the ids that are not known to the model per seed list as well
+        :return: a list of arrays with the recommended catalog idx, one array per seed list, ordered by the seeds,
+            (recommendations, unknown ids per seed list) if return_unknown is True
+        """
+        if not self.model:
+            raise ValueError(f'Recommender model does not exist, please consider training it first using .train()')
+
+        if not isinstance(seeds, list) or not all(isinstance(ids, list) for ids in seeds):
+            raise ValueError(f'seeds should be a list of lists of strings, you provided {type(seeds)}')
+
+        state = self._state
+        lengths = np.fromiter((len(ids) for ids in seeds), dtype=np.int64, count=len(seeds))
+        groups = np.repeat(np.arange(len(seeds)), lengths)
+        with stage(stage='locate'):
+            positions = self._locate(state, [track_id for ids in seeds for track_id in ids])
+        unknown = [[track_id for track_id in ids if track_id not in state.positions] for ids in seeds]
+
+        known = positions >= 0  # unknown ids are marked with -1
+        groups, positions = groups[known], positions[known]
+
+        if not positions.size:
+            blocks = [np.empty(0, dtype=np.int64) for _ in seeds]
+            return (blocks, unknown) if return_unknown else blocks
+
+        with stage(stage='query'):
+            recs_idx = self._lookup_neighbours(state, positions, k=n_recs)
+
+        rec_groups = np.repeat(groups, recs_idx.shape[1])
+        recs_idx = recs_idx.ravel()
+
+        # drop the seeds from their own seed list, then the duplicates within every seed list
+        n_rows = len(state.row_idx)
+        is_seed = np.isin(rec_groups * n_rows + recs_idx, groups * n_rows + positions)
+        rec_groups, recs_idx = rec_groups[~is_seed], recs_idx[~is_seed]
+
+        _, first = np.unique(rec_groups * n_rows + recs_idx, return_index=True)
+        first.sort()  # keep the order of the first occurrence
+        rec_groups, recs_idx = rec_groups[first], recs_idx[first]
+
+        bounds = np.searchsorted(rec_groups, np.arange(len(seeds) + 1))
+        blocks = [state.row_idx[recs_idx[start:end]] for start, end in zip(bounds[:-1], bounds[1:])]
+
+        if return_unknown:
+            return blocks, unknown
+
+        return blocks
+
+    def recommend_many(self, requests: list[tuple[list[str], int]]) -> list[tuple[np.ndarray, list[str]]]:
+        """
+        Answer many independent .recommend() calls with a single neighbour query, e.g. the concurrent API requests
+        collected by utils/coalescer.py. The query is as deep as the deepest call, the others get its first columns
+        :param requests: (ids, n_recs) pairs
+        :return: (recommendations, unknown ids) per request, exactly what .recommend(ids, n_recs, True) returns
+        """
+        if not self.model:
+            raise ValueError(f'Recommender model does not exist, please consider training it first using .train()')
+
+        if any(n_recs < 0 for _, n_recs in requests):
+            raise ValueError('n_recs must not be negative')
+
+        state = self._state
+        with stage(stage='locate'):
+            positions = self._locate(state, [track_id for ids, _ in requests for track_id in ids])
+
+        known = positions >= 0
+        k = max((n_recs for _, n_recs in requests), default=0)
+        if known.any():
+            with stage(stage='query'):
+                rows = self._lookup_neighbours(state, positions[known], k=k)
+        else:
+            rows = np.empty((0, k), dtype=np.int64)
+
+        # the rows of the known seeds follow the input order, so every request owns a contiguous block of them
+        bounds = np.cumsum([0, *(len(ids) for ids, _ in requests)])
+        known_bounds = np.concatenate([[0], np.cumsum(known)])[bounds]
+
+        results = []
+        for i, (ids, n_recs) in enumerate(requests):
+            recs_idx = state.row_idx[rows[known_bounds[i]:known_bounds[i + 1], :n_recs]]
+            unknown = [track_id for track_id, is_known in zip(ids, known[bounds[i]:bounds[i + 1]]) if not is_known]
+            results.append((recs_idx, unknown))
+
+        return results
+
+    def recommend_taste(
+            self
+            , ids: list[str]
+            , n_recs: int
+            , method: str = 'rrf'
+            , weights: list[float] = None
+            , return_unknown: bool = False
+            , track_filter: TrackFilter = None
+    ) -> np.ndarray | tuple[np.ndarray, list[str]]:
+        """
+        Recommend a single ranked list for the whole seed set (e.g. a playlist to continue), the seeds and the
+        duplicates are excluded. The methods:
+            centroid - a single query around the (weighted) mean of the seeds
+            rrf - the seeds' neighbour lists fused by their reciprocal ranks, the tracks close to many seeds win
+            distance - the seeds' neighbours ranked by their (weighted) mean distance to all the seeds
+        :param ids: list of track ids
+        :param n_recs: number of recommendations to return in total
+        :param method: the fusion method, one of .fusion_methods
+        :param weights: the seeds' weights aligned with the ids, e.g. the play counts, equal if None
+        :param return_unknown: whether to return the list of ids that are not known to the model as well
+        :param track_filter: only recommend the tracks that pass the filter, see Catalog.filter()
+        :return: catalog idx of the recommended tracks, the best first, (recommendations, unknown ids) if return_unknown
+            is True
+        """
+        if not self.model:
+            raise ValueError(f'Recommender model does not exist, please consider training it first using .train()')
+
+        if not isinstance(ids, list):
+            raise ValueError(f'ids should be a list of string, you provided {type(ids)}')
+
+        if method not in self.fusion_methods:
+            raise ValueError(f'Unknown fusion method {method}, choose one of {self.fusion_methods}')
+
+        weights = np.ones(len(ids)) if weights is None else np.asarray(weights, dtype=np.float64)
+        if weights.shape != (len(ids),) or (weights < 0).any():
+            raise ValueError('weights should be a non-negative number per id')
+
+        state = self._state
+        with stage(stage='locate'):
+            positions = self._locate(state, ids)
+        unknown = [track_id for track_id, pos in zip(ids, positions) if pos < 0]
+
+        known = positions >= 0
+        positions, first = np.unique(positions[known], return_index=True)  # a repeated seed counts once
+        weights = weights[known][first]
+
+        if positions.size and weights.sum() > 0:
+            with stage(stage='query'):
+                rows = self._fuse(state, positions, weights, n_recs=n_recs, method=method, track_filter=track_filter)
+            recs_idx = state.row_idx[rows]
+        else:
+            recs_idx = np.empty(0, dtype=np.int64)
+
+        if return_unknown:
+            return recs_idx, unknown
+
+        return recs_idx
+
+    @classmethod
+    def _fuse(
+            cls
+            , state: IndexState
+            , positions: np.ndarray
+            , weights: np.ndarray
+            , n_recs: int
+            , method: str
+            , track_filter: TrackFilter = None
+    ) -> np.ndarray:
+        """Rank the candidate rows for the seed rows by the method, the seeds excluded, see .recommend_taste()"""
+        # the index cannot be searched deeper than its tracks
+        n_recs = min(n_recs, len(state.row_idx) - len(state.delta.tombstones) - len(positions))
+        if method == 'centroid':
+            centroid = np.average(cls._gather(state, positions), axis=0, weights=weights).astype(np.float32)[None]
+            if track_filter is None:
+                candidates = cls._query(state, centroid, k=n_recs + len(positions))[0]  # already ranked
+            else:
+                candidates = cls._filtered_query(
+                    state, centroid, k=n_recs + len(positions), track_filter=track_filter
+                )[0]
+        else:
+            # deep enough for n_recs candidates to remain, even if all the other seeds are among a seed's neighbours
+            k = n_recs + len(positions) - 1
+            if track_filter is None:
+                rows = cls._lookup_neighbours(state, positions, k=k)
+            else:
+                rows = cls._filtered_query(
+                    state, cls._gather(state, positions), k=k, track_filter=track_filter, exclude=positions
+                )
+            candidates, inverse = np.unique(rows, return_inverse=True)
+
+            if method == 'rrf':
+                scores = weights[:, None] / (cls.rrf_k + np.arange(1, rows.shape[1] + 1))
+                scores = -np.bincount(inverse.ravel(), weights=scores.ravel(), minlength=len(candidates))
+            else:
+                seeds, vectors = cls._gather(state, positions), cls._gather(state, candidates)
+                distances = np.sqrt(((vectors[:, None, :] - seeds[None, :, :]) ** 2).sum(axis=2))
+                scores = distances @ (weights / weights.sum())
+
+            scores[candidates < 0] = np.inf  # the slots no track has passed the filter for
+            candidates = candidates[np.argsort(scores, kind='stable')]
+
+        return candidates[~np.isin(candidates, positions) & (candidates >= 0)][:n_recs]
+
+    def recommend_stream(
+            self
+            , ids: list[str]
+            , depth: int
+            , mode: str = 'per_seed'
+            , method: str = 'rrf'
+            , weights: list[float] = None
+            , track_filter: TrackFilter = None
+    ) -> tuple[np.ndarray, list[str], bool]:
+        """
+        Rank the tracks for the seed set as a single stream without the seeds and the duplicates, the per_seed mode
+            interleaves the seeds' neighbour lists rank by rank
+        :param ids: list of track ids
+        :param depth: number of the neighbours per seed in the per_seed mode, of the tracks in the taste mode
+        :param mode: per_seed or taste
+        :param method: the taste mode's fusion method, see .recommend_taste()
+        :param weights: the taste mode's seed weights, see .recommend_taste()
+        :param track_filter: only recommend the tracks that pass the filter, see Catalog.filter()
+        :return: catalog idx of the ranked tracks, the unknown ids, and whether a greater depth would not find any more
+        """
+        if mode == 'taste':
+            recs_idx, unknown = self.recommend_taste(
+                ids, n_recs=depth, method=method, weights=weights, return_unknown=True, track_filter=track_filter
+            )
+            return recs_idx, unknown, len(recs_idx) < depth
+
+        state = self._state
+        depth = min(depth, len(state.row_idx) - len(state.delta.tombstones) - 1)
+        recs_idx, unknown = self.recommend(ids, n_recs=depth, return_unknown=True, track_filter=track_filter)
+
+        # -1 marks that all the tracks passing the filter have been found
+        exhausted = depth == len(state.row_idx) - len(state.delta.tombstones) - 1 or bool((recs_idx < 0).any())
+
+        positions = self._locate(state, ids)
+        seeds = state.row_idx[positions[positions >= 0]]
+        recs_idx = recs_idx.T.ravel()  # rank by rank, the seeds in the order of the input
+        recs_idx = recs_idx[(recs_idx >= 0) & ~np.isin(recs_idx, seeds)]
+        _, first = np.unique(recs_idx, return_index=True)
+
+        return recs_idx[np.sort(first)], unknown, exhausted
+
+    @property
+    def delta_size(self) -> int:
+        """Number of tracks in the delta index"""
+        return len(self._state.delta)
+
+    @property
+    def n_tracks(self) -> int:
+        """Number of tracks that can be recommended, the delta's included and the replaced ones left out"""
+        state = self._state
+        return len(state.row_idx) - len(state.delta.tombstones)  # the delta's rows follow the main ones
+
+    def add_tracks(self, df: pd.DataFrame, publish: bool = False) -> None:
+        """
+        Add new or changed tracks to the delta index without retraining, they are projected with the frozen scaler and
+            PCA of the last training. The requests see the tracks as soon as the method returns
+        :param df: pandas' DataFrame with the tracks table's rows, track_id, idx and the audio features are required
+        :param publish: whether to publish the delta index on top of the current artifact, so that the other workers
+            and the restarts pick it up
+        :return: void function
+        """
+        if self._projection is None:
+            raise ValueError('The model has no frozen projection, please consider training it again using .train()')
+
+        if df.empty:
+            return
+
+        df = df.drop_duplicates(subset='track_id', keep='last')
+        vectors = self._projection.transform(df)
+
+        with self._write_lock:
+            state = self._state
+            delta = state.delta.add(
+                ids=df['track_id'].tolist()
+                , vectors=vectors
+                , row_idx=df['idx'].to_numpy(dtype=np.int64)
+                , main_positions=state.positions
+            )
+            self._build_lookup(delta=delta)
+
+        if len(delta) >= self.compact_threshold:
+            self.compact(publish=publish, background=True)
+        elif publish:
+            self.publish_delta()
+
+    def update_from_changeset(self, path: str, publish: bool = False) -> int:
+        """
+        Add the inserted and the updated tracks of an ETL changeset (see db/etl.py) to the delta index
+        :param path: path to the changeset's JSON file
+        :param publish: whether to publish the delta index, see .add_tracks()
+        :return: number of the tracks added
+        """
+        with open(path) as f:
+            changeset = json.load(f)
+
+        ids = changeset['inserted'] + changeset['updated']
+        if not ids:
+            return 0
+
+        snapshot = Snapshot.current(catalog_version=self.catalog_version())
+        if snapshot is not None and snapshot.has('tracks'):
+            df = snapshot.read_pandas('tracks', filters={'track_id': ids})
+        else:
+            df = self.__class__.query_table(table_name='tracks', filters={'track_id': ids})
+        self.add_tracks(df, publish=publish)
+
+        return len(df)
+
+    def publish_delta(self) -> None:
+        """
+        Publish the delta index on top of the current artifact, the features and the main index are shared with it. If
+            the main index has been compacted since, the whole model is published instead
+        :return: void function
+        """
+        if self._artifact is None:
+            raise ValueError('There is no model artifact to build upon, please consider saving the model first')
+
+        if self._compacted:
+            self._publish_artifact()
+            return
+
+        with self._write_lock:
+            extras, metadata = self._artifact_extras()
+            self._artifact = ModelArtifact.publish_extras(
+                base=self._artifact, extras=extras, metadata=metadata, root=self._artifacts_path
+            )
+            self.version = self._artifact.version
+
+    def compact(self, publish: bool = False, background: bool = False) -> None:
+        """
+        Merge the delta into the main index: the replaced rows are dropped, the delta rows are appended and the index is
+            rebuilt with the same engine and parameters. The requests are served by the old index in the meantime
+        :param publish: whether to publish the compacted model as a new artifact
+        :param background: whether to run in a background thread, at most one compaction runs at a time
+        :return: void function
+        """
+        if background:
+            if self._compaction is not None and self._compaction.is_alive():
+                return
+
+            self._compaction = threading.Thread(target=self.compact, kwargs={'publish': publish}, daemon=True)
+            self._compaction.start()
+            return
+
+        state = self._state
+        delta = state.delta
+        if not len(delta) and not len(delta.tombstones):
+            return
+
+        keep = np.setdiff1d(np.arange(delta.n_main), delta.tombstones)
+        vectors = np.vstack([state.vectors[keep], delta.vectors])
+        ids = np.concatenate([self.data.index.to_numpy()[keep].astype(str), np.asarray(delta.ids, dtype=str)])
+        row_idx = np.concatenate([state.row_idx[keep], delta.row_idx])
+
+        model = ENGINES[state.model.name](**state.model.get_params()).fit(vectors)
+
+        with self._write_lock:
+            # the tracks added or changed again while the index was being rebuilt go to the new delta
+            pending = self._state.delta
+            snapshot = dict(zip(delta.ids, delta.vectors))
+            replay = [
+                i for i, (track_id, vector) in enumerate(zip(pending.ids, pending.vectors))
+                if track_id not in snapshot or not np.array_equal(snapshot[track_id], vector)
+            ]
+
+            self.model = model
+            self.data = pd.DataFrame(vectors, columns=self.data.columns, index=pd.Index(ids, name='track_id'))
+            self._row_idx = row_idx
+            self._neighbours = None  # the rows have moved, the table is recomputed along with the next training
+            self._compacted = True
+            self._build_lookup()
+
+            if replay:
+                self._build_lookup(delta=self._state.delta.add(
+                    ids=[pending.ids[i] for i in replay]
+                    , vectors=pending.vectors[replay]
+                    , row_idx=pending.row_idx[replay]
+                    , main_positions=self._state.positions
+                ))
+
+        if publish:
+            self._publish_artifact()
+
+    def wait_for_compaction(self, timeout: float = None) -> None:
+        """Wait for the background compaction to finish, if there is any"""
+        if self._compaction is not None:
+            self._compaction.join(timeout=timeout)
 
 
 if __name__ == '__main__':
-    recommender = Recommender(reuse_model=False)
+    changesets = sys.argv[1:]
+
+    if changesets and ModelArtifact.current_version():
+        recommender = Recommender()
+
+        for changeset in changesets:
+            print(f'{changeset}: {recommender.update_from_changeset(changeset)} tracks added')
+
+        recommender.wait_for_compaction()
+        recommender.publish_delta()
+    else:
+        recommender = Recommender(reuse_model=False)
 
-    if not recommender.table_exists(table_name='pr_comps') or not os.path.isfile('ml/kdt.pkl'):
-        recommender.train()
-        recommender.save()
+        if not recommender.table_exists(table_name='pr_comps') or not ModelArtifact.current_version():
+            recommender.train()
+            recommender.save()
 
+            # the neighbour table is published as the next version, RECOMMENDER_NEIGHBOURS_K=0 turns it off
+            k = int(os.environ.get('RECOMMENDER_NEIGHBOURS_K', 50))
+            if k and recommender.model:
+                publish_neighbours(root=recommender._artifacts_path, k=k)
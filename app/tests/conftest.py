@@ -0,0 +1,94 @@
+import os
+import sys
+import tempfile
+import importlib.util
+
+# the app's modules are imported from the app directory, and the process-wide stores must not touch the real ones
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+SCRATCH_DIR = tempfile.mkdtemp(prefix='track-recommender-tests-')
+os.environ.update({
+    'SPOTIFY_ID': 'test'
+    , 'SPOTIFY_SECRET': 'test'
+    , 'METRICS_DIR': os.path.join(SCRATCH_DIR, 'metrics')
+    , 'MEDIA_CACHE_PATH': os.path.join(SCRATCH_DIR, 'media_cache.sqlite')
+    , 'RESPONSE_CACHE_PATH': os.path.join(SCRATCH_DIR, 'response_cache.sqlite')
+    , 'RECOMMEND_SESSIONS_PATH': os.path.join(SCRATCH_DIR, 'sessions.sqlite')
+    , 'RECOMMENDER_REFRESH_INTERVAL': '0'
+})
+
+import numpy as np
+import pandas as pd
+import pytest
+from benchmarks.data import synthetic_dataset
+
+
+def catalog_tables(dataset: pd.DataFrame) -> dict[str, pd.DataFrame]:
+    """Normalise the synthetic dataset into the catalog tables the way the ETL does, without the DB"""
+    tracks = dataset.drop(columns=['artists', 'album_name']).reset_index(names='idx')
+    tracks['album_id'] = 1
+
+    links = dataset[['track_id']].assign(artist=dataset['artists'].str.split(';')).explode('artist')
+    artists = pd.DataFrame({'artist': links['artist'].drop_duplicates().to_numpy()})
+    artists.insert(0, 'artist_id', np.arange(1, len(artists) + 1))
+    links = links.merge(artists, on='artist')[['track_id', 'artist_id']]
+
+    return {'tracks': tracks, 'artists': artists, 'tracks_artists': links}
+
+
+@pytest.fixture(scope='session')
+def dataset() -> pd.DataFrame:
+    return synthetic_dataset(n_tracks=2000, seed=0)
+
+
+@pytest.fixture(scope='session')
+def published(dataset, tmp_path_factory):
+    """
+    Publish a catalog snapshot and a trained model artifact of the synthetic dataset into a scratch directory, the
+        published locations are patched for the whole session
+    :return: the artifacts' directory
+    """
+    from db.db_handler import DB
+    from db.snapshot import Snapshot
+    from ml.artifacts import ModelArtifact
+    from ml import neighbours
+    from recommender import Recommender
+
+    root = tmp_path_factory.mktemp('published')
+    artifacts_path = str(root / 'artifacts')
+
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(DB, '_catalog_version_path', str(root / 'catalog.version'))
+        patch.setattr(Snapshot, 'default_root', str(root / 'snapshots'))
+        patch.setattr(ModelArtifact, 'default_root', artifacts_path)
+
+        Snapshot.publish(catalog_tables(dataset), catalog_version=DB.publish_catalog())
+
+        recommender = Recommender(reuse_model=False, artifacts_path=artifacts_path)
+        recommender.train(n_dimensions=6)
+        recommender._publish_artifact()
+        neighbours.publish(root=artifacts_path, k=20, jobs=1)
+
+        yield artifacts_path
+
+
+@pytest.fixture(scope='session')
+def api(published):
+    """The Flask app serving the published model, the Spotify links are stubbed"""
+    # the app directory is a package named app as well, so the module is loaded by its path
+    spec = importlib.util.spec_from_file_location('api', os.path.join(APP_DIR, 'app.py'))
+    api = importlib.util.module_from_spec(spec)
+    sys.modules['api'] = api
+    spec.loader.exec_module(api)
+
+    api.spotify_api.process_tracks = lambda ids: pd.DataFrame({
+        'track_id': ids, 'uri': [f'spotify:track:{track_id}' for track_id in ids], 'image_url': None
+    })
+
+    return api
+
+
+@pytest.fixture
+def client(api):
+    return api.app.test_client()
@@ -0,0 +1,83 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from utils.coalescer import Coalescer
+
+
+class Recorder:
+    """A batch function that doubles the items, records the batches and fails on the negative items"""
+    def __init__(self):
+        self.batches = []
+        self._lock = threading.Lock()
+
+    def __call__(self, items: list) -> list:
+        with self._lock:
+            self.batches.append(list(items))
+
+        if any(item < 0 for item in items):
+            raise ValueError(f'negative item in {items}')
+
+        return [2 * item for item in items]
+
+
+def submit_all(coalescer: Coalescer, items: list) -> list:
+    """Submit every item from its own thread at once, return the results or the exceptions"""
+    barrier = threading.Barrier(len(items))
+
+    def call(item):
+        barrier.wait()
+        try:
+            return coalescer.submit(item)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=len(items)) as pool:
+        return list(pool.map(call, items))
+
+
+def test_single_call():
+    fn = Recorder()
+
+    assert Coalescer(fn, window=0.001).submit(21) == 42
+    assert fn.batches == [[21]]
+
+
+def test_concurrent_calls_share_a_batch():
+    fn = Recorder()
+    coalescer = Coalescer(fn, window=0.5, max_batch=8)
+
+    results = submit_all(coalescer, list(range(8)))
+
+    assert results == [2 * item for item in range(8)]
+    assert len(fn.batches) == 1 and sorted(fn.batches[0]) == list(range(8))
+
+
+def test_batches_are_bounded_by_max_batch():
+    fn = Recorder()
+    coalescer = Coalescer(fn, window=0.2, max_batch=3)
+
+    results = submit_all(coalescer, list(range(10)))
+
+    assert results == [2 * item for item in range(10)]
+    assert all(len(batch) <= 3 for batch in fn.batches)
+    assert sorted(item for batch in fn.batches for item in batch) == list(range(10))
+
+
+def test_failed_batch_is_retried_call_by_call():
+    fn = Recorder()
+    coalescer = Coalescer(fn, window=0.5, max_batch=4)
+
+    results = submit_all(coalescer, [1, -1, 2, 3])
+
+    assert [results[0], results[2], results[3]] == [2, 4, 6]
+    assert isinstance(results[1], ValueError)
+    assert len(fn.batches[0]) == 4 and sorted(map(len, fn.batches[1:])) == [1, 1, 1, 1]
+
+
+def test_single_failed_call_raises():
+    coalescer = Coalescer(Recorder(), window=0.001)
+
+    with pytest.raises(ValueError):
+        coalescer.submit(-1)
+
+    assert coalescer.submit(1) == 2  # the worker survives the failure
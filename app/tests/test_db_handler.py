@@ -0,0 +1,36 @@
+from types import SimpleNamespace
+import pytest
+from db.db_handler import DB
+
+
+@pytest.fixture
+def schema(monkeypatch) -> SimpleNamespace:
+    """A stubbed DB whose tables are listed in .tables, its lookups are recorded in .calls, the cache starts empty"""
+    schema = SimpleNamespace(tables=[], calls=[])
+
+    def fetch(cls, name: str, params: dict = None, **kwargs) -> list[tuple]:
+        schema.calls.append(params['table_name'])
+        return [(params['table_name'] in schema.tables,)]
+
+    monkeypatch.setattr(DB, 'fetch', classmethod(fetch))
+    monkeypatch.setattr(DB, '_schema_cache', {})
+
+    return schema
+
+
+def test_missing_tables_are_not_cached(schema):
+    assert not DB.table_exists('pr_comps')
+    schema.tables.append('pr_comps')  # e.g. created by another worker
+
+    assert DB.table_exists('pr_comps')
+    assert DB.table_exists('pr_comps p')
+    assert schema.calls == ['pr_comps', 'pr_comps']
+
+
+def test_invalidation(schema):
+    schema.tables.append('tracks')
+    assert DB.table_exists('tracks') and DB.table_exists('tracks')
+
+    DB.invalidate_schema_cache(table_name='tracks')
+    assert DB.table_exists('tracks')
+    assert schema.calls == ['tracks', 'tracks']
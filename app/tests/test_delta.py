@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+import pytest
+from ml.delta import DeltaIndex
+from ml.engines import BruteForceIndex
+from recommender import Recommender
+
+
+def test_replaced_rows_are_tombstoned():
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(10, 3)).astype(np.float32)
+    main = BruteForceIndex().fit(vectors)
+    positions = {f't{i}': i for i in range(10)}
+
+    # t3 moves onto t7, t10 is new and lands next to t0
+    delta = DeltaIndex(n_main=10).add(
+        ids=['t3', 't10'], vectors=vectors[[7, 0]] + 1e-3, row_idx=np.array([3, 10]), main_positions=positions
+    )
+
+    assert len(delta) == 2 and delta.tombstones.tolist() == [3]
+
+    _, rows = delta.query(main, vectors[[7, 0]], k=2)
+    assert rows.tolist() == [[7, 10], [0, 11]]  # the delta rows are numbered from n_main onwards
+
+    _, rows = delta.query(main, vectors, k=20)
+    assert rows.shape == (10, 11) and not np.isin(rows, delta.tombstones).any()
+
+    # adding a track again replaces its delta row, the tombstones stay
+    delta = delta.add(ids=['t3'], vectors=vectors[[1]], row_idx=np.array([3]), main_positions=positions)
+    assert delta.ids == ['t10', 't3'] and delta.tombstones.tolist() == [3]
+
+
+class Recorder(BruteForceIndex):
+    """Records the depths the index is searched at"""
+    def __init__(self):
+        super().__init__()
+        self.depths = []
+
+    def query(self, X: np.ndarray, k: int = 1, return_distance: bool = True):
+        self.depths.append(k)
+        return super().query(X, k=k, return_distance=return_distance)
+
+
+def test_tombstones_widen_only_the_queries_they_fall_into():
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(1000, 3)).astype(np.float32)
+    main = Recorder().fit(vectors)
+
+    # the 300 rows nearest to the first row are replaced by the tracks far away
+    replaced = np.argsort(((vectors - vectors[0]) ** 2).sum(axis=1))[:300]
+    delta = DeltaIndex(n_main=1000).add(
+        ids=[f't{i}' for i in replaced], vectors=vectors[replaced] + 100, row_idx=replaced
+        , main_positions={f't{i}': i for i in range(1000)}
+    )
+
+    X = vectors[[0, 999]]
+    _, rows = delta.query(main, X, k=5)
+
+    live = np.setdiff1d(np.arange(1000), replaced)
+    expected = live[BruteForceIndex().fit(vectors[live]).query(X, k=5, return_distance=False)]
+    assert np.array_equal(rows, expected)
+    assert main.depths[0] <= 15 and len(main.depths) > 1  # the first query is searched deeper on its own
+
+
+@pytest.fixture
+def recommender(published) -> Recommender:
+    """A recommender of its own, the changes to its index must not leak into the other tests"""
+    return Recommender(artifacts_path=published)
+
+
+@pytest.fixture
+def tracks(dataset) -> pd.DataFrame:
+    return dataset.reset_index(names='idx')
+
+
+def nearest(recommender: Recommender, track_id: str, n_recs: int = 5) -> list[int]:
+    return recommender.recommend([track_id], n_recs=n_recs)[0].tolist()
+
+
+def test_added_tracks_are_recommended(recommender, tracks):
+    n_tracks = recommender.n_tracks
+    first, second, third = tracks['track_id'].iloc[:3]
+
+    # a new copy of the first track, and the second track changed into a copy of the third
+    added = pd.concat([
+        tracks.iloc[[0]].assign(track_id='new', idx=len(tracks))
+        , tracks.iloc[[2]].assign(track_id=second, idx=1)
+    ])
+    recommender.add_tracks(added)
+
+    assert recommender.delta_size == 2 and recommender.n_tracks == n_tracks + 1
+    assert nearest(recommender, first)[0] == len(tracks)
+    assert nearest(recommender, third)[0] == 1
+    assert nearest(recommender, 'new')[0] == 0
+
+
+def test_background_compaction_merges_the_delta(recommender, tracks):
+    changed = tracks.iloc[10:20].assign(danceability=tracks['danceability'].iloc[10:20][::-1].to_numpy())
+    recommender.add_tracks(pd.concat([changed, tracks.iloc[[0]].assign(track_id='new', idx=len(tracks))]))
+
+    n_tracks = recommender.n_tracks
+    seeds = tracks['track_id'].iloc[10:20].tolist()
+    before = recommender.recommend(seeds, n_recs=10)
+
+    recommender.compact(background=True)
+    recommender.wait_for_compaction()
+
+    assert recommender.delta_size == 0 and not len(recommender._state.delta.tombstones)
+    assert recommender.n_tracks == n_tracks
+    after = recommender.recommend(seeds, n_recs=10)
+    assert all(set(old) == set(new) for old, new in zip(before, after))  # the ties may swap places
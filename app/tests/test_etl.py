@@ -0,0 +1,174 @@
+import os
+import sys
+import json
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+from conftest import APP_DIR
+
+# the ETL is a script of the db directory, it imports its siblings as top-level modules
+sys.path.insert(0, os.path.join(APP_DIR, 'db'))
+
+from etl import Changeset, ExtractTransformLoad
+from db_handler import DB
+
+
+def test_changeset_is_saved_by_its_version(tmp_path):
+    changeset = Changeset(version='v1', inserted=['a'], updated=['b'], unchanged=3, duplicates={'tracks_artists': 1})
+
+    path = changeset.save(str(tmp_path / 'changesets'))
+
+    assert os.path.basename(path) == 'v1.json'
+    with open(path) as f:
+        assert Changeset(**json.load(f)) == changeset
+
+
+def test_chunks_continue_the_keys(dataset):
+    etl = ExtractTransformLoad()
+    first = etl._normalise_chunk(dataset.iloc[:100])
+    second = etl._normalise_chunk(dataset.iloc[50:150])  # half of it has been seen already
+
+    assert first['tracks']['idx'].tolist() == list(range(100))
+    assert second['tracks']['track_id'].tolist() == dataset['track_id'].iloc[100:150].tolist()
+    assert second['tracks']['idx'].tolist() == list(range(100, 150))
+
+    for table, key in [('albums', 'album_id'), ('artists', 'artist_id')]:
+        keys = pd.concat([first[table][key], second[table][key]])
+        assert keys.tolist() == list(range(1, len(keys) + 1))
+
+    # the albums and the artists of the previous chunks keep their keys
+    albums = pd.concat([first['albums'], second['albums']]).set_index('album')['album_id']
+    tracks = second['tracks'].set_index('track_id')
+    expected = dataset.set_index('track_id').loc[tracks.index, 'album_name'].map(albums)
+    assert tracks['album_id'].tolist() == expected.tolist()
+
+
+class Cursor:
+    """A psycopg2 cursor stand-in for _ensure_unique_keys(), counts the given duplicates per table"""
+    def __init__(self, duplicates: dict[str, int]):
+        self.duplicates = duplicates
+        self.statements = []
+
+    def execute(self, statement: str, params: dict = None) -> None:
+        self.statements.append(statement)
+
+    def fetchall(self) -> list[tuple]:
+        return []  # none of the indexes exists yet
+
+    def fetchone(self) -> tuple:
+        table = self.statements[-1].split(' from ')[-1]
+        return self.duplicates.get(table, 0),
+
+
+def test_duplicated_links_are_dropped_and_counted():
+    cursor = Cursor({'tracks_artists': 2})
+
+    assert ExtractTransformLoad._ensure_unique_keys(cursor) == {'tracks_artists': 2}
+    assert any(statement.startswith('delete from tracks_artists') for statement in cursor.statements)
+    assert sum(statement.startswith('create unique index') for statement in cursor.statements) == 4
+
+
+@pytest.mark.parametrize('table', ['tracks', 'albums', 'artists'])
+def test_duplicated_keys_are_not_dropped(table):
+    cursor = Cursor({table: 1})
+
+    with pytest.raises(ValueError, match=table):
+        ExtractTransformLoad._ensure_unique_keys(cursor)
+
+    assert not any(statement.startswith('delete') for statement in cursor.statements)
+
+
+@pytest.fixture
+def scratch_db(dataset, tmp_path, monkeypatch):
+    """
+    Point the ETL at a scratch database and the first 100 tracks of the dataset, TEST_POSTGRES_DB is the database's
+        SQLAlchemy URL, its tables are replaced
+    """
+    url = os.environ.get('TEST_POSTGRES_DB')
+    if not url:
+        pytest.skip('TEST_POSTGRES_DB is not set')
+
+    engine = create_engine(url)
+    monkeypatch.setattr(DB, '_sql_engine', engine)
+    monkeypatch.setattr(DB, '_catalog_version_path', str(tmp_path / 'catalog.version'))
+    monkeypatch.setattr(ExtractTransformLoad, '_changesets_path', str(tmp_path / 'changesets'))
+    monkeypatch.setattr(ExtractTransformLoad, '_source_url', str(tmp_path / 'dataset.csv'))
+    dataset.iloc[:100].to_csv(tmp_path / 'dataset.csv')
+
+    yield engine
+    engine.dispose()
+
+
+def count_rows(engine) -> dict[str, int]:
+    with engine.connect() as conn:
+        return {
+            table: conn.exec_driver_sql(f'select count(*) from {table}').scalar()
+            for table in ('tracks', 'albums', 'artists', 'tracks_artists')
+        }
+
+
+@pytest.mark.parametrize('load', ['populate_database', 'populate_database_streaming'])
+def test_full_load_is_committed(scratch_db, dataset, load):
+    with scratch_db.begin() as conn:  # the leftovers of the previous runs must not pass for the load
+        for table in ('tracks', 'albums', 'artists', 'tracks_artists'):
+            conn.exec_driver_sql(f'drop table if exists {table}')
+
+    getattr(ExtractTransformLoad(), load)()
+
+    tracks = dataset.iloc[:100]
+    assert count_rows(scratch_db) == {
+        'tracks': 100
+        , 'albums': tracks['album_name'].nunique()
+        , 'artists': tracks['artists'].str.split(';').explode().nunique()
+        , 'tracks_artists': len(tracks['artists'].str.split(';').explode())
+    }
+    assert DB.catalog_version()
+
+
+@pytest.fixture
+def etl(scratch_db) -> ExtractTransformLoad:
+    """An ETL over the scratch database populated by the streaming load"""
+    etl = ExtractTransformLoad()
+    etl.populate_database_streaming()
+
+    return etl
+
+
+def test_upsert_changeset(etl, dataset, tmp_path):
+    delta = dataset.iloc[[0, 1, 2, *range(100, 110)]].copy()
+    delta.loc[0, 'popularity'] += 1
+    delta.loc[1, 'artists'] += ';Newcomer'  # the track's own row stays the same
+    delta.to_csv(tmp_path / 'delta.csv')
+
+    changeset = etl.upsert_database(str(tmp_path / 'delta.csv'))
+
+    assert changeset.inserted == dataset['track_id'].iloc[100:110].tolist()
+    assert sorted(changeset.updated) == sorted(dataset['track_id'].iloc[:2])
+    assert changeset.unchanged == 1 and 'Newcomer' in changeset.artists
+    assert os.path.isfile(os.path.join(ExtractTransformLoad._changesets_path, f'{changeset.version}.json'))
+
+    # the same delta again changes nothing, no catalog version is published
+    changeset = etl.upsert_database(str(tmp_path / 'delta.csv'))
+    assert not changeset.inserted and not changeset.updated and changeset.unchanged == 13
+    assert changeset.version == ''
+
+    with DB._sql_engine.connect() as conn:
+        tracks = pd.read_sql('select track_id, idx from tracks', con=conn).set_index('track_id')['idx']
+    assert sorted(tracks) == list(range(110)) and tracks[dataset['track_id'].iloc[0]] == 0
+
+
+def test_upsert_reports_the_duplicates(etl, dataset, tmp_path):
+    with DB._sql_engine.begin() as conn:
+        conn.exec_driver_sql('insert into tracks_artists select * from tracks_artists limit 1')
+
+    dataset.iloc[[0]].to_csv(tmp_path / 'delta.csv')
+    assert etl.upsert_database(str(tmp_path / 'delta.csv')).duplicates == {'tracks_artists': 1}
+
+
+def test_upsert_refuses_the_duplicated_albums(etl, dataset, tmp_path):
+    with DB._sql_engine.begin() as conn:
+        conn.exec_driver_sql('insert into albums select * from albums limit 1')
+
+    dataset.iloc[[0]].to_csv(tmp_path / 'delta.csv')
+    with pytest.raises(ValueError, match='albums'):
+        etl.upsert_database(str(tmp_path / 'delta.csv'))
@@ -0,0 +1,84 @@
+import time
+import pytest
+from utils.response_cache import ResponseCache
+
+
+def test_key():
+    key = ResponseCache.key('recommend', ('model', 'catalog'), ids=['a', 'b'], n_recs=5)
+
+    assert key == ResponseCache.key('recommend', ('model', 'catalog'), n_recs=5, ids=['a', 'b'])
+    assert key != ResponseCache.key('recommend', ('model', 'catalog'), ids=['b', 'a'], n_recs=5)
+    assert key != ResponseCache.key('recommend', ('retrained', 'catalog'), ids=['a', 'b'], n_recs=5)
+    assert key != ResponseCache.key('session', ('model', 'catalog'), ids=['a', 'b'], n_recs=5)
+
+
+@pytest.mark.parametrize('shared', [True, False])
+def test_etag_follows_the_body(tmp_path, shared):
+    cache = ResponseCache(path=str(tmp_path / 'responses.sqlite') if shared else '')
+
+    etag = cache.set('first', b'[1, 2]')
+
+    assert cache.get('first') == (etag, b'[1, 2]')
+    assert cache.set('second', b'[1, 2]') == etag and cache.set('first', b'[2, 1]') != etag
+    assert cache.get('unknown') is None
+
+
+def test_workers_share_the_responses(tmp_path):
+    path = str(tmp_path / 'responses.sqlite')
+    worker, other_worker = ResponseCache(path=path), ResponseCache(path=path)
+
+    etag = worker.set('key', b'[]')
+
+    assert other_worker.get('key') == (etag, b'[]')
+    assert other_worker.stats()['shared_hits'] == 1
+    assert other_worker.get('key') == (etag, b'[]') and other_worker.stats()['shared_hits'] == 1  # from memory now
+
+
+def test_responses_expire(tmp_path):
+    path = str(tmp_path / 'responses.sqlite')
+    cache = ResponseCache(path=path, ttl=60)
+
+    cache.set('short', b'[]', ttl=0.05)
+    cache.set('long', b'[]')
+    time.sleep(0.1)
+
+    assert cache.get('short') is None and ResponseCache(path=path).get('short') is None
+    assert cache.get('long') is not None
+
+
+def test_revalidation(client, api):
+    payload = {'ids': api.recommender.data.index[:2].tolist(), 'n_recs': 5}
+    response = client.post('/api/v1/recommend', json=payload)
+    etag = response.headers['ETag']
+
+    assert response.status_code == 200 and len(response.json) == 10
+
+    cached = client.post('/api/v1/recommend', json=payload, headers={'If-None-Match': etag})
+    assert cached.status_code == 304 and not cached.data and cached.headers['ETag'] == etag
+
+    stale = client.post('/api/v1/recommend', json=payload, headers={'If-None-Match': '"stale"'})
+    assert stale.status_code == 200 and stale.data == response.data
+
+
+def test_taste_mode_shares_the_response_of_the_seed_set(client, api):
+    ids = api.recommender.data.index[10:13].tolist()
+    payload = {'n_recs': 5, 'mode': 'taste'}
+
+    first = client.post('/api/v1/recommend', json={'ids': ids, 'weights': [1, 2, 3], **payload})
+    second = client.post('/api/v1/recommend', json={'ids': ids[::-1], 'weights': [3, 2, 1], **payload})
+
+    assert first.status_code == second.status_code == 200
+    assert first.headers['ETag'] == second.headers['ETag']
+
+
+def test_degraded_responses_expire_early(client, api, monkeypatch):
+    process_tracks = api.spotify_api.process_tracks
+    payload = {'ids': api.recommender.data.index[20:22].tolist(), 'n_recs': 5}
+
+    monkeypatch.setattr(api, 'degraded_ttl', 0.05)
+    monkeypatch.setattr(api.spotify_api, 'process_tracks', lambda ids: process_tracks(ids).assign(uri=None))
+    assert all(track['uri'] is None for track in client.post('/api/v1/recommend', json=payload).json)
+
+    monkeypatch.setattr(api.spotify_api, 'process_tracks', process_tracks)
+    time.sleep(0.1)
+    assert all(track['uri'] is not None for track in client.post('/api/v1/recommend', json=payload).json)
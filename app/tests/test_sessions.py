@@ -0,0 +1,179 @@
+import json
+import base64
+import numpy as np
+import pytest
+from utils.sessions import SessionStore, pack_tracks, unpack_tracks
+
+
+class Stream:
+    """A fetch function over a fixed ranking, counts its calls"""
+    def __init__(self, n: int, reorder: bool = False):
+        self.ranking = np.arange(n)
+        self.reorder = reorder
+        self.depths = []
+
+    def __call__(self, params: dict, depth: int) -> tuple[np.ndarray, list[str], bool]:
+        self.depths.append(depth)
+        candidates = self.ranking[:depth]
+        if self.reorder:  # a deeper search ranks the tracks differently
+            candidates = candidates[::-1]
+
+        return candidates, ['unknown'], depth >= len(self.ranking)
+
+
+def walk(store: SessionStore, key: str, size: int, max_pages: int = 100, cursor: bool = False) -> list[np.ndarray]:
+    """Serve the session page by page, the served tracks are passed along the way a cursor carries them if cursor"""
+    pages, offset, has_more = [], 0, True
+    while has_more and len(pages) < max_pages:
+        served = np.concatenate([np.empty(0, dtype=np.int64), *pages]) if cursor else None
+        page, _, has_more = store.page(key, {}, offset, size, served=served)
+        pages.append(page)
+        offset += len(page)
+
+    return pages
+
+
+def test_pages_cover_the_stream_once():
+    store = SessionStore(Stream(95), path='', maxbytes=2 ** 20, ttl=60)
+
+    pages = walk(store, 'key', size=10)
+
+    assert len(pages) == 10
+    assert np.array_equal(np.concatenate(pages), np.arange(95))
+
+
+def test_pages_are_cut_from_the_stored_candidates():
+    stream = Stream(1000)
+    store = SessionStore(stream, path='', maxbytes=2 ** 20, ttl=60)
+
+    walk(store, 'key', size=10, max_pages=8, cursor=True)
+
+    assert stream.depths == [11, 22, 44, 88]  # deeper twice as much, only when a page runs past the candidates
+
+
+def test_served_tracks_keep_their_place_when_the_search_goes_deeper():
+    store = SessionStore(Stream(100, reorder=True), path='', maxbytes=2 ** 20, ttl=60)
+
+    tracks = np.concatenate(walk(store, 'key', size=7))
+
+    assert len(tracks) == 100 and len(np.unique(tracks)) == 100
+
+
+def test_lost_sessions_do_not_repeat_the_served_tracks():
+    stream = Stream(100, reorder=True)
+    store = SessionStore(stream, path='', maxbytes=2 ** 20, ttl=0)  # every session expires at once
+
+    tracks = np.concatenate(walk(store, 'key', size=7, cursor=True))
+
+    assert len(tracks) == 100 and len(np.unique(tracks)) == 100
+    assert len(stream.depths) == 15  # found again for every page
+
+
+def test_session_served_differently_is_found_again():
+    store = SessionStore(Stream(100, reorder=True), path='', maxbytes=2 ** 20, ttl=60)
+    store.page('key', {}, offset=0, size=10)
+
+    # another client has been served other tracks by a session of the same parameters, e.g. before it was lost
+    served = np.arange(90, 100)
+    page, _, _ = store.page('key', {}, offset=10, size=10, served=served)
+
+    assert len(page) == 10 and not np.isin(page, served).any()
+
+
+def test_workers_share_the_sessions(tmp_path):
+    path = str(tmp_path / 'sessions.sqlite')
+    stream, other_stream = Stream(1000), Stream(1000)
+    worker, other_worker = SessionStore(stream, path=path), SessionStore(other_stream, path=path)
+
+    first, _, _ = worker.page('key', {}, offset=0, size=10)
+    second, unknown, has_more = other_worker.page('key', {}, offset=10, size=10, served=first)
+
+    assert np.array_equal(second, np.arange(10, 20)) and unknown == ['unknown'] and has_more
+    # the other worker takes the session twice as deep, instead of finding it again at the needed depth of 21
+    assert stream.depths == [11] and other_stream.depths == [22]
+
+
+def test_sessions_are_bounded_by_their_size():
+    store = SessionStore(Stream(1000), path='', maxbytes=3 * (11 * 8 + SessionStore._overhead), ttl=60)
+
+    for key in range(10):
+        store.page(str(key), {}, offset=0, size=10)
+
+    assert len(store) == 3
+
+
+def test_packed_tracks():
+    tracks = np.array([5, 0, 123_456, 77])
+
+    assert unpack_tracks(pack_tracks(tracks)).tolist() == [0, 5, 77, 123_456]
+    assert unpack_tracks(pack_tracks(np.empty(0, dtype=np.int64))).tolist() == []
+    with pytest.raises(ValueError):
+        unpack_tracks('not packed')
+
+
+def decode(cursor: str) -> dict:
+    return json.loads(base64.urlsafe_b64decode(cursor))
+
+
+def encode(cursor: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+
+@pytest.mark.parametrize('lost', [False, True])
+@pytest.mark.parametrize('body', [
+    {'n_recs': 400}
+    , {'n_recs': 400, 'mode': 'taste', 'method': 'centroid'}
+    , {'n_recs': 50, 'mode': 'taste', 'method': 'rrf'}
+    , {'n_recs': 50, 'mode': 'taste', 'method': 'distance'}
+    , {'n_recs': 50, 'filters': {'genres': ['jazz'], 'popularity': [80, None]}}
+])
+def test_session_walk(client, api, monkeypatch, body, lost):
+    if lost:  # every page lands on a worker that does not know the session
+        monkeypatch.setattr(api, 'sessions', SessionStore(api.fetch_stream, path='', ttl=0))
+
+    seeds = api.recommender.data.index[:3].tolist()
+    response = client.post('/api/v1/recommend/session', json={'ids': seeds, **body})
+
+    served = []
+    for _ in range(50):
+        assert response.status_code == 200, response.json
+        served += [track['track_id'] for track in response.json['recommendations']]
+        if response.json['cursor'] is None:
+            break
+        response = client.post('/api/v1/recommend/session', json={'cursor': response.json['cursor']})
+
+    assert len(served) == len(set(served)) and not set(served) & set(seeds)
+    assert response.json['cursor'] is None
+
+
+def test_cursor_expires_with_the_model_or_the_catalog(client, api):
+    seeds = api.recommender.data.index[:2].tolist()
+    cursor = decode(client.post('/api/v1/recommend/session', json={'ids': seeds, 'n_recs': 5}).json['cursor'])
+    model_version, catalog_version = cursor['versions']
+
+    assert client.post('/api/v1/recommend/session', json={'cursor': encode(cursor)}).status_code == 200
+
+    for versions in [['retrained', catalog_version], [model_version, 'reloaded']]:
+        response = client.post('/api/v1/recommend/session', json={'cursor': encode({**cursor, 'versions': versions})})
+        assert response.status_code == 410
+
+
+def test_invalid_cursor(client, api):
+    seeds = api.recommender.data.index[:2].tolist()
+    cursor = decode(client.post('/api/v1/recommend/session', json={'ids': seeds, 'n_recs': 5}).json['cursor'])
+
+    for invalid in [
+        'not a cursor'
+        , encode({**cursor, 'served': 'not packed'})
+        , encode({**cursor, 'served': pack_tracks(np.arange(100))[:8]})
+        , encode({**cursor, 'params': {**cursor['params'], 'n_recs': 0}})
+        , encode({'served': cursor['served']})
+    ]:
+        response = client.post('/api/v1/recommend/session', json={'cursor': invalid})
+        assert response.status_code == 400, invalid
+
+
+def test_unknown_seeds(client):
+    response = client.post('/api/v1/recommend/session', json={'ids': ['unknown'], 'n_recs': 5})
+
+    assert response.status_code == 404 and response.json['unknown_ids'] == ['unknown']
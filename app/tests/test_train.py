@@ -0,0 +1,18 @@
+from ml import train
+from ml.artifacts import ModelArtifact
+
+
+def test_promoted_model_has_a_neighbour_table(published, tmp_path, monkeypatch):
+    root = str(tmp_path / 'artifacts')
+    monkeypatch.setattr(ModelArtifact, 'default_root', root)  # the session's model stays as it is
+    monkeypatch.setattr(train, 'reports_path', str(tmp_path / 'reports'))
+
+    report = train.main([
+        '--n-components', '4', '6', '--engines', 'kdtree', 'brute', '--leaf-size', '20', '--n-queries', '100'
+        , '--n-latency', '10', '--jobs', '1', '--neighbours-k', '10'
+    ])
+
+    artifact = ModelArtifact.load(root=root)
+    assert report['promoted_version'] == artifact.version == ModelArtifact.current_version(root)
+    assert artifact.extras['neighbour_rows'].shape == (len(artifact.ids), 10)
+    assert artifact.manifest['engine'] == report['best']['engine']
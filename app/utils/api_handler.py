@@ -1,6 +1,13 @@
+import os
 import requests
 import time
+import weakref
 from functools import wraps
+from requests.adapters import HTTPAdapter
+from .metrics import HTTP_CLIENT_REQUESTS, HTTP_CLIENT_SECONDS, RETRIES
+
+
+RETRY_WAIT = float(os.environ.get('HTTP_RETRY_WAIT', 10))  # seconds to wait after being rate limited
 
 
 def wait_on_429(func):
@@ -9,7 +16,8 @@ def wait_on_429(func):
         result = func(self, *args, **kwargs)
 
         if isinstance(result, tuple) and len(result) >= 2 and result[1] == 429:
-            time.sleep(10)
+            RETRIES.inc(reason='429')
+            time.sleep(RETRY_WAIT)
             result = func(self, *args, **kwargs)
 
         return result
@@ -18,11 +26,30 @@ def wait_on_429(func):
 
 
 class APIHandler:
+    """
+    A thin wrapper around requests, the connections are pooled by one Session, sized by HTTP_POOL_SIZE
+    """
     def __init__(self, client_id: str | None = None, client_secret: str | None = None):
         if client_id and client_secret:
             self._client_id = client_id
             self._client_secret = client_secret
 
+        self._pool_size = int(os.environ.get('HTTP_POOL_SIZE', 10))
+        self._timeout = float(os.environ.get('HTTP_TIMEOUT', 10))
+
+        self._open_session()
+        _handlers.add(self)
+
+    def _after_fork(self) -> None:
+        """Reset the state a forked worker must not share with its parent, e.g. the parent's sockets"""
+        self._open_session()
+
+    def _open_session(self) -> None:
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self._pool_size, pool_maxsize=self._pool_size)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
     def post(self, url, headers, payload, use_secret: bool = False, **kwargs) -> tuple[dict, int]:
         if use_secret and self._client_id and self._client_secret:
             payload['client_id'] = self._client_id
@@ -32,7 +59,9 @@ class APIHandler:
             payload.update(kwargs)
 
         try:
-            response = requests.post(url=url, headers=headers, data=payload)
+            with HTTP_CLIENT_SECONDS.time(method='POST'):
+                response = self._session.post(url=url, headers=headers, data=payload, timeout=self._timeout)
+            HTTP_CLIENT_REQUESTS.inc(method='POST', status=str(response.status_code))
 
             try:
                 return response.json(), response.status_code
@@ -40,26 +69,46 @@ class APIHandler:
                 return {
                     'response': response.text
                 }, response.status_code
-        except requests.exceptions.ConnectionError as err:
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+            HTTP_CLIENT_REQUESTS.inc(method='POST', status=type(err).__name__)
             return {}, 503
 
-    @staticmethod
-    def get(url, **kwargs) -> tuple[dict, int]:
+    def get(self, url, **kwargs) -> tuple[dict, int]:
         try:
-            with requests.Session() as session:
-                request = requests.Request('GET', url=url, **kwargs)
-                prepped = session.prepare_request(request)
+            request = requests.Request('GET', url=url, **kwargs)
+            prepped = self._session.prepare_request(request)
+
+            with HTTP_CLIENT_SECONDS.time(method='GET'):
+                response = self._session.send(prepped, timeout=self._timeout)
+            HTTP_CLIENT_REQUESTS.inc(method='GET', status=str(response.status_code))
 
-                response = session.send(prepped)
             try:
                 return response.json(), response.status_code
             except requests.exceptions.JSONDecodeError as err:
                 return {
                     'response': response.text
                 }, response.status_code
-        except requests.exceptions.ConnectionError as err:
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+            HTTP_CLIENT_REQUESTS.inc(method='GET', status=type(err).__name__)
             return {}, 503
 
+    def close(self) -> None:
+        """Close the pooled connections"""
+        self._session.close()
+
+
+# the live handlers are reset in a forked child by a single hook, a hook per handler would keep every handler ever
+# created alive
+_handlers: weakref.WeakSet[APIHandler] = weakref.WeakSet()
+
+
+def _reset_after_fork() -> None:
+    for handler in list(_handlers):
+        handler._after_fork()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
 
 if __name__ == '__main__':
     api = APIHandler()
@@ -0,0 +1,120 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Iterable
+
+
+class LRUCache:
+    """
+    A thread-safe in-process LRU cache with an optional time to live
+    ...
+
+    Attributes
+    ----------
+    :param maxsize: maximal number of the entries, or their maximal total weight if a weigher is given
+    :param ttl: number of seconds the entries are valid for, forever if None
+    :param weigher: a function that gets the weight of a value, e.g. len for the number of bytes
+
+    Methods
+    -------
+    get(key: Hashable, default: Any = None) -> Any:
+        Get the cached value
+    set(key: Hashable, value: Any, ttl: float = None) -> None:
+        Cache the value
+    get_many(keys: Iterable[Hashable]) -> dict:
+        Get the cached values of many keys at once, the missing keys are left out
+    set_many(items: dict, ttl: float = None) -> None:
+        Cache many values at once
+    clear() -> None:
+        Drop all the entries
+    stats() -> dict[str, int]:
+        Get the size and the hit/miss counters
+    """
+    def __init__(self, maxsize: int = 10_000, ttl: float = None, weigher: Callable[[Any], int] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self._weigher = weigher or (lambda value: 1)
+        self._weight = 0
+        self._data: OrderedDict[Hashable, tuple[Any, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _get(self, key: Hashable, now: float) -> tuple[bool, Any]:
+        """Get the entry, the caller holds the lock"""
+        entry = self._data.get(key)
+
+        if entry is None or entry[1] < now:
+            if entry is not None:
+                self._pop(key)
+            self._misses += 1
+            return False, None
+
+        self._data.move_to_end(key)
+        self._hits += 1
+
+        return True, entry[0]
+
+    def _pop(self, key: Hashable) -> None:
+        """Drop the entry, the caller holds the lock"""
+        value, _ = self._data.pop(key)
+        self._weight -= self._weigher(value)
+
+    def _set(self, key: Hashable, value: Any, expires: float) -> None:
+        """Set the entry and evict the least recently used ones, the caller holds the lock"""
+        if key in self._data:
+            self._pop(key)
+
+        self._data[key] = (value, expires)
+        self._weight += self._weigher(value)
+
+        while self._weight > self.maxsize and len(self._data) > 1:
+            self._pop(next(iter(self._data)))
+
+    def _expires(self, ttl: float | None) -> float:
+        ttl = self.ttl if ttl is None else ttl
+
+        return time.monotonic() + ttl if ttl is not None else float('inf')
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            found, value = self._get(key, time.monotonic())
+
+        return value if found else default
+
+    def set(self, key: Hashable, value: Any, ttl: float = None) -> None:
+        expires = self._expires(ttl)
+
+        with self._lock:
+            self._set(key, value, expires)
+
+    def get_many(self, keys: Iterable[Hashable]) -> dict:
+        now = time.monotonic()
+        values = {}
+
+        with self._lock:
+            for key in keys:
+                found, value = self._get(key, now)
+                if found:
+                    values[key] = value
+
+        return values
+
+    def set_many(self, items: dict, ttl: float = None) -> None:
+        expires = self._expires(ttl)
+
+        with self._lock:
+            for key, value in items.items():
+                self._set(key, value, expires)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._weight = 0
+
+    def stats(self) -> dict[str, int]:
+        return {'size': len(self._data), 'weight': self._weight, 'hits': self._hits, 'misses': self._misses}
@@ -0,0 +1,109 @@
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable
+from utils.metrics import COALESCER_QUEUE_DEPTH, COALESCER_BATCH_SIZE, COALESCER_WAIT_SECONDS
+
+
+class Coalescer:
+    """
+    Collects the calls of the concurrent requests and runs them as a single batch, closed after max_batch calls or
+    window seconds, by a daemon thread started lazily in every process
+    ...
+
+    Attributes
+    ----------
+    :param fn: the batch function, gets a list of the items and returns a list of the results in the same order
+    :param window: maximal number of seconds a call waits for the others to join its batch
+    :param max_batch: maximal number of the calls per batch
+    :param name: the coalescer's name, used as the metrics' label
+
+    Methods
+    -------
+    submit(item: Any) -> Any:
+        Add the item to the next batch, wait for the batch to run and return the item's result
+    """
+    def __init__(self, fn: Callable[[list], list], window: float = 0.002, max_batch: int = 64, name: str = 'default'):
+        self.window = window
+        self.max_batch = max_batch
+        self.name = name
+
+        self._fn = fn
+        self._lock = threading.Lock()
+        self._queue: queue.SimpleQueue[tuple[Any, Future, float]] = queue.SimpleQueue()
+        self._worker = None
+        self._pid = None
+
+    def _ensure_worker(self) -> None:
+        """Start the batching thread, unless it is running in this process already"""
+        if self._pid == os.getpid() and self._worker.is_alive():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid() and self._worker.is_alive():
+                return
+
+            if self._pid != os.getpid():  # the parent's queue may hold calls nobody is going to wait for
+                self._queue = queue.SimpleQueue()
+
+            self._worker = threading.Thread(target=self._run, name=f'coalescer-{self.name}', daemon=True)
+            self._worker.start()
+            self._pid = os.getpid()
+
+    def submit(self, item: Any) -> Any:
+        """
+        Add the item to the next batch and wait for its result
+        :param item: the batch function's input for this call
+        :return: the batch function's output for this call, its exception is raised instead if it failed
+        """
+        self._ensure_worker()
+
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        COALESCER_QUEUE_DEPTH.set(self._queue.qsize(), coalescer=self.name)
+
+        return future.result()
+
+    def _collect(self) -> list[tuple[Any, Future, float]]:
+        """Wait for the first call, then for the others until the batch is full or the window is over"""
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.window
+
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+
+            now = time.perf_counter()
+            COALESCER_QUEUE_DEPTH.set(self._queue.qsize(), coalescer=self.name)
+            COALESCER_BATCH_SIZE.observe(len(batch), coalescer=self.name)
+            for _, _, queued_at in batch:
+                COALESCER_WAIT_SECONDS.observe(now - queued_at, coalescer=self.name)
+
+            self._execute(batch)
+
+    def _execute(self, batch: list[tuple[Any, Future, float]]) -> None:
+        """Run the batch and hand the results out, a failed batch is retried call by call"""
+        try:
+            results = self._fn([item for item, _, _ in batch])
+        except Exception as e:
+            if len(batch) > 1:
+                for call in batch:
+                    self._execute([call])
+                return
+
+            batch[0][1].set_exception(e)
+            return
+
+        for (_, future, _), result in zip(batch, results):
+            future.set_result(result)
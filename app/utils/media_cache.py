@@ -0,0 +1,158 @@
+import os
+import time
+import sqlite3
+import threading
+import weakref
+from .cache import LRUCache
+from .metrics import CACHE_LOOKUPS
+
+
+class MediaCache:
+    """
+    A cache of the tracks' Spotify media (uri and image_url), an in-process LRU in front of a shared SQLite file
+    ...
+
+    Attributes
+    ----------
+    :param path: path to the SQLite file, MEDIA_CACHE_PATH or db/media_cache.sqlite by default
+    :param maxsize: maximal number of the tracks in the in-process tier, MEDIA_CACHE_SIZE or 50000 by default
+    :param ttl: number of seconds the media are valid for, MEDIA_CACHE_TTL or 30 days by default
+    :param negative_ttl: number of seconds the unknown tracks are remembered for, MEDIA_CACHE_NEGATIVE_TTL or 1 day by
+        default
+
+    Methods
+    -------
+    get_many(track_ids: list[str]) -> dict[str, dict | None]:
+        Get the cached media of the tracks, None for the tracks known not to exist
+    set_many(media: dict[str, dict], missing: list[str] = None) -> None:
+        Cache the fetched media and the tracks that do not exist
+    stats() -> dict[str, int]:
+        Get the counters of both tiers
+    """
+    _default_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'db', 'media_cache.sqlite')
+    _batch_size = 500  # stay well below SQLite's limit of the bound parameters
+
+    def __init__(self, path: str = None, maxsize: int = None, ttl: float = None, negative_ttl: float = None):
+        self.path = path or os.environ.get('MEDIA_CACHE_PATH', self._default_path)
+        self.ttl = ttl if ttl is not None else float(os.environ.get('MEDIA_CACHE_TTL', 30 * 24 * 3600))
+        self.negative_ttl = (
+            negative_ttl if negative_ttl is not None else float(os.environ.get('MEDIA_CACHE_NEGATIVE_TTL', 24 * 3600))
+        )
+
+        self._memory = LRUCache(maxsize=maxsize or int(os.environ.get('MEDIA_CACHE_SIZE', 50_000)))
+        self._local = threading.local()  # SQLite connections can't be shared between the threads, nor the processes
+        _caches.add(self)
+        self._store_hits = 0
+        self._store_misses = 0
+
+        with self._connection() as conn:
+            conn.execute("""
+                create table if not exists track_media (
+                    track_id text primary key
+                    , uri text
+                    , image_url text
+                    , found integer not null
+                    , expires_at real not null
+                )
+            """)
+
+    def _forget_connections(self) -> None:
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('pragma journal_mode=wal')  # readers do not block the writer
+            conn.execute('pragma synchronous=normal')
+            self._local.conn = conn
+
+        return conn
+
+    def get_many(self, track_ids: list[str]) -> dict[str, dict | None]:
+        """
+        Get the cached media, the in-process tier is asked first, the rest is read from SQLite in batches
+        :param track_ids: list of track ids
+        :return: track id -> {'uri', 'image_url'} for the cached tracks, None for the ones known not to exist, the
+            tracks that are not cached are left out
+        """
+        media = self._memory.get_many(track_ids)
+        missing = [track_id for track_id in dict.fromkeys(track_ids) if track_id not in media]
+        CACHE_LOOKUPS.inc(len(media), cache='media', tier='memory', result='hit')
+        CACHE_LOOKUPS.inc(len(missing), cache='media', tier='memory', result='miss')
+
+        if not missing:
+            return media
+
+        now = time.time()
+        conn = self._connection()
+        for start in range(0, len(missing), self._batch_size):
+            batch = missing[start:start + self._batch_size]
+            rows = conn.execute(
+                f"""
+                select track_id, uri, image_url, found, expires_at
+                from track_media
+                where track_id in ({', '.join('?' * len(batch))}) and expires_at > ?
+                """
+                , (*batch, now)
+            ).fetchall()
+
+            for track_id, uri, image_url, found, expires_at in rows:
+                media[track_id] = {'uri': uri, 'image_url': image_url} if found else None
+                self._memory.set(track_id, media[track_id], ttl=expires_at - now)
+
+            self._store_hits += len(rows)
+            self._store_misses += len(batch) - len(rows)
+            CACHE_LOOKUPS.inc(len(rows), cache='media', tier='store', result='hit')
+            CACHE_LOOKUPS.inc(len(batch) - len(rows), cache='media', tier='store', result='miss')
+
+        return media
+
+    def set_many(self, media: dict[str, dict], missing: list[str] = None) -> None:
+        """
+        Cache the media in both tiers
+        :param media: track id -> {'uri', 'image_url'}
+        :param missing: the tracks Spotify does not know, cached for negative_ttl only
+        :return: void function
+        """
+        missing = missing or []
+        now = time.time()
+
+        rows = [
+            (track_id, entry['uri'], entry['image_url'], 1, now + self.ttl) for track_id, entry in media.items()
+        ] + [
+            (track_id, None, None, 0, now + self.negative_ttl) for track_id in missing
+        ]
+        if not rows:
+            return
+
+        self._memory.set_many(media, ttl=self.ttl)
+        self._memory.set_many(dict.fromkeys(missing), ttl=self.negative_ttl)
+
+        try:
+            with self._connection() as conn:
+                conn.executemany('insert or replace into track_media values (?, ?, ?, ?, ?)', rows)
+        except sqlite3.OperationalError as e:  # e.g. locked for too long, the in-process tier still has the data
+            print(f'Could not persist the media cache, {e}')
+
+    def stats(self) -> dict[str, int]:
+        return {
+            **{f'memory_{key}': value for key, value in self._memory.stats().items()}
+            , 'store_hits': self._store_hits
+            , 'store_misses': self._store_misses
+        }
+
+
+# the SQLite connections of the live caches are dropped in a forked child by a single hook, a hook per cache would keep
+# every cache ever created alive
+_caches: weakref.WeakSet[MediaCache] = weakref.WeakSet()
+
+
+def _forget_after_fork() -> None:
+    for cache in list(_caches):
+        cache._forget_connections()
+
+
+os.register_at_fork(after_in_child=_forget_after_fork)
@@ -0,0 +1,356 @@
+import os
+import sys
+import json
+import atexit
+import time
+import uuid
+import bisect
+import threading
+from collections import Counter as Tally
+from contextlib import contextmanager
+
+# every process periodically dumps its metrics into this directory, so that /metrics served by any of the gunicorn
+# workers reports the whole container
+METRICS_DIR = os.environ.get('METRICS_DIR', '/dev/shm/track-recommender-metrics' if os.path.isdir('/dev/shm') else '')
+DUMP_INTERVAL = float(os.environ.get('METRICS_DUMP_INTERVAL', 5))
+
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+class Metric:
+    """
+    A base class of the metrics, the values are kept per label set
+    ...
+
+    Attributes
+    ----------
+    :param name: the metric's name, as exposed
+    :param documentation: the metric's help text
+    """
+    kind = ''
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def snapshot(self) -> list:
+        with self._lock:
+            return [[list(map(list, key)), value] for key, value in self._values.items()]
+
+
+class Counter(Metric):
+    """A monotonically increasing value, e.g. the number of requests"""
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down, e.g. the size of the model"""
+    kind = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[_key(labels)] = value
+
+
+class Histogram(Metric):
+    """A distribution of the observed values, e.g. the latencies, counted into cumulative buckets"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        key = _key(labels)
+        position = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[position] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> list:
+        with self._lock:
+            return [[list(map(list, key)), [list(counts), total]] for key, (counts, total) in self._values.items()]
+
+
+class Registry:
+    """
+    The process' metrics, shared with the other processes of the container through METRICS_DIR
+    ...
+
+    Methods
+    -------
+    counter(name: str, documentation: str) -> Counter:
+        Register a counter
+    gauge(name: str, documentation: str) -> Gauge:
+        Register a gauge
+    histogram(name: str, documentation: str, buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        Register a histogram
+    dump() -> None:
+        Write the process' snapshot into METRICS_DIR
+    render() -> str:
+        Render the metrics of all the processes in the Prometheus text format
+    """
+    def __init__(self, directory: str = METRICS_DIR):
+        self.directory = directory
+        self._metrics: dict[str, Metric] = {}
+        self._dumper = None
+
+    def _register(self, metric: Metric) -> Metric:
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self._register(Counter(name, documentation))
+
+    def gauge(self, name: str, documentation: str) -> Gauge:
+        return self._register(Gauge(name, documentation))
+
+    def histogram(self, name: str, documentation: str, buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, buckets=buckets))
+
+    def snapshot(self) -> dict:
+        return {
+            name: {
+                'kind': metric.kind
+                , 'documentation': metric.documentation
+                , 'buckets': list(getattr(metric, 'buckets', []))
+                , 'values': metric.snapshot()
+            }
+            for name, metric in self._metrics.items()
+        }
+
+    def dump(self) -> None:
+        if not self.directory:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        tmp_path = f'{path}.{uuid.uuid4().hex[:8]}.tmp'
+
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def start_dumping(self, interval: float = DUMP_INTERVAL) -> None:
+        """Dump the snapshot periodically from a daemon thread, it is restarted in the forked children"""
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.dump()
+                except OSError as e:
+                    print(f'Could not dump the metrics, {e}')
+
+        if self.directory and (self._dumper is None or not self._dumper.is_alive()):
+            if self._dumper is None:
+                atexit.register(self.dump)  # the values since the last dump, e.g. of a worker recycled by gunicorn
+
+            self._dumper = threading.Thread(target=loop, daemon=True, name='metrics')
+            self._dumper.start()
+
+    def _snapshots(self) -> list[tuple[int, dict]]:
+        """Read the snapshots of all the processes, the own one is taken fresh"""
+        snapshots = [(os.getpid(), self.snapshot())]
+        if not self.directory or not os.path.isdir(self.directory):
+            return snapshots
+
+        for entry in os.listdir(self.directory):
+            pid = entry.removesuffix('.json')
+            if not entry.endswith('.json') or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+
+            try:
+                with open(os.path.join(self.directory, entry)) as f:
+                    snapshots.append((int(pid), json.load(f)))
+            except (OSError, ValueError):  # removed or being replaced in the meantime
+                continue
+
+        return snapshots
+
+    @staticmethod
+    def _alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+
+        return True
+
+    def render(self) -> str:
+        """
+        Render the metrics in the Prometheus text format, the counters and the histograms are summed over the
+            processes, including the exited ones, the gauges are reported per live process
+        :return: the exposition text
+        """
+        merged: dict[str, dict] = {}
+        for pid, snapshot in self._snapshots():
+            for name, metric in snapshot.items():
+                target = merged.setdefault(name, {**metric, 'values': {}})
+
+                for key, value in metric['values']:
+                    key = tuple(map(tuple, key))
+                    if metric['kind'] == 'gauge':
+                        if pid == os.getpid() or self._alive(pid):
+                            target['values'][key + (('pid', str(pid)),)] = value
+                    elif metric['kind'] == 'counter':
+                        target['values'][key] = target['values'].get(key, 0) + value
+                    else:
+                        counts, total = target['values'].get(key, ([0] * len(value[0]), 0.0))
+                        target['values'][key] = ([a + b for a, b in zip(counts, value[0])], total + value[1])
+
+        lines = []
+        for name, metric in sorted(merged.items()):
+            lines.append(f"# HELP {name} {metric['documentation']}")
+            lines.append(f"# TYPE {name} {metric['kind']}")
+
+            for key, value in sorted(metric['values'].items()):
+                if metric['kind'] != 'histogram':
+                    lines.append(f'{name}{_labels(key)} {value}')
+                    continue
+
+                counts, total = value
+                cumulative = 0
+                for bound, count in zip([*metric['buckets'], '+Inf'], counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(key + (('le', str(bound)),))} {cumulative}")
+                lines.append(f'{name}_sum{_labels(key)} {total}')
+                lines.append(f'{name}_count{_labels(key)} {cumulative}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(key: tuple) -> str:
+    if not key:
+        return ''
+
+    escaped = (
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for name, value in key
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+class Sampler:
+    """
+    A sampling profiler of a single thread, the stacks are counted in the collapsed format of the flame graph tools
+    ...
+
+    Attributes
+    ----------
+    :param thread_id: the profiled thread, the current one if None
+    :param interval: number of seconds between two samples
+
+    Methods
+    -------
+    start() -> Sampler:
+        Start sampling
+    stop() -> Sampler:
+        Stop sampling
+    collapsed() -> str:
+        Get the sampled stacks, one 'frame;frame;frame count' line per distinct stack
+    """
+    def __init__(self, thread_id: int = None, interval: float = 0.001):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = Tally()
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='sampler')
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self) -> 'Sampler':
+        self._thread.start()
+        return self
+
+    def stop(self) -> 'Sampler':
+        self._stop.set()
+        self._thread.join()
+        return self
+
+    def collapsed(self) -> str:
+        return '\n'.join(f'{stack} {count}' for stack, count in self.stacks.most_common())
+
+
+REGISTRY = Registry()
+
+# the metrics of the hot paths, registered once, so that all the modules share them
+REQUESTS = REGISTRY.counter('http_requests_total', 'Number of the handled API requests')
+REQUEST_SECONDS = REGISTRY.histogram('http_request_duration_seconds', 'Duration of the API requests')
+STAGE_SECONDS = REGISTRY.histogram('stage_duration_seconds', 'Duration of the stages of the API requests')
+DB_QUERIES = REGISTRY.counter('db_queries_total', 'Number of the DB round trips')
+DB_QUERY_SECONDS = REGISTRY.histogram('db_query_duration_seconds', 'Duration of the DB round trips')
+HTTP_CLIENT_REQUESTS = REGISTRY.counter('http_client_requests_total', 'Number of the outgoing HTTP requests')
+HTTP_CLIENT_SECONDS = REGISTRY.histogram('http_client_duration_seconds', 'Duration of the outgoing HTTP requests')
+RETRIES = REGISTRY.counter('retries_total', 'Number of the retried outgoing requests, by the reason')
+CACHE_LOOKUPS = REGISTRY.counter('cache_lookups_total', 'Number of the cache lookups, by the cache and the result')
+ERRORS = REGISTRY.counter('errors_total', 'Number of the handled errors, by the component')
+NEIGHBOUR_LOOKUPS = REGISTRY.counter(
+    'neighbour_lookups_total', 'Number of the seeds, by the source of their neighbours'
+)
+MODEL_ROWS = REGISTRY.gauge('model_rows', 'Number of the tracks in the nearest neighbours index')
+MODEL_BYTES = REGISTRY.gauge('model_bytes', 'Size of the model features and the index arrays')
+MODEL_LOAD_SECONDS = REGISTRY.gauge('model_load_seconds', 'Duration of the last model load')
+DELTA_ROWS = REGISTRY.gauge('model_delta_rows', 'Number of the tracks in the delta index')
+CATALOG_ROWS = REGISTRY.gauge('catalog_rows', 'Number of the tracks in the in-memory catalog')
+CATALOG_LOAD_SECONDS = REGISTRY.gauge('catalog_load_seconds', 'Duration of the last catalog load')
+COALESCER_QUEUE_DEPTH = REGISTRY.gauge('coalescer_queue_depth', 'Number of the calls waiting for the next batch')
+COALESCER_BATCH_SIZE = REGISTRY.histogram(
+    'coalescer_batch_size', 'Number of the calls run as a single batch', buckets=SIZE_BUCKETS
+)
+COALESCER_WAIT_SECONDS = REGISTRY.histogram(
+    'coalescer_wait_seconds', 'Time the calls spent waiting for their batch to start'
+)
+
+stage = STAGE_SECONDS.time  # with stage(stage='neighbours'): ...
+
+
+# a forked child must not report the parent's values as its own, and the parent's dumping thread does not survive the
+# fork, so the child starts its own one
+def _reset_after_fork() -> None:
+    for metric in REGISTRY._metrics.values():
+        metric._lock = threading.Lock()
+        if metric.kind == 'gauge':
+            continue  # the gauges describe the state, e.g. the preloaded model, which the child shares
+        metric._values = {}
+
+    if REGISTRY._dumper is not None:  # the copied thread is not alive in the child, the exit hook is inherited
+        REGISTRY.start_dumping()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import weakref
+from .cache import LRUCache
+from .metrics import CACHE_LOOKUPS
+
+
+class ResponseCache:
+    """
+    A cache of the serialised API responses keyed by the request and the versions, an in-process LRU in front of a
+    SQLite file shared by the workers
+    ...
+
+    Attributes
+    ----------
+    :param path: path to the shared SQLite file, RESPONSE_CACHE_PATH or /dev/shm/response_cache.sqlite by default, the
+        shared tier is disabled if empty
+    :param maxbytes: maximal size of the responses in either tier, RESPONSE_CACHE_BYTES or 64 MiB by default
+    :param ttl: number of seconds the responses are valid for, RESPONSE_CACHE_TTL or 1 hour by default
+
+    Methods
+    -------
+    key(endpoint: str, versions: tuple, **params) -> str:
+        Build the cache key of the request
+    get(key: str) -> tuple[str, bytes] | None:
+        Get the ETag and the body of the cached response
+    set(key: str, body: bytes, ttl: float = None) -> str:
+        Cache the response, return its ETag
+    stats() -> dict[str, int]:
+        Get the counters of both tiers
+    """
+    _default_path = '/dev/shm/response_cache.sqlite' if os.path.isdir('/dev/shm') else ''
+    _prune_every = 100  # number of the writes between two size checks of the shared tier
+
+    def __init__(self, path: str = None, maxbytes: int = None, ttl: float = None):
+        self.path = path if path is not None else os.environ.get('RESPONSE_CACHE_PATH', self._default_path)
+        self.maxbytes = maxbytes or int(os.environ.get('RESPONSE_CACHE_BYTES', 64 * 2 ** 20))
+        self.ttl = ttl if ttl is not None else float(os.environ.get('RESPONSE_CACHE_TTL', 3600))
+
+        self._memory = LRUCache(maxsize=self.maxbytes, ttl=self.ttl, weigher=lambda entry: len(entry[1]))
+        self._local = threading.local()  # SQLite connections can't be shared between the threads, nor the processes
+        _caches.add(self)
+        self._writes = 0
+        self._shared_hits = 0
+        self._shared_misses = 0
+
+        if self.path:
+            with self._connection() as conn:
+                conn.execute("""
+                    create table if not exists responses (
+                        key text primary key
+                        , etag text not null
+                        , body blob not null
+                        , expires_at real not null
+                    )
+                """)
+
+    def _forget_connections(self) -> None:
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1)
+            conn.execute('pragma journal_mode=wal')
+            conn.execute('pragma synchronous=off')  # it is a cache in memory, there is nothing to make durable
+            self._local.conn = conn
+
+        return conn
+
+    @staticmethod
+    def key(endpoint: str, versions: tuple, **params) -> str:
+        """
+        Build the cache key, the parameters are serialised with the sorted keys, so their order does not matter
+        :param endpoint: the endpoint's name
+        :param versions: the versions the response depends on, e.g. of the model and the catalog
+        :param params: the normalised request parameters
+        :return: the cache key
+        """
+        payload = json.dumps([endpoint, list(versions), params], sort_keys=True, separators=(',', ':'))
+
+        return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+    def get(self, key: str) -> tuple[str, bytes] | None:
+        """
+        Get the cached response, the in-process tier is asked first
+        :param key: the cache key
+        :return: (ETag, body), None if the response is not cached
+        """
+        entry = self._memory.get(key)
+        if entry is not None or not self.path:
+            CACHE_LOOKUPS.inc(cache='response', tier='memory', result='miss' if entry is None else 'hit')
+            return entry
+
+        now = time.time()
+        try:
+            row = self._connection().execute(
+                'select etag, body, expires_at from responses where key = ? and expires_at > ?', (key, now)
+            ).fetchone()
+        except sqlite3.OperationalError:
+            row = None
+
+        if row is None:
+            self._shared_misses += 1
+            CACHE_LOOKUPS.inc(cache='response', tier='shared', result='miss')
+            return None
+
+        self._shared_hits += 1
+        CACHE_LOOKUPS.inc(cache='response', tier='shared', result='hit')
+        entry = (row[0], bytes(row[1]))
+        self._memory.set(key, entry, ttl=row[2] - now)
+
+        return entry
+
+    def set(self, key: str, body: bytes, ttl: float = None) -> str:
+        """
+        Cache the response in both tiers
+        :param key: the cache key
+        :param body: the serialised response
+        :param ttl: number of seconds the response is valid for, the cache's ttl if None
+        :return: the response's ETag
+        """
+        ttl = self.ttl if ttl is None else ttl
+        etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self._memory.set(key, (etag, body), ttl=ttl)
+
+        if not self.path:
+            return etag
+
+        try:
+            with self._connection() as conn:
+                conn.execute(
+                    'insert or replace into responses values (?, ?, ?, ?)', (key, etag, body, time.time() + ttl)
+                )
+
+            self._writes += 1
+            if self._writes % self._prune_every == 0:
+                self._prune()
+        except sqlite3.OperationalError as e:  # e.g. locked for too long, the in-process tier still has it
+            print(f'Could not share the cached response, {e}')
+
+        return etag
+
+    def _prune(self) -> None:
+        """Drop the expired responses, then the ones closest to the expiry, until the shared tier fits into maxbytes"""
+        with self._connection() as conn:
+            conn.execute('delete from responses where expires_at <= ?', (time.time(),))
+
+            size, count = conn.execute('select coalesce(sum(length(body)), 0), count(*) from responses').fetchone()
+            if size > self.maxbytes and count:
+                excess = int(count * (1 - self.maxbytes / size)) + 1
+                conn.execute(
+                    'delete from responses where key in (select key from responses order by expires_at limit ?)'
+                    , (excess,)
+                )
+
+    def stats(self) -> dict[str, int]:
+        return {
+            **{f'memory_{key}': value for key, value in self._memory.stats().items()}
+            , 'shared_hits': self._shared_hits
+            , 'shared_misses': self._shared_misses
+        }
+
+
+# the SQLite connections of the live caches are dropped in a forked child by a single hook, a hook per cache would keep
+# every cache ever created alive
+_caches: weakref.WeakSet[ResponseCache] = weakref.WeakSet()
+
+
+def _forget_after_fork() -> None:
+    for cache in list(_caches):
+        cache._forget_connections()
+
+
+os.register_at_fork(after_in_child=_forget_after_fork)
@@ -0,0 +1,232 @@
+import os
+import json
+import time
+import zlib
+import base64
+import binascii
+import sqlite3
+import threading
+import weakref
+from typing import Callable, NamedTuple
+import numpy as np
+from .cache import LRUCache
+from .metrics import CACHE_LOOKUPS
+
+
+class Session(NamedTuple):
+    """The tracks found for a session so far, replaced as a whole whenever the search goes deeper"""
+    candidates: np.ndarray  # the ranked catalog idx
+    unknown: list[str]  # the seeds that are not known to the model
+    depth: int  # the depth they were found at
+    exhausted: bool  # whether a greater depth would not find any more
+
+
+def pack_tracks(idx: np.ndarray) -> str:
+    """Pack the catalog idx into a compact URL-safe string, e.g. for a cursor, their order is not kept"""
+    gaps = np.diff(np.unique(np.asarray(idx, dtype=np.int64)), prepend=0).astype('<u4')
+
+    return base64.urlsafe_b64encode(zlib.compress(gaps.tobytes())).decode()
+
+
+def unpack_tracks(packed: str) -> np.ndarray:
+    """Unpack the catalog idx packed by pack_tracks(), sorted, raise ValueError if the string is not a packed one"""
+    try:
+        gaps = np.frombuffer(zlib.decompress(base64.urlsafe_b64decode(packed)), dtype='<u4')
+    except (TypeError, binascii.Error, zlib.error) as e:
+        raise ValueError(f'Invalid packed tracks, {e}')
+
+    return np.cumsum(gaps, dtype=np.int64)
+
+
+class SessionStore:
+    """
+    Serves a ranked stream of recommendations page by page, the tracks found for a session are kept in an in-process
+    LRU in front of a SQLite file shared by the workers, and searched twice as deep when a page reaches past them
+    ...
+
+    Attributes
+    ----------
+    :param fetch: gets the session's parameters and the depth, returns the ranked catalog idx, the unknown seeds and
+        whether a greater depth would not find any more, see Recommender.recommend_stream()
+    :param path: path to the shared SQLite file, RECOMMEND_SESSIONS_PATH or /dev/shm/sessions.sqlite by default, the
+        shared tier is disabled if empty
+    :param maxbytes: maximal size of the sessions' candidates in either tier, RECOMMEND_SESSIONS_BYTES or 32 MiB by
+        default
+    :param ttl: number of seconds a session is kept after its last page, RECOMMEND_SESSION_TTL or 30 minutes by default
+
+    Methods
+    -------
+    page(key: str, params: dict, offset: int, size: int, served: np.ndarray = None) -> tuple[np.ndarray, list, bool]:
+        Get the page of the session's stream, the unknown seeds, and whether there are more pages
+    """
+    _default_path = '/dev/shm/sessions.sqlite' if os.path.isdir('/dev/shm') else ''
+    _overhead = 256  # the approximate size of a session apart from its candidates
+    _prune_every = 100  # number of the writes between two size checks of the shared tier
+
+    def __init__(
+            self
+            , fetch: Callable[[dict, int], tuple[np.ndarray, list[str], bool]]
+            , path: str = None
+            , maxbytes: int = None
+            , ttl: float = None
+    ):
+        self.path = path if path is not None else os.environ.get('RECOMMEND_SESSIONS_PATH', self._default_path)
+        self.maxbytes = maxbytes or int(os.environ.get('RECOMMEND_SESSIONS_BYTES', 32 * 2 ** 20))
+        self.ttl = ttl if ttl is not None else float(os.environ.get('RECOMMEND_SESSION_TTL', 1800))
+
+        self._fetch = fetch
+        self._sessions = LRUCache(
+            maxsize=self.maxbytes, ttl=self.ttl, weigher=lambda session: session.candidates.nbytes + self._overhead
+        )
+        self._local = threading.local()  # SQLite connections can't be shared between the threads, nor the processes
+        _stores.add(self)
+        self._writes = 0
+
+        if self.path:
+            with self._connection() as conn:
+                conn.execute("""
+                    create table if not exists sessions (
+                        key text primary key
+                        , candidates blob not null
+                        , unknown text not null
+                        , depth integer not null
+                        , exhausted integer not null
+                        , expires_at real not null
+                    )
+                """)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _forget_connections(self) -> None:
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1)
+            conn.execute('pragma journal_mode=wal')
+            conn.execute('pragma synchronous=off')  # it is a cache in memory, there is nothing to make durable
+            self._local.conn = conn
+
+        return conn
+
+    def _get(self, key: str) -> Session | None:
+        """Get the session, the in-process tier is asked first"""
+        session = self._sessions.get(key)
+        if session is not None or not self.path:
+            CACHE_LOOKUPS.inc(cache='sessions', tier='memory', result='miss' if session is None else 'hit')
+            return session
+
+        try:
+            row = self._connection().execute(
+                'select candidates, unknown, depth, exhausted from sessions where key = ? and expires_at > ?'
+                , (key, time.time())
+            ).fetchone()
+        except sqlite3.OperationalError:
+            row = None
+
+        CACHE_LOOKUPS.inc(cache='sessions', tier='shared', result='miss' if row is None else 'hit')
+        if row is None:
+            return None
+
+        return Session(
+            candidates=np.frombuffer(row[0], dtype=np.int64), unknown=json.loads(row[1]), depth=row[2]
+            , exhausted=bool(row[3])
+        )
+
+    def _set(self, key: str, session: Session, changed: bool) -> None:
+        """Keep the session in both tiers for another ttl seconds, its candidates are only written if they changed"""
+        self._sessions.set(key, session)
+        if not self.path:
+            return
+
+        expires_at = time.time() + self.ttl
+        try:
+            with self._connection() as conn:
+                if changed:
+                    conn.execute('insert or replace into sessions values (?, ?, ?, ?, ?, ?)', (
+                        key, np.ascontiguousarray(session.candidates, dtype=np.int64).tobytes()
+                        , json.dumps(session.unknown), session.depth, int(session.exhausted), expires_at
+                    ))
+                else:
+                    conn.execute('update sessions set expires_at = ? where key = ?', (expires_at, key))
+
+            self._writes += 1
+            if self._writes % self._prune_every == 0:
+                self._prune()
+        except sqlite3.OperationalError as e:  # e.g. locked for too long, the in-process tier still has it
+            print(f'Could not share the session, {e}')
+
+    def _prune(self) -> None:
+        """Drop the expired sessions, then the ones closest to the expiry, until the shared tier fits into maxbytes"""
+        with self._connection() as conn:
+            conn.execute('delete from sessions where expires_at <= ?', (time.time(),))
+
+            size, count = conn.execute(
+                'select coalesce(sum(length(candidates)), 0), count(*) from sessions'
+            ).fetchone()
+            if size > self.maxbytes and count:
+                excess = int(count * (1 - self.maxbytes / size)) + 1
+                conn.execute(
+                    'delete from sessions where key in (select key from sessions order by expires_at limit ?)'
+                    , (excess,)
+                )
+
+    def page(
+            self
+            , key: str
+            , params: dict
+            , offset: int
+            , size: int
+            , served: np.ndarray = None
+    ) -> tuple[np.ndarray, list[str], bool]:
+        """
+        Get a page of the session's stream, the session is created or searched deeper if needed
+        :param key: the session's key, e.g. the hash of its parameters and of the model's and the catalog's versions
+        :param params: the session's parameters, passed to the fetch function
+        :param offset: number of the tracks served before the page
+        :param size: number of the tracks per page
+        :param served: the tracks served before the page in any order, the session is found again around them if it
+            has been lost or if it has served other tracks since, e.g. to another client, so none of them is repeated
+        :return: catalog idx of the page's tracks, the unknown seeds, and whether there are more pages
+        """
+        session = self._get(key)
+        if served is not None:
+            served = np.sort(np.asarray(served, dtype=np.int64))
+            if session is None or not np.array_equal(np.sort(session.candidates[:offset]), served):
+                session = Session(candidates=served, unknown=[], depth=0, exhausted=False) if len(served) else None
+
+        needed = offset + size + 1  # one more, to know whether there is a next page
+        changed = session is None or (len(session.candidates) < needed and not session.exhausted)
+        if changed:
+            depth = max(needed, 2 * session.depth) if session is not None else needed
+
+            while True:
+                candidates, unknown, exhausted = self._fetch(params, depth)
+                if len(candidates) >= needed or exhausted:
+                    break
+                depth *= 2
+
+            if session is not None:  # a deeper search may rank the tracks differently, the served ones stay in place
+                served = session.candidates[:offset]
+                candidates = np.concatenate([served, candidates[~np.isin(candidates, served)]])
+
+            session = Session(candidates=candidates, unknown=unknown, depth=depth, exhausted=exhausted)
+
+        self._set(key, session, changed=changed)  # the time to live starts again with every page
+
+        return session.candidates[offset:offset + size], session.unknown, len(session.candidates) > offset + size
+
+
+# the SQLite connections of the live stores are dropped in a forked child by a single hook, as the caches' ones are
+_stores: weakref.WeakSet[SessionStore] = weakref.WeakSet()
+
+
+def _forget_after_fork() -> None:
+    for store in list(_stores):
+        store._forget_connections()
+
+
+os.register_at_fork(after_in_child=_forget_after_fork)
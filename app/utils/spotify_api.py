@@ -1,8 +1,13 @@
 import os
+import sys
+import threading
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from functools import wraps
 from .api_handler import APIHandler, wait_on_429
+from .media_cache import MediaCache
+from .metrics import RETRIES
 
 load_dotenv()
 
@@ -13,10 +18,12 @@ def reauthorize_on_401(func):
         if not self._access_token:
             self._authenticate()
 
+        token = self._access_token
         result = func(self, *args, **kwargs)
 
         if isinstance(result, tuple) and len(result) >= 2 and result[1] == 401:
-            self._authenticate()
+            RETRIES.inc(reason='401')
+            self._authenticate(expired_token=token)
 
             result = func(self, *args, **kwargs)
 
@@ -26,7 +33,16 @@ def reauthorize_on_401(func):
 
 
 class SpotifyAPIHandler(APIHandler):
-    def __init__(self):
+    """
+    Spotify Web API client, the multi-track lookups are fetched concurrently in chunks of 50 ids, the media are kept in
+    the optional MediaCache
+    """
+    chunk_size = 50
+    # overridable, e.g. to point the client at a local stand-in
+    _api_url = os.environ.get('SPOTIFY_API_URL', 'https://api.spotify.com/v1')
+    _accounts_url = os.environ.get('SPOTIFY_ACCOUNTS_URL', 'https://accounts.spotify.com/api')
+
+    def __init__(self, cache: MediaCache | None = None):
         client_id = os.environ.get('SPOTIFY_ID')
         client_secret = os.environ.get('SPOTIFY_SECRET')
 
@@ -41,12 +57,32 @@ class SpotifyAPIHandler(APIHandler):
             , client_secret=client_secret
         )
 
+        self._cache = cache
         self._access_token = ''
         self._token_type = ''
+        self._start_executor()
+
+    def _after_fork(self) -> None:
+        super()._after_fork()
+        self._start_executor()  # the threads do not survive a fork
+
+    def _start_executor(self) -> None:
+        self._auth_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=int(os.environ.get('SPOTIFY_MAX_WORKERS', 4))
+            , thread_name_prefix='spotify'
+        )
 
-    def _authenticate(self) -> None:
+    def _authenticate(self, expired_token: str | None = None) -> None:
+        with self._auth_lock:
+            if expired_token is not None and self._access_token != expired_token:
+                return  # another thread has already renewed the token
+
+            self._request_token()
+
+    def _request_token(self) -> None:
         response, status = self.post(
-            url='https://accounts.spotify.com/api/token'
+            url=f'{self._accounts_url}/token'
             , headers={
                 'Content-Type': 'application/x-www-form-urlencoded'
             }
@@ -67,7 +103,7 @@ class SpotifyAPIHandler(APIHandler):
         #     self._authenticate()
 
         response, status = self.get(
-            url=f'https://api.spotify.com/v1/tracks/{track_id}'
+            url=f'{self._api_url}/tracks/{track_id}'
             , headers={'Authorization': f'{self._token_type}  {self._access_token}'}
         )
 
@@ -81,43 +117,132 @@ class SpotifyAPIHandler(APIHandler):
 
     @wait_on_429
     @reauthorize_on_401
-    def get_tracks(self, track_ids: list[str]) -> dict:
+    def _request_tracks(self, track_ids: list[str]) -> tuple[dict, int]:
         ids = ','.join(track_ids)
 
-        response, status = self.get(
-            url=f'https://api.spotify.com/v1/tracks?ids={ids}'
+        return self.get(
+            url=f'{self._api_url}/tracks?ids={ids}'
             , headers={'Authorization': f'{self._token_type}  {self._access_token}'}
         )
 
+    def get_tracks(self, track_ids: list[str]) -> dict:
+        response, status = self._request_tracks(track_ids=track_ids)
+
         if status == 200:
             return response
 
+    def _get_chunk(self, track_ids: list[str]) -> list[dict | None] | None:
+        """Fetch one chunk of tracks, None if the request failed, None entries for the tracks Spotify does not know"""
+        try:
+            response = self.get_tracks(track_ids=track_ids)
+        except Exception as e:  # a failed chunk must not fail the other ones
+            print(f'Spotify request for {len(track_ids)} tracks failed, {e}')
+            return None
+
+        if not response or len(response.get('tracks') or []) != len(track_ids):
+            return None
+
+        return response['tracks']
+
+    def _fetch_chunks(self, track_ids: list[str]) -> list[tuple[list[str], list[dict | None] | None]]:
+        """Split the ids into chunks and fetch them concurrently, return the chunks along with their results"""
+        if not self._access_token:  # authenticate once upfront instead of in every thread
+            self._authenticate()
+
+        chunks = [track_ids[i:i + self.chunk_size] for i in range(0, len(track_ids), self.chunk_size)]
+
+        if len(chunks) == 1:
+            return [(chunks[0], self._get_chunk(chunks[0]))]
+
+        return list(zip(chunks, self._executor.map(self._get_chunk, chunks)))
+
+    def get_tracks_chunked(self, track_ids: list[str]) -> list[dict | None]:
+        """
+        Fetch any number of tracks, the ids are split into chunks of chunk_size, which are fetched concurrently
+        :param track_ids: list of Spotify track ids
+        :return: the tracks' data in the order of the input, None for the tracks that could not be fetched
+        """
+        return [
+            entry
+            for chunk, entries in self._fetch_chunks(track_ids)
+            for entry in (entries if entries is not None else [None] * len(chunk))
+        ]
+
+    def get_media(self, track_ids: list[str]) -> dict[str, dict | None]:
+        """
+        Get the tracks' uri and image_url, from the cache if possible, the rest is fetched from Spotify and cached
+        :param track_ids: list of Spotify track ids
+        :return: track id -> {'uri', 'image_url'}, None for the tracks that are unknown or could not be fetched
+        """
+        media = self._cache.get_many(track_ids) if self._cache else {}
+        to_fetch = [track_id for track_id in dict.fromkeys(track_ids) if track_id not in media]
+
+        if not to_fetch:
+            return media
+
+        fetched, missing = {}, []
+        for chunk, entries in self._fetch_chunks(to_fetch):
+            if entries is None:  # failed, not cached, so the tracks are retried with the next request
+                media.update(dict.fromkeys(chunk))
+                continue
+
+            for track_id, entry in zip(chunk, entries):
+                if not entry or 'uri' not in entry:
+                    missing.append(track_id)
+                    continue
+
+                images = entry['album']['images']
+                fetched[track_id] = {'uri': entry['uri'], 'image_url': images[0]['url'] if images else None}
+
+        if self._cache:
+            self._cache.set_many(fetched, missing=missing)
+
+        media.update(fetched)
+        media.update(dict.fromkeys(missing))
+
+        return media
+
     def process_tracks(self, ids: list[str]) -> pd.DataFrame:
-        def extract_track_data(entry):
-            return {
-                'track_id': entry['id']
-                , 'uri': entry['uri']
-                , 'image_url': entry['album']['images'][0]['url']
-            }
+        if not ids:
+            return pd.DataFrame({})
 
-        if len(ids) > 1:
-            response = self.get_tracks(track_ids=ids)
-            track_data = [extract_track_data(entry) for entry in response['tracks']]
-            tracks = pd.DataFrame(track_data)
+        media = self.get_media(track_ids=ids)
+        empty = {'uri': None, 'image_url': None}
 
-        elif len(ids) == 1:
-            response = self.get_track(track_id=ids[0])
-            track_data = extract_track_data(response)
-            tracks = pd.DataFrame([track_data])
+        return pd.DataFrame([{'track_id': track_id, **(media.get(track_id) or empty)} for track_id in ids])
 
-        else:
-            tracks = pd.DataFrame({})
+    def prewarm(self, track_ids: list[str], batch_size: int = 1000) -> int:
+        """
+        Fill the cache with the media of the given tracks, e.g. the whole catalog ordered by popularity
+        :param track_ids: list of Spotify track ids
+        :param batch_size: number of the tracks processed at once
+        :return: number of the tracks that were fetched from Spotify
+        """
+        if not self._cache:
+            raise ValueError('There is no cache to prewarm, please pass a MediaCache to the constructor')
 
-        return tracks
+        n_fetched = 0
+        for start in range(0, len(track_ids), batch_size):
+            batch = track_ids[start:start + batch_size]
+            n_fetched += len(batch) - len(self._cache.get_many(batch))
+            self.get_media(batch)
+
+        return n_fetched
 
 
 if __name__ == '__main__':
-    api = SpotifyAPIHandler()
+    api = SpotifyAPIHandler(cache=MediaCache())
+
+    if sys.argv[1:2] == ['prewarm']:  # python -m utils.spotify_api prewarm [limit]
+        from db.db_handler import DB
+
+        catalog = DB.query_table(
+            table_name='tracks'
+            , columns=['track_id']
+            , order_by=['popularity desc']
+            , limit=int(sys.argv[2]) if len(sys.argv) > 2 else None
+        )
+        print(f"{api.prewarm(catalog['track_id'].tolist())} tracks fetched from Spotify")
 
     # print(api.get_track(track_id='5SuOikwiRyPMVoIQDJUgSV'))
     # print(api.get_tracks(track_ids=['7ouMYWpwJ422jRcDASZB7P', '4VqPOruhp5EdPBeR92t6lQ', '2takcwOaAZWiXQijPHIx7B']))